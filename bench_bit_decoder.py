@@ -0,0 +1,79 @@
+import random
+import timeit
+
+from decoders import *
+
+
+class LoopBitPackedBuffer(BitPackedBuffer):
+    # The byte-at-a-time read_bits loop, kept as the baseline for the benchmark
+
+    def read_bits(self, bits):
+        _next = self._next
+        _nextbits = self._nextbits
+        _bigendian = self._bigendian
+        _used = self._used
+
+        result = 0
+        remaining_bits = bits
+        read_bits = 0
+
+        while remaining_bits:
+            if _nextbits == 0:
+                if _used >= self._datalen:
+                    raise TruncatedError(self)
+                _next = self._data[_used]
+                _used += 1
+                _nextbits = 8
+
+            if remaining_bits > _nextbits:
+                remaining_bits -= _nextbits
+                if _bigendian:
+                    result |= _next << remaining_bits
+                else:
+                    result |= _next << read_bits
+                    read_bits += _nextbits
+                _nextbits = 0
+            else:
+                copy = _next & ((1 << remaining_bits) - 1)
+                _next = _next >> remaining_bits
+                _nextbits -= remaining_bits
+                if _bigendian:
+                    result |= copy
+                else:
+                    result |= copy << read_bits
+                break
+
+        self._next = _next
+        self._nextbits = _nextbits
+        self._used = _used
+
+        return result
+
+
+def bench(buffer_class, data, widths, endian, number):
+    def run():
+        buffer = buffer_class(data, endian)
+        read_bits = buffer.read_bits
+        for width in widths:
+            read_bits(width)
+
+    return min(timeit.repeat(run, number=number, repeat=5)) / number
+
+
+if __name__ == '__main__':
+    rnd = random.Random(0)
+    data = bytes(rnd.getrandbits(8) for i in range(1 << 16))
+
+    # Mix of widths seen in game events, plus the 32 bit reads from _int, _fourcc and unit tags
+    mixes = {
+        'mixed': [rnd.choice((1, 2, 3, 5, 7, 8, 14, 16, 20, 32)) for i in range(10000)],
+        '32-bit': [32] * 10000,
+        '64-bit': [64] * 5000,
+    }
+
+    for endian in ('big', 'little'):
+        for name, widths in mixes.items():
+            loop = bench(LoopBitPackedBuffer, data, widths, endian, 20)
+            fast = bench(BitPackedBuffer, data, widths, endian, 20)
+            print('%-6s %-7s loop %8.2f us  from_bytes %8.2f us  x%.2f' % (
+                endian, name, loop * 1e6, fast * 1e6, loop / fast))
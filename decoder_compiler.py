@@ -0,0 +1,543 @@
+# Copyright (c) 2018 Blizzard Entertainment
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections
+import struct
+import threading
+
+from decoders import *
+from decoders import _as_buffer, _decode_blob
+
+
+# Helpers the generated source refers to by name
+def _fourcc(value):
+    #  bug fix for hero mastery levels.  Bytes were decoding backwards.
+    return struct.pack('>I', value).decode('utf-8')
+
+
+_namespace = {
+    'CorruptedError': CorruptedError,
+    '_decode_blob': _decode_blob,
+    '_fourcc': _fourcc,
+    '_unpack_real32': struct.Struct('>f').unpack,
+    '_unpack_real64': struct.Struct('>d').unpack,
+}
+
+
+class BitPackedCompiler:
+    """Turns a protocol's typeinfos into flat python source for BitPackedDecoder.
+
+    Every typeid gets one function.  Ints, bools, blobs and optionals/arrays of them are
+    inlined as expressions into their parents, so a struct of simple fields decodes in a
+    single call that builds one dict display.  The functions live inside a _bind(buffer)
+    factory which caches the buffer methods as closure variables.
+    """
+
+    def __init__(self, typeinfos, projection=None):
+        self._typeinfos = typeinfos
+        self._widths = fixed_bit_widths(typeinfos)
+        self._projection = projection or {}
+        self._projected = {}  # (typeid, fields) -> name of the projected struct function
+        self._projected_lines = []
+
+    def _int_expr(self, bounds):
+        if bounds[1] == 0:
+            return repr(bounds[0])
+        if bounds[0] == 0:
+            return 'read_bits(%d)' % bounds[1]
+        return '(%d + read_bits(%d))' % (bounds[0], bounds[1])
+
+    def expr(self, typeid):
+        # Returns a python expression which decodes typeid
+        name, args = self._typeinfos[typeid]
+        if name == '_int':
+            return self._int_expr(args[0])
+        elif name == '_bool':
+            return '(read_bits(1) != 0)'
+        elif name == '_null':
+            return 'None'
+        elif name == '_fourcc':
+            return '_fourcc(read_bits(32))'
+        elif name == '_blob':
+            return '_decode_blob(read_aligned_view(%s))' % self._int_expr(args[0])
+        elif name == '_real32':
+            return '_unpack_real32(read_unaligned_bytes(4))'
+        elif name == '_real64':
+            return '_unpack_real64(read_unaligned_bytes(8))'
+        elif name == '_optional':
+            return '(%s if read_bits(1) else None)' % self.expr(args[0])
+        elif name == '_array':
+            return '[%s for _ in range(%s)]' % (self.expr(args[1]), self._int_expr(args[0]))
+        return '_t%d()' % typeid
+
+    def function(self, typeid):
+        # Returns the lines of the function body for typeid
+        name, args = self._typeinfos[typeid]
+        if name == '_struct':
+            return self._struct(args[0])
+        elif name == '_choice':
+            return self._choice(args[0], args[1])
+        elif name == '_bitarray':
+            return ['length = %s' % self._int_expr(args[0]),
+                    'return (length, read_bits(length))']
+        elif name in ('_int', '_bool', '_null', '_fourcc', '_blob', '_real32', '_real64',
+                      '_optional', '_array'):
+            return ['return %s' % self.expr(typeid)]
+        raise CorruptedError('unknown typeinfo %r' % (name,))
+
+    def _struct(self, fields):
+        # The parent is decoded first, wherever it is declared, and its fields are merged
+        # into the result when it is a struct.
+        parent = [f for f in fields if f[0] == '__parent']
+        fields = [f for f in fields if f[0] != '__parent']
+
+        if not parent:
+            items = ', '.join('%r: %s' % (name, self.expr(typeid)) for name, typeid, tag in fields)
+            return ['return {%s}' % items]
+
+        lines = ['result = %s' % self.expr(parent[0][1]),
+                 'if not isinstance(result, dict):',
+                 "    result = {'__parent': result}"]
+        for name, typeid, tag in fields:
+            lines.append('result[%r] = %s' % (name, self.expr(typeid)))
+        lines.append('return result')
+        return lines
+
+    def _choice(self, bounds, fields):
+        lines = ['tag = %s' % self._int_expr(bounds)]
+        for tag in sorted(fields):
+            name, typeid = fields[tag]
+            lines.append('if tag == %d:' % tag)
+            lines.append('    return {%r: %s}' % (name, self.expr(typeid)))
+        lines.append('raise CorruptedError(buffer)')
+        return lines
+
+    def skip(self, typeid, inline=True):
+        # Returns statements which advance the buffer past typeid without building any objects.
+        # Fixed width types collapse into a single skip_bits, other structs and choices are skipped
+        # with a call to their skip function unless inline is False.
+        name, args = self._typeinfos[typeid]
+        width = self._widths[typeid]
+        if width is not None:
+            return ['skip_bits(%d)' % width] if width else []
+        elif name in ('_struct', '_choice') and inline:
+            return ['_s%d()' % typeid]
+        elif name == '_blob':
+            return ['skip_aligned_bytes(%s)' % self._int_expr(args[0])]
+        elif name == '_bitarray':
+            return ['skip_bits(%s)' % self._int_expr(args[0])]
+        elif name == '_optional':
+            return self._block('if read_bits(1):', self.skip(args[0]))
+        elif name == '_array':
+            element = self._widths[args[1]]
+            if element is not None:
+                return ['skip_bits(%s * %d)' % (self._int_expr(args[0]), element)] if element else []
+            return self._block('for _ in range(%s):' % self._int_expr(args[0]), self.skip(args[1]))
+        elif name == '_struct':
+            return self._skip_fields(sorted(args[0], key=lambda f: f[0] != '__parent'))
+        elif name == '_choice':
+            lines = ['tag = %s' % self._int_expr(args[0])]
+            for tag in sorted(args[1]):
+                lines.extend(self._block('if tag == %d:' % tag, self.skip(args[1][tag][1]) + ['return']))
+            lines.append('raise CorruptedError(buffer)')
+            return lines
+        raise CorruptedError('unknown typeinfo %r' % (name,))
+
+    def _skip_fields(self, fields):
+        # Runs of fixed width fields are skipped together
+        lines = []
+        fixed = 0
+        for field in fields:
+            if self._widths[field[1]] is not None:
+                fixed += self._widths[field[1]]
+                continue
+            if fixed:
+                lines.append('skip_bits(%d)' % fixed)
+                fixed = 0
+            lines.extend(self.skip(field[1]))
+        if fixed:
+            lines.append('skip_bits(%d)' % fixed)
+        return lines
+
+    def projected(self, typeid, wanted):
+        # Returns the name of a function decoding only the wanted fields of struct typeid.
+        # The other fields are skipped, a struct parent is projected the same way.
+        key = (typeid, wanted)
+        if key in self._projected:
+            return self._projected[key]
+        name = '_p%d_%d' % (typeid, len(self._projected))
+        self._projected[key] = name
+
+        fields = self._typeinfos[typeid][1][0]
+        parent = [f for f in fields if f[0] == '__parent']
+        lines = ['result = {}']
+        if parent:
+            if self._typeinfos[parent[0][1]][0] == '_struct':
+                parent_expr = '%s()' % self.projected(parent[0][1], wanted)
+            else:
+                parent_expr = self.expr(parent[0][1])
+            lines = ['result = %s' % parent_expr,
+                     'if not isinstance(result, dict):',
+                     "    result = {'__parent': result}"]
+
+        skipped = []
+        for field in fields:
+            if field[0] == '__parent':
+                continue
+            if field[0] not in wanted:
+                skipped.append(field)
+                continue
+            lines.extend(self._skip_fields(skipped))
+            skipped = []
+            lines.append('result[%r] = %s' % (field[0], self.expr(field[1])))
+        lines.extend(self._skip_fields(skipped))
+        lines.append('return result')
+
+        self._projected_lines.append('    def %s():' % name)
+        self._projected_lines.extend('        ' + line for line in lines)
+        return name
+
+    def _block(self, header, lines):
+        return [header] + ['    ' + line for line in (lines or ['pass'])]
+
+    def source(self):
+        lines = ['def _bind(buffer):',
+                 '    read_bits = buffer.read_bits',
+                 '    read_aligned_view = buffer.read_aligned_view',
+                 '    read_unaligned_bytes = buffer.read_unaligned_bytes',
+                 '    skip_bits = buffer.skip_bits',
+                 '    skip_aligned_bytes = buffer.skip_aligned_bytes']
+        for typeid in range(len(self._typeinfos)):
+            lines.append('    def _t%d():' % typeid)
+            lines.extend('        ' + line for line in self.function(typeid))
+            lines.append('    def _s%d():' % typeid)
+            lines.extend('        ' + line for line in (self.skip(typeid, inline=False) or ['pass']))
+
+        # Projected structs replace the full decoder of their typeid
+        decoders = ['_t%d' % i for i in range(len(self._typeinfos))]
+        for typeid, wanted in sorted(self._projection.items()):
+            if self._typeinfos[typeid][0] == '_struct':
+                decoders[typeid] = self.projected(typeid, frozenset(wanted))
+        lines.extend(self._projected_lines)
+
+        lines.append('    return ([%s],' % ', '.join(decoders))
+        lines.append('            [%s])' % ', '.join('_s%d' % i for i in range(len(self._typeinfos))))
+        return '\n'.join(lines) + '\n'
+
+
+class BitPackedProgram:
+    """The compiled decoder functions for one set of typeinfos.
+
+    The source is generated and compiled once, bind() creates the decoder and skip functions
+    for a buffer.  projection optionally maps struct typeids to the field names to decode,
+    instance() of those typeids leaves the other fields out.
+    """
+
+    def __init__(self, typeinfos, projection=None):
+        self.typeinfos = typeinfos
+        self.source = BitPackedCompiler(typeinfos, projection).source()
+        namespace = dict(_namespace)
+        exec(compile(self.source, '<bitpacked typeinfos>', 'exec'), namespace)
+        self._bind = namespace['_bind']
+
+    def bind(self, buffer):
+        return self._bind(buffer)
+
+
+class CompiledBitPackedDecoder(BitPackedDecoder):
+    """BitPackedDecoder running the generated functions of a BitPackedProgram."""
+
+    def __init__(self, contents, program):
+        self._buffer = _as_buffer(contents)
+        self._typeinfo_functions, self._skip_functions = program.bind(self._buffer)
+        self._typeinfo_len = len(self._typeinfo_functions)
+
+    def skip(self, typeid):
+        self._skip_functions[typeid]()
+
+
+def _vint(buffer):
+    b = buffer.read_bits(8)
+    negative = b & 1
+    result = (b >> 1) & 0x3f
+    bits = 6
+    while (b & 0x80) != 0:
+        b = buffer.read_bits(8)
+        result |= (b & 0x7f) << bits
+        bits += 7
+    return -result if negative else result
+
+
+def _skip_instance(buffer):
+    skip = buffer.read_bits(8)
+    if skip == 0:  # array
+        length = _vint(buffer)
+        for i in range(0,length):
+            _skip_instance(buffer)
+    elif skip == 1:  # bitblob
+        length = _vint(buffer)
+        buffer.read_aligned_view((length + 7) // 8)
+    elif skip == 2:  # blob
+        length = _vint(buffer)
+        buffer.read_aligned_view(length)
+    elif skip == 3:  # choice
+        tag = _vint(buffer)
+        _skip_instance(buffer)
+    elif skip == 4:  # optional
+        exists = buffer.read_bits(8) != 0
+        if exists:
+            _skip_instance(buffer)
+    elif skip == 5:  # struct
+        length = _vint(buffer)
+        for i in range(0,length):
+            tag = _vint(buffer)
+            _skip_instance(buffer)
+    elif skip == 6:  # u8
+        buffer.read_aligned_view(1)
+    elif skip == 7:  # u32
+        buffer.read_aligned_view(4)
+    elif skip == 8:  # u64
+        buffer.read_aligned_view(8)
+    elif skip == 9:  # vint
+        _vint(buffer)
+
+
+class VersionedProgram:
+    """Closures decoding each typeid of a versioned stream, resolved once per typeinfos.
+
+    Unlike VersionedDecoder, the typeinfo dispatch happens once when the program is built, and
+    structs and choices look their fields up by tag in a precomputed dict.  Every function takes
+    the buffer to read from, so one program serves any number of buffers.  projection works as
+    for BitPackedProgram.
+    """
+
+    def __init__(self, typeinfos, projection=None):
+        self.typeinfos = typeinfos
+        self.functions = []
+
+        # ASSUMPTION:  structs & related only use previously declared functions
+        for funcName, args_array in typeinfos:
+            self.functions.append(getattr(self, funcName)(*args_array))
+
+        # Projected structs replace the full decoder of their typeid once everything is built,
+        # so nested uses of the typeid still decode every field.
+        projected = list(self.functions)
+        for typeid, wanted in (projection or {}).items():
+            funcName, args_array = typeinfos[typeid]
+            if funcName == '_struct':
+                projected[typeid] = self._struct(args_array[0], frozenset(wanted))
+        self.functions = projected
+
+    def _array(self, bounds, typeid):
+        element_func = self.functions[typeid]
+
+        def _array_closure(buffer):
+            if buffer.read_bits(8) != 0:
+                raise CorruptedError(buffer)
+            return [element_func(buffer) for i in range(_vint(buffer))]
+        return _array_closure
+
+    def _bitarray(self, bounds):
+        def _bitarray_closure(buffer):
+            if buffer.read_bits(8) != 1:
+                raise CorruptedError(buffer)
+            length = _vint(buffer)
+            return (length, buffer.read_aligned_bytes((length + 7) // 8))
+        return _bitarray_closure
+
+    def _blob(self, bounds):
+        def _blob_closure(buffer):
+            if buffer.read_bits(8) != 2:
+                raise CorruptedError(buffer)
+            return _decode_blob(buffer.read_aligned_view(_vint(buffer)))
+        return _blob_closure
+
+    def _bool(self):
+        def _bool_closure(buffer):
+            if buffer.read_bits(8) != 6:
+                raise CorruptedError(buffer)
+            return buffer.read_bits(8) != 0
+        return _bool_closure
+
+    def _choice(self, bounds, fields):
+        field_lookup = {}
+        for tag, (name, typeid) in fields.items():
+            field_lookup[tag] = (name, self.functions[typeid])
+
+        def _choice_closure(buffer):
+            if buffer.read_bits(8) != 3:
+                raise CorruptedError(buffer)
+            field = field_lookup.get(_vint(buffer))
+            if field is None:
+                _skip_instance(buffer)
+                return {}
+            return {field[0]: field[1](buffer)}
+        return _choice_closure
+
+    def _fourcc(self):
+        def _fourcc_closure(buffer):
+            if buffer.read_bits(8) != 7:
+                raise CorruptedError(buffer)
+            return buffer.read_aligned_bytes(4)
+        return _fourcc_closure
+
+    def _int(self, bounds):
+        def _int_closure(buffer):
+            if buffer.read_bits(8) != 9:
+                raise CorruptedError(buffer)
+            return _vint(buffer)
+        return _int_closure
+
+    def _null(self):
+        def _null_closure(buffer):
+            return None
+        return _null_closure
+
+    def _optional(self, typeid):
+        exec_func = self.functions[typeid]
+
+        def _optional_closure(buffer):
+            if buffer.read_bits(8) != 4:
+                raise CorruptedError(buffer)
+            return exec_func(buffer) if buffer.read_bits(8) != 0 else None
+        return _optional_closure
+
+    def _real32(self):
+        unpack = struct.Struct('>f').unpack
+
+        def _real32_closure(buffer):
+            if buffer.read_bits(8) != 7:
+                raise CorruptedError(buffer)
+            return unpack(buffer.read_aligned_view(4))
+        return _real32_closure
+
+    def _real64(self):
+        unpack = struct.Struct('>d').unpack
+
+        def _real64_closure(buffer):
+            if buffer.read_bits(8) != 8:
+                raise CorruptedError(buffer)
+            return unpack(buffer.read_aligned_view(8))
+        return _real64_closure
+
+    def _struct(self, fields, wanted=None):
+        # Fields left out of wanted are skipped like unknown tags
+        field_lookup = {}
+        for name, typeid, tag in fields:
+            if wanted is not None and name == '__parent' and self.typeinfos[typeid][0] == '_struct':
+                field_lookup.setdefault(tag, (name, self._struct(self.typeinfos[typeid][1][0], wanted)))
+            elif wanted is None or name in wanted or name == '__parent':
+                field_lookup.setdefault(tag, (name, self.functions[typeid]))
+        single = len(fields) == 1
+
+        def _struct_closure(buffer):
+            if buffer.read_bits(8) != 5:
+                raise CorruptedError(buffer)
+            result = {}
+            for i in range(_vint(buffer)):
+                field = field_lookup.get(_vint(buffer))
+                if field is None:
+                    _skip_instance(buffer)
+                elif field[0] == '__parent':
+                    parent = field[1](buffer)
+                    if isinstance(parent, dict):
+                        result.update(parent)
+                    elif single:
+                        result = parent
+                    else:
+                        result['__parent'] = parent
+                else:
+                    result[field[0]] = field[1](buffer)
+            return result
+        return _struct_closure
+
+
+class CompiledVersionedDecoder(VersionedDecoder):
+    """VersionedDecoder running the closures of a VersionedProgram."""
+
+    def __init__(self, contents, program):
+        self._buffer = _as_buffer(contents)
+        self._typeinfos = program.typeinfos
+        self._functions = program.functions
+
+    def instance(self, typeid):
+        if typeid >= len(self._functions):
+            raise CorruptedError(self)
+        return self._functions[typeid](self._buffer)
+
+    def skip(self, typeid):
+        _skip_instance(self._buffer)
+
+
+# Compiled programs, keyed on the program class and the identity of the typeinfos list they
+# were built from.  Each protocol build has its own typeinfos list, so this is a per-build cache
+# and the typeinfos are kept alive alongside the program so their id can't be reused.
+# Unprojected programs are kept for good, projected ones are per query so only the most
+# recently used MAX_PROJECTED_PROGRAMS of them are.
+_programs = {}
+_projected_programs = collections.OrderedDict()
+_programs_lock = threading.Lock()
+
+MAX_PROJECTED_PROGRAMS = 64
+
+
+def get_program(program_class, typeinfos, projection=None):
+    """Returns the program_class program for typeinfos, building it on first use.
+
+    projection maps struct typeids to the field names to decode, see BitPackedProgram.
+    """
+    if not projection:
+        key = (program_class, id(typeinfos))
+        entry = _programs.get(key)
+        if entry is None:
+            with _programs_lock:
+                entry = _programs.get(key)
+                if entry is None:
+                    entry = (typeinfos, program_class(typeinfos, {}))
+                    _programs[key] = entry
+        return entry[1]
+
+    projection = tuple(sorted((typeid, tuple(sorted(fields))) for typeid, fields in projection.items()))
+    key = (program_class, id(typeinfos), projection)
+    with _programs_lock:
+        entry = _projected_programs.get(key)
+        if entry is None:
+            entry = (typeinfos, program_class(typeinfos, dict(projection)))
+            _projected_programs[key] = entry
+            if len(_projected_programs) > MAX_PROJECTED_PROGRAMS:
+                _projected_programs.popitem(last=False)
+        else:
+            _projected_programs.move_to_end(key)
+    return entry[1]
+
+
+def get_bitpacked_program(typeinfos, projection=None):
+    return get_program(BitPackedProgram, typeinfos, projection)
+
+
+def get_versioned_program(typeinfos, projection=None):
+    return get_program(VersionedProgram, typeinfos, projection)
+
+
+def clear_programs():
+    """Drops every cached program."""
+    with _programs_lock:
+        _programs.clear()
+        _projected_programs.clear()
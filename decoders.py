@@ -29,117 +29,284 @@ class CorruptedError(Exception):
     pass
 
 
+def _decode_blob(view):
+    # Blobs are text when they are valid utf-8, raw bytes otherwise
+    try:
+        return str(view, 'utf-8')
+    except UnicodeDecodeError:
+        return view.tobytes()
+
+
+def fixed_bit_widths(typeinfos):
+    """Returns the number of bits each typeid takes up in a bit-packed stream.
+
+    The width is None for types whose size depends on the data (optionals, variable length
+    arrays, blobs...).
+    """
+    widths = []
+    for name, args in typeinfos:
+        width = None
+        if name == '_int':
+            width = args[0][1]
+        elif name == '_bool':
+            width = 1
+        elif name == '_null':
+            width = 0
+        elif name in ('_fourcc', '_real32'):
+            width = 32
+        elif name == '_real64':
+            width = 64
+        elif name == '_bitarray':
+            if args[0][1] == 0:
+                width = args[0][0]
+        elif name == '_array':
+            element = widths[args[1]] if args[1] < len(widths) else None
+            if args[0][1] == 0 and element is not None:
+                width = args[0][0] * element
+        elif name == '_struct':
+            fields = [widths[f[1]] if f[1] < len(widths) else None for f in args[0]]
+            if None not in fields:
+                width = sum(fields)
+        elif name == '_choice':
+            options = set(widths[t] if t < len(widths) else None for n, t in args[1].values())
+            if len(options) == 1 and None not in options:
+                width = args[0][1] + options.pop()
+        widths.append(width)
+    return widths
+
+
 class BitPackedBuffer:
     def __init__(self, contents, endian='big'):
-        self._data = contents or []
+        # The buffer walks the payload by byte index over a memoryview, so the
+        # bit position is always known and aligned reads can be sliced without copying.
+        self._data = memoryview(contents or b'').cast('B')
         self._datalen = len(self._data)
-        self._datagen = iter(self._data)
-        self._used = 0
-        self._next = 0
+        self._used = 0  # index of the next unread byte in _data
+        self._next = 0  # unread bits of the current byte, right-adjusted
         self._nextbits = 0
         self._bigendian = (endian == 'big')
 
     def __str__(self):
-        return 'buffer(%02x/%d)' % (self._next or 0, self._nextbits)
+        return 'buffer(%02x/%d,[%d]=%s)' % (
+            self._nextbits and self._next or 0, self._nextbits,
+            self._used, '%02x' % (self._data[self._used],) if (self._used < self._datalen) else '--')
 
     def done(self):
-        if self._next is None:
-            return True
+        return self._nextbits == 0 and self._used >= self._datalen
 
-        # if we're at the end of a byte, read a byte, and check again.
-        if self._nextbits == 0:
-            self._next = next(self._datagen, None)
-            self._nextbits = 8
+    def tell_bits(self):
+        return (self._used << 3) - self._nextbits
 
-            return self._next is None
-        else:
-            return False
+    # used_bits is the historical name for the bit position
+    used_bits = tell_bits
 
-    # Here for compatibility, currently does nothing as we're using an iterator
-    def used_bits(self):
-        return 0
+    def seek_bits(self, bits):
+        if bits < 0 or bits > (self._datalen << 3):
+            raise TruncatedError(self)
+
+        used = bits >> 3
+        offset = bits & 7
+        if offset:
+            # Partially consumed bytes are stored with the consumed low bits shifted out
+            self._next = self._data[used] >> offset
+            self._nextbits = 8 - offset
+            used += 1
+        else:
+            self._next = 0
+            self._nextbits = 0
+        self._used = used
 
     def byte_align(self):
+        self._next = 0
         self._nextbits = 0
 
-    def read_aligned_bytes(self, num_bytes):
-        self.byte_align()
-        return bytes(next(self._datagen) for i in range(0, num_bytes))
+    def skip_bits(self, bits):
+        if bits <= self._nextbits:
+            self._next >>= bits
+            self._nextbits -= bits
+        else:
+            self.seek_bits((self._used << 3) - self._nextbits + bits)
 
-    def read_bits(self, bits):
+    def skip_aligned_bytes(self, num_bytes):
+        self._next = 0
+        self._nextbits = 0
+        end = self._used + num_bytes
+        if end > self._datalen:
+            raise TruncatedError(self)
+        self._used = end
 
-        # Special case for when we aren't reading any bits
-        if bits == 0:
-            return 0
+    def read_aligned_view(self, num_bytes):
+        # Returns a zero-copy memoryview over the next num_bytes bytes
+        self._next = 0
+        self._nextbits = 0
+        start = self._used
+        end = start + num_bytes
+        if end > self._datalen:
+            raise TruncatedError(self)
+        self._used = end
+        return self._data[start:end]
 
-        # cache the class variables as locals to reduce pointer dereferences
-        _next = self._next
+    def read_aligned_bytes(self, num_bytes):
+        return self.read_aligned_view(num_bytes).tobytes()
+
+    def read_bits(self, bits):
         _nextbits = self._nextbits
-        _bigendian = self._bigendian
-        _datagen = self._datagen
-
-        result = 0
-        remaining_bits = bits # this is the number of bits remaining to be read.
-        read_bits = 0 # only increment this in little-endian mode
-
-        while True:
-            if _nextbits == 0:
-                _next = _datagen.__next__()
-                _nextbits = 8
-
-            # If we have to read more than the available bits in our _next, then just read all of the bits
-            # This works because partial reads of _next are destructive of the bits that are read.
-            # As a result, _next will never be greater than 2^_nextbits
-            if remaining_bits > _nextbits:
-                copy = _next  # This copy is technically unnecessary, but it keeps the code consistent.
-
-                # By subtracting first, remaining_bits becomes the right-most position (big-endian).
-                remaining_bits -= _nextbits
-
-                if _bigendian:
-                    # Bits in _nextbits are always right-adjusted, so we left-shift the requisite number of bits
-                    result |= copy << remaining_bits
-                else:
-                    # We use read_bits here for little endian because the first byte is 0-adjusted,
-                    # second is 8-adjusted, etc.
+        _next = self._next
 
-                    result |= copy << read_bits
-                    read_bits += _nextbits  # Append to read_bits after using it.  Order is important here.
-                _nextbits = 0  # We just read all of the bits, so we need to read another byte
+        # Fast path: the request fits in the bits left over from the current byte
+        if bits <= _nextbits:
+            self._next = _next >> bits
+            self._nextbits = _nextbits - bits
+            return _next & ((1 << bits) - 1)
+
+        # NOTE:  _next is always right-adjusted and smaller than 2^_nextbits, so it can be used as-is.
+        # Bits are consumed from the low end of each byte, so in big-endian mode only the low bits
+        # of the last byte touched belong to this read.
+        need = bits - _nextbits  # bits that have to come from whole bytes
+        _used = self._used
+
+        if need <= 8:
+            # Only one more byte is involved, index it directly
+            if _used >= self._datalen:
+                raise TruncatedError(self)
+            byte = self._data[_used]
+            self._used = _used + 1
+            self._next = byte >> need
+            self._nextbits = 8 - need
+            if self._bigendian:
+                return (_next << need) | (byte & ((1 << need) - 1))
+            return _next | ((byte & ((1 << need) - 1)) << _nextbits)
+
+        # Otherwise pull every byte the request touches in a single int.from_bytes call,
+        # then shift and mask the word into place.
+        end = _used + ((need + 7) >> 3)
+        if end > self._datalen:
+            raise TruncatedError(self)
+        extra = ((end - _used) << 3) - need  # unread high bits left over in the last byte
+
+        if self._bigendian:
+            word = int.from_bytes(self._data[_used:end], 'big')
+            if extra:
+                lastbits = 8 - extra
+                result = ((_next << need) | ((word >> 8) << lastbits) |
+                          (word & ((1 << lastbits) - 1)))
+                self._next = (word & 0xff) >> lastbits
             else:
-                copy = _next & ((1 << remaining_bits) - 1)  # We are creating a mask here by 1 << 3 == 1000 - 1 = 0111
-                _next = _next >> remaining_bits  # We are removing the bits that we just used here.
-                _nextbits -= remaining_bits  # Keep track of the number of bits remaining.
-
-                if _bigendian:
-                    # No need to left adjust since last byte in big endian mode is right-adjusted.
-                    result |= copy
-                else:
-                    result |= copy << read_bits
-
-                # NOTE:  no need to adjust remaining_bits or read_bits since we're exiting
-                break
+                result = (_next << need) | word
+                self._next = 0
+        else:
+            word = int.from_bytes(self._data[_used:end], 'little')
+            result = _next | ((word & ((1 << need) - 1)) << _nextbits)
+            self._next = word >> need
 
-        self._next = _next
-        self._nextbits = _nextbits
+        self._nextbits = extra
+        self._used = end
 
         return result
 
     def read_unaligned_bytes(self, num_bytes):
         # read_bits is slow, so doing a trivial check to see if we are at a bytes boundary
         if self._nextbits == 0:
-            return bytes(next(self._datagen) for i in range(0,num_bytes))
+            return self.read_aligned_bytes(num_bytes)
         else:
             return bytes(self.read_bits(8) for i in range(0,num_bytes))
 
 
+class ChunkedBitPackedBuffer(BitPackedBuffer):
+    """A BitPackedBuffer over an iterable of chunks, e.g. the sectors of a compressed file.
+
+    Chunks are pulled as reads reach the end of the current one, and reads can span chunks.
+    Only the unread part of the stream is kept, so seek_bits can't go back before the
+    chunk being read.
+    """
+    def __init__(self, chunks, endian='big'):
+        BitPackedBuffer.__init__(self, b'', endian)
+        self._chunks = iter(chunks)
+        self._base = 0  # stream offset of _data
+
+    def _fill(self, num_bytes):
+        # Extends the unread bytes to at least num_bytes, returns False when the chunks run out
+        available = self._datalen - self._used
+        if available >= num_bytes or self._chunks is None:
+            return False
+        parts = [self._data[self._used:]]
+        for chunk in self._chunks:
+            parts.append(chunk)
+            available += len(chunk)
+            if available >= num_bytes:
+                break
+        else:
+            self._chunks = None
+        self._base += self._used
+        self._data = memoryview(b''.join(parts)).cast('B')
+        self._datalen = len(self._data)
+        self._used = 0
+        return True
+
+    def done(self):
+        if self._used >= self._datalen:
+            self._fill(1)
+        return BitPackedBuffer.done(self)
+
+    def tell_bits(self):
+        return ((self._base + self._used) << 3) - self._nextbits
+
+    used_bits = tell_bits
+
+    def seek_bits(self, bits):
+        # Chunks entirely before bits are dropped without being joined to the unread bytes
+        while self._chunks is not None and bits >= ((self._base + self._datalen) << 3):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._chunks = None
+                break
+            self._base += self._datalen
+            self._data = memoryview(chunk).cast('B')
+            self._datalen = len(self._data)
+            self._used = 0
+        BitPackedBuffer.seek_bits(self, bits - (self._base << 3))
+
+    def skip_bits(self, bits):
+        if bits <= self._nextbits:
+            BitPackedBuffer.skip_bits(self, bits)
+        else:
+            self.seek_bits(self.tell_bits() + bits)
+
+    def skip_aligned_bytes(self, num_bytes):
+        self._fill(num_bytes)
+        BitPackedBuffer.skip_aligned_bytes(self, num_bytes)
+
+    def read_aligned_view(self, num_bytes):
+        try:
+            return BitPackedBuffer.read_aligned_view(self, num_bytes)
+        except TruncatedError:
+            if not self._fill(num_bytes):
+                raise
+            return BitPackedBuffer.read_aligned_view(self, num_bytes)
+
+    def read_bits(self, bits):
+        try:
+            return BitPackedBuffer.read_bits(self, bits)
+        except TruncatedError:
+            if not self._fill((bits - self._nextbits + 7) >> 3):
+                raise
+            return BitPackedBuffer.read_bits(self, bits)
+
+
+def _as_buffer(contents):
+    # Decoders read from a buffer passed in, e.g. a ChunkedBitPackedBuffer, or from a new one
+    return contents if isinstance(contents, BitPackedBuffer) else BitPackedBuffer(contents)
+
+
 class BitPackedDecoder:
 
     def __init__(self, contents, typeinfos):
-        self._buffer = BitPackedBuffer(contents)
+        self._buffer = _as_buffer(contents)
 
+        self._typeinfos = typeinfos
         self._typeinfo_functions = []
         self._typeinfo_len = len(typeinfos)
+        self._skip_functions = None  # built on the first call to skip()
 
         # NOTE:  this class has been re-written to use closures.
         # All of the named functionality now return a function, which when executed actually does the dirty work.
@@ -162,6 +329,11 @@ class BitPackedDecoder:
         return self._typeinfo_functions[typeid]()
         #return self._typeinfos_lookup[typeid](*self._typeinfos_args[typeid])
 
+    def skip(self, typeid):
+        if self._skip_functions is None:
+            self._skip_functions = self._build_skip_functions()
+        self._skip_functions[typeid]()
+
     def byte_align(self):
         self._buffer.byte_align()
 
@@ -171,6 +343,12 @@ class BitPackedDecoder:
     def used_bits(self):
         return self._buffer.used_bits()
 
+    def tell_bits(self):
+        return self._buffer.tell_bits()
+
+    def seek_bits(self, bits):
+        self._buffer.seek_bits(bits)
+
     def _array(self, bounds, typeid):
         int_func = self._int(bounds)
 
@@ -194,12 +372,7 @@ class BitPackedDecoder:
 
         def _blob_closure():
             length = int_func()
-            result = self._buffer.read_aligned_bytes(length)
-            try:
-                result = result.decode('utf-8')
-            except UnicodeDecodeError:
-                pass
-            return result
+            return _decode_blob(self._buffer.read_aligned_view(length))
         return _blob_closure
 
     def _bool(self):
@@ -293,9 +466,87 @@ class BitPackedDecoder:
 
         return _struct_closure
 
+    def _build_skip_functions(self):
+        # Skip closures advance the buffer past a typeid without building any objects.
+        # Types with a fixed width collapse into a single skip_bits call.
+        widths = fixed_bit_widths(self._typeinfos)
+        skip_functions = []
+        for typeid, (funcName, args_array) in enumerate(self._typeinfos):
+            skip_functions.append(self._skip_closure(funcName, args_array, widths[typeid], widths, skip_functions))
+        return skip_functions
+
+    def _skip_closure(self, funcName, args_array, width, widths, skip_functions):
+        _buffer = self._buffer
+
+        if width is not None:
+            def _skip_fixed_closure():
+                _buffer.skip_bits(width)
+            return _skip_fixed_closure
+
+        if funcName == '_blob':
+            length_func = self._int(args_array[0])
+
+            def _skip_blob_closure():
+                _buffer.skip_aligned_bytes(length_func())
+            return _skip_blob_closure
+
+        elif funcName == '_bitarray':
+            length_func = self._int(args_array[0])
+
+            def _skip_bitarray_closure():
+                _buffer.skip_bits(length_func())
+            return _skip_bitarray_closure
+
+        elif funcName == '_optional':
+            skip_func = skip_functions[args_array[0]]
+
+            def _skip_optional_closure():
+                if _buffer.read_bits(1):
+                    skip_func()
+            return _skip_optional_closure
+
+        elif funcName == '_array':
+            length_func = self._int(args_array[0])
+            element_width = widths[args_array[1]]
+            if element_width is not None:
+                def _skip_fixed_array_closure():
+                    _buffer.skip_bits(length_func() * element_width)
+                return _skip_fixed_array_closure
+
+            skip_func = skip_functions[args_array[1]]
+
+            def _skip_array_closure():
+                for i in range(length_func()):
+                    skip_func()
+            return _skip_array_closure
+
+        elif funcName == '_choice':
+            tag_func = self._int(args_array[0])
+            fields_lookup = dict((tag, skip_functions[typeid]) for tag, (name, typeid) in args_array[1].items())
+
+            def _skip_choice_closure():
+                skip_func = fields_lookup.get(tag_func())
+                if skip_func is None:
+                    raise CorruptedError(self)
+                skip_func()
+            return _skip_choice_closure
+
+        elif funcName == '_struct':
+            # The parent is decoded first, see _struct
+            fields = sorted(args_array[0], key=lambda f: f[0] != '__parent')
+            skip_funcs = [skip_functions[typeid] for name, typeid, index in fields]
+
+            def _skip_struct_closure():
+                for skip_func in skip_funcs:
+                    skip_func()
+            return _skip_struct_closure
+
+        raise CorruptedError('unknown typeinfo %r' % (funcName,))
+
+
 class VersionedDecoder:
     def __init__(self, contents, typeinfos):
-        self._buffer = BitPackedBuffer(contents)
+        self._buffer = _as_buffer(contents)
         self._typeinfos = typeinfos
 
     def __str__(self):
@@ -316,6 +567,12 @@ class VersionedDecoder:
     def used_bits(self):
         return self._buffer.used_bits()
 
+    def tell_bits(self):
+        return self._buffer.tell_bits()
+
+    def seek_bits(self, bits):
+        self._buffer.seek_bits(bits)
+
     def _expect_skip(self, expected):
         if self._buffer.read_bits(8) != expected:
             raise CorruptedError(self)
@@ -339,17 +596,12 @@ class VersionedDecoder:
     def _bitarray(self, bounds):
         self._expect_skip(1)
         length = self._vint()
-        return (length, self._buffer.read_aligned_bytes((length + 7) / 8))
+        return (length, self._buffer.read_aligned_bytes((length + 7) // 8))
 
     def _blob(self, bounds):
         self._expect_skip(2)
         length = self._vint()
-        result = self._buffer.read_aligned_bytes(length)
-        try:
-            result = result.decode('utf-8')
-        except UnicodeDecodeError:
-            pass
-        return result
+        return _decode_blob(self._buffer.read_aligned_view(length))
 
     def _bool(self):
         self._expect_skip(6)
@@ -410,6 +662,9 @@ class VersionedDecoder:
                 self._skip_instance()
         return result
 
+    def skip(self, typeid):
+        self._skip_instance()
+
     def _skip_instance(self):
         skip = self._buffer.read_bits(8)
         if skip == 0:  # array
@@ -418,7 +673,7 @@ class VersionedDecoder:
                 self._skip_instance()
         elif skip == 1:  # bitblob
             length = self._vint()
-            self._buffer.read_aligned_bytes((length + 7) / 8)
+            self._buffer.read_aligned_bytes((length + 7) // 8)
         elif skip == 2:  # blob
             length = self._vint()
             self._buffer.read_aligned_bytes(length)
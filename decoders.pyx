@@ -18,8 +18,15 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+# cython: language_level=3
+#
+# Compiled backend for decoders.py.  When built in place (python setup.py build_ext --inplace)
+# the extension module shadows decoders.py, everything but BitPackedBuffer must be kept
+# identical to it.
+
 import struct
 
+
 class TruncatedError(Exception):
     pass
 
@@ -27,181 +34,577 @@ class TruncatedError(Exception):
 class CorruptedError(Exception):
     pass
 
+
+def _decode_blob(view):
+    # Blobs are text when they are valid utf-8, raw bytes otherwise
+    try:
+        return str(view, 'utf-8')
+    except UnicodeDecodeError:
+        return view.tobytes()
+
+
+def fixed_bit_widths(typeinfos):
+    """Returns the number of bits each typeid takes up in a bit-packed stream.
+
+    The width is None for types whose size depends on the data (optionals, variable length
+    arrays, blobs...).
+    """
+    widths = []
+    for name, args in typeinfos:
+        width = None
+        if name == '_int':
+            width = args[0][1]
+        elif name == '_bool':
+            width = 1
+        elif name == '_null':
+            width = 0
+        elif name in ('_fourcc', '_real32'):
+            width = 32
+        elif name == '_real64':
+            width = 64
+        elif name == '_bitarray':
+            if args[0][1] == 0:
+                width = args[0][0]
+        elif name == '_array':
+            element = widths[args[1]] if args[1] < len(widths) else None
+            if args[0][1] == 0 and element is not None:
+                width = args[0][0] * element
+        elif name == '_struct':
+            fields = [widths[f[1]] if f[1] < len(widths) else None for f in args[0]]
+            if None not in fields:
+                width = sum(fields)
+        elif name == '_choice':
+            options = set(widths[t] if t < len(widths) else None for n, t in args[1].values())
+            if len(options) == 1 and None not in options:
+                width = args[0][1] + options.pop()
+        widths.append(width)
+    return widths
+
+
 cdef class BitPackedBuffer:
-    cdef bytes _data
-    cdef int _datalen
-    cdef int _used
-    cdef unsigned char _next
-    cdef char _nextbits
-    cdef char _bigendian
-
-    def __init__(self, bytes contents, str endian='big'):
-        self._data = contents or []
+    # Same buffer as decoders.py, with the bit position kept in C variables and reads of up to
+    # 56 bits assembled in a 64 bit integer.
+    cdef object _data
+    cdef const unsigned char[:] _bytes
+    cdef Py_ssize_t _datalen
+    cdef Py_ssize_t _used
+    cdef unsigned int _next
+    cdef int _nextbits
+    cdef bint _bigendian
+
+    def __init__(self, contents, endian='big'):
+        self._data = memoryview(contents or b'').cast('B')
+        self._bytes = self._data
         self._datalen = len(self._data)
-        self._used = 0
-        self._next = 0
+        self._used = 0  # index of the next unread byte in _data
+        self._next = 0  # unread bits of the current byte, right-adjusted
         self._nextbits = 0
         self._bigendian = (endian == 'big')
 
     def __str__(self):
         return 'buffer(%02x/%d,[%d]=%s)' % (
             self._nextbits and self._next or 0, self._nextbits,
-            self._used, '%02x' % (self._data[self._used],) if (self._used < len(self._data)) else '--')
+            self._used, '%02x' % (self._bytes[self._used],) if (self._used < self._datalen) else '--')
 
-    cpdef int done(self):
-        # return self._nextbits == 0 and self._used >= len(self._data)
+    cpdef bint done(self):
         return self._nextbits == 0 and self._used >= self._datalen
 
-    cpdef int used_bits(self):
-        # return self._used * 8 - self._nextbits
+    cpdef Py_ssize_t tell_bits(self):
+        return (self._used << 3) - self._nextbits
+
+    # used_bits is the historical name for the bit position
+    cpdef Py_ssize_t used_bits(self):
         return (self._used << 3) - self._nextbits
 
-    cpdef int byte_align(self):
+    cpdef seek_bits(self, Py_ssize_t bits):
+        cdef Py_ssize_t used
+        cdef int offset
+        if bits < 0 or bits > (self._datalen << 3):
+            raise TruncatedError(self)
+
+        used = bits >> 3
+        offset = bits & 7
+        if offset:
+            # Partially consumed bytes are stored with the consumed low bits shifted out
+            self._next = self._bytes[used] >> offset
+            self._nextbits = 8 - offset
+            used += 1
+        else:
+            self._next = 0
+            self._nextbits = 0
+        self._used = used
+
+    cpdef byte_align(self):
+        self._next = 0
+        self._nextbits = 0
+
+    cpdef skip_bits(self, Py_ssize_t bits):
+        if bits <= self._nextbits:
+            self._next >>= bits
+            self._nextbits -= bits
+        else:
+            self.seek_bits((self._used << 3) - self._nextbits + bits)
+
+    cpdef skip_aligned_bytes(self, Py_ssize_t num_bytes):
+        self._next = 0
+        self._nextbits = 0
+        if self._used + num_bytes > self._datalen:
+            raise TruncatedError(self)
+        self._used += num_bytes
+
+    cpdef read_aligned_view(self, Py_ssize_t num_bytes):
+        # Returns a zero-copy memoryview over the next num_bytes bytes
+        cdef Py_ssize_t start = self._used
+        self._next = 0
         self._nextbits = 0
+        if start + num_bytes > self._datalen:
+            raise TruncatedError(self)
+        self._used = start + num_bytes
+        return self._data[start:self._used]
+
+    cpdef bytes read_aligned_bytes(self, Py_ssize_t num_bytes):
+        return self.read_aligned_view(num_bytes).tobytes()
+
+    cpdef read_bits(self, Py_ssize_t bits):
+        cdef int nextbits = self._nextbits
+        cdef unsigned long long result = self._next
+        cdef unsigned int byte
+        cdef Py_ssize_t need, used, end
+        cdef int shift
+
+        # Fast path: the request fits in the bits left over from the current byte
+        if bits <= nextbits:
+            self._next >>= bits
+            self._nextbits = nextbits - bits
+            return result & ((1ULL << bits) - 1)
+
+        if bits > 56:
+            return self._read_long_bits(bits)
+
+        # NOTE:  _next is always right-adjusted and smaller than 2^_nextbits, so it can be used as-is.
+        # Bits are consumed from the low end of each byte, so in big-endian mode only the low bits
+        # of the last byte touched belong to this read.
+        need = bits - nextbits  # bits that have to come from whole bytes
+        used = self._used
+        end = used + ((need + 7) >> 3)
+        if end > self._datalen:
+            raise TruncatedError(self)
+
+        if self._bigendian:
+            while need >= 8:
+                result = (result << 8) | self._bytes[used]
+                used += 1
+                need -= 8
+            if need:
+                byte = self._bytes[used]
+                used += 1
+                result = (result << need) | (byte & ((1U << need) - 1))
+                self._next = byte >> need
+                self._nextbits = 8 - need
+            else:
+                self._next = 0
+                self._nextbits = 0
+        else:
+            shift = nextbits
+            while need >= 8:
+                result |= (<unsigned long long>self._bytes[used]) << shift
+                used += 1
+                shift += 8
+                need -= 8
+            if need:
+                byte = self._bytes[used]
+                used += 1
+                result |= (<unsigned long long>(byte & ((1U << need) - 1))) << shift
+                self._next = byte >> need
+                self._nextbits = 8 - need
+            else:
+                self._next = 0
+                self._nextbits = 0
+
+        self._used = used
+        return result
 
-    cpdef bytes read_aligned_bytes(self, bytes):
-        self.byte_align()
-        data = self._data[self._used:self._used + bytes]
-        self._used += bytes
-        if len(data) != bytes:
+    cdef object _read_long_bits(self, Py_ssize_t bits):
+        # Reads wider than a C integer pull every byte they touch with a single int.from_bytes call
+        _next = self._next
+        _nextbits = self._nextbits
+        need = bits - _nextbits
+        _used = self._used
+        end = _used + ((need + 7) >> 3)
+        if end > self._datalen:
             raise TruncatedError(self)
-        return data
-
-    cpdef unsigned int read_bits(self, char bits):
-        cdef unsigned int result = 0
-        cdef char resultbits = bits
-        cdef char copybits
-        cdef unsigned char copy
-        while resultbits > 0:
-            if self._nextbits == 0:
-                if self.done():
-                    raise TruncatedError(self)
-                self._next = self._data[self._used]
-                self._used += 1
-                self._nextbits = 8
-            copybits = self._nextbits if resultbits > self._nextbits else resultbits
-            #copybits = min(resultbits, self._nextbits)
-            #copy = (self._next & ((1 << copybits) - 1))
-            copy = (self._next >> (8 - self._nextbits) & ((1 << copybits) - 1))
-            if self._bigendian:
-                result |= copy << (resultbits - copybits)
+        extra = ((end - _used) << 3) - need  # unread high bits left over in the last byte
+
+        if self._bigendian:
+            word = int.from_bytes(self._data[_used:end], 'big')
+            if extra:
+                lastbits = 8 - extra
+                result = ((_next << need) | ((word >> 8) << lastbits) |
+                          (word & ((1 << lastbits) - 1)))
+                self._next = (word & 0xff) >> lastbits
             else:
-                result |= copy << bits - resultbits
-            #self._next >>= copybits
-            self._nextbits -= copybits
-            resultbits -= copybits
+                result = (_next << need) | word
+                self._next = 0
+        else:
+            word = int.from_bytes(self._data[_used:end], 'little')
+            result = _next | ((word & ((1 << need) - 1)) << _nextbits)
+            self._next = word >> need
+
+        self._nextbits = extra
+        self._used = end
+
         return result
 
-    def read_unaligned_bytes(self, bytes):
-        return bytearray(self.read_bits(8) for i in range(0,bytes))
+    cpdef read_unaligned_bytes(self, Py_ssize_t num_bytes):
+        # read_bits is slow, so doing a trivial check to see if we are at a bytes boundary
+        if self._nextbits == 0:
+            return self.read_aligned_bytes(num_bytes)
+        else:
+            return bytes([self.read_bits(8) for i in range(0,num_bytes)])
+
+
+cdef class ChunkedBitPackedBuffer(BitPackedBuffer):
+    """A BitPackedBuffer over an iterable of chunks, e.g. the sectors of a compressed file.
+
+    Chunks are pulled as reads reach the end of the current one, and reads can span chunks.
+    Only the unread part of the stream is kept, so seek_bits can't go back before the
+    chunk being read.
+    """
+    cdef object _chunks
+    cdef Py_ssize_t _base  # stream offset of _data
+
+    def __init__(self, chunks, endian='big'):
+        BitPackedBuffer.__init__(self, b'', endian)
+        self._chunks = iter(chunks)
+        self._base = 0
+
+    cdef bint _fill(self, Py_ssize_t num_bytes) except -1:
+        # Extends the unread bytes to at least num_bytes, returns False when the chunks run out
+        cdef Py_ssize_t available = self._datalen - self._used
+        if available >= num_bytes or self._chunks is None:
+            return False
+        parts = [self._data[self._used:]]
+        for chunk in self._chunks:
+            parts.append(chunk)
+            available += len(chunk)
+            if available >= num_bytes:
+                break
+        else:
+            self._chunks = None
+        self._base += self._used
+        self._data = memoryview(b''.join(parts)).cast('B')
+        self._bytes = self._data
+        self._datalen = len(self._data)
+        self._used = 0
+        return True
+
+    cpdef bint done(self):
+        if self._used >= self._datalen:
+            self._fill(1)
+        return BitPackedBuffer.done(self)
+
+    cpdef Py_ssize_t tell_bits(self):
+        return ((self._base + self._used) << 3) - self._nextbits
+
+    cpdef Py_ssize_t used_bits(self):
+        return ((self._base + self._used) << 3) - self._nextbits
+
+    cpdef seek_bits(self, Py_ssize_t bits):
+        # Chunks entirely before bits are dropped without being joined to the unread bytes
+        while self._chunks is not None and bits >= ((self._base + self._datalen) << 3):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._chunks = None
+                break
+            self._base += self._datalen
+            self._data = memoryview(chunk).cast('B')
+            self._bytes = self._data
+            self._datalen = len(self._data)
+            self._used = 0
+        BitPackedBuffer.seek_bits(self, bits - (self._base << 3))
+
+    cpdef skip_bits(self, Py_ssize_t bits):
+        if bits <= self._nextbits:
+            BitPackedBuffer.skip_bits(self, bits)
+        else:
+            self.seek_bits(self.tell_bits() + bits)
+
+    cpdef skip_aligned_bytes(self, Py_ssize_t num_bytes):
+        self._fill(num_bytes)
+        BitPackedBuffer.skip_aligned_bytes(self, num_bytes)
+
+    cpdef read_aligned_view(self, Py_ssize_t num_bytes):
+        try:
+            return BitPackedBuffer.read_aligned_view(self, num_bytes)
+        except TruncatedError:
+            if not self._fill(num_bytes):
+                raise
+            return BitPackedBuffer.read_aligned_view(self, num_bytes)
+
+    cpdef read_bits(self, Py_ssize_t bits):
+        try:
+            return BitPackedBuffer.read_bits(self, bits)
+        except TruncatedError:
+            if not self._fill((bits - self._nextbits + 7) >> 3):
+                raise
+            return BitPackedBuffer.read_bits(self, bits)
+
 
-cdef class BitPackedDecoder:
-    cdef BitPackedBuffer _buffer
-    cdef _typeinfos
-    cdef int _typeinfos_len
-    cdef _typeinfos_lookup
+def _as_buffer(contents):
+    # Decoders read from a buffer passed in, e.g. a ChunkedBitPackedBuffer, or from a new one
+    return contents if isinstance(contents, BitPackedBuffer) else BitPackedBuffer(contents)
+
+
+class BitPackedDecoder:
+
+    def __init__(self, contents, typeinfos):
+        self._buffer = _as_buffer(contents)
 
-    def __init__(self, bytes contents, typeinfos):
-        self._buffer = BitPackedBuffer(contents)
         self._typeinfos = typeinfos
-        self._typeinfos_len = len(typeinfos)
-        self._typeinfos_lookup = []
-        for x in typeinfos:
-            self._typeinfos_lookup.append(getattr(self, x[0]))
+        self._typeinfo_functions = []
+        self._typeinfo_len = len(typeinfos)
+        self._skip_functions = None  # built on the first call to skip()
+
+        # NOTE:  this class has been re-written to use closures.
+        # All of the named functionality now return a function, which when executed actually does the dirty work.
+        # instance functions the same as before.  If you want to get a reference to a given function, use _lookup
+        # ASSUMPTION:  structs & related only use previously declared functions
+        for funcName, args_array in typeinfos:
+            funcObj = getattr(self, funcName)(*args_array)
+            self._typeinfo_functions.append(funcObj)
 
     def __str__(self):
         return self._buffer.__str__()
 
+    def _lookup(self, typeid):
+        return self._typeinfo_functions[typeid]
+
     def instance(self, typeid):
-        if typeid >= self._typeinfos_len:
-            raise CorruptedError(self)
+        #if typeid >= self._typeinfo_len:
+        #    raise CorruptedError(self)
         # typeinfo = self._typeinfos[typeid]
-        return self._typeinfos_lookup[typeid](*self._typeinfos[typeid][1])
+        return self._typeinfo_functions[typeid]()
+        #return self._typeinfos_lookup[typeid](*self._typeinfos_args[typeid])
 
-    cpdef int byte_align(self):
+    def skip(self, typeid):
+        if self._skip_functions is None:
+            self._skip_functions = self._build_skip_functions()
+        self._skip_functions[typeid]()
+
+    def byte_align(self):
         self._buffer.byte_align()
 
-    cpdef int done(self):
+    def done(self):
         return self._buffer.done()
 
-    cpdef int used_bits(self):
+    def used_bits(self):
         return self._buffer.used_bits()
 
+    def tell_bits(self):
+        return self._buffer.tell_bits()
+
+    def seek_bits(self, bits):
+        self._buffer.seek_bits(bits)
+
     def _array(self, bounds, typeid):
-        length = self._int(bounds)
-        return [self.instance(typeid) for i in range(0,length)]
+        int_func = self._int(bounds)
+
+        def _array_closure():
+            length = int_func()
+            type_lookup = self._lookup(typeid)
+            return [type_lookup() for i in range(0,length)]
+
+        return _array_closure
 
     def _bitarray(self, bounds):
-        length = self._int(bounds)
-        return (length, self._buffer.read_bits(length))
+        int_func = self._int(bounds)
+
+        def _bitarray_closure():
+            length = int_func()
+            return (length, self._buffer.read_bits(length))
+        return _bitarray_closure
 
     def _blob(self, bounds):
-        length = self._int(bounds)
-        result = self._buffer.read_aligned_bytes(length)
-        try:
-            result = result.decode('utf-8')
-        except UnicodeDecodeError:
-            pass
-        return result
+        int_func = self._int(bounds)
+
+        def _blob_closure():
+            length = int_func()
+            return _decode_blob(self._buffer.read_aligned_view(length))
+        return _blob_closure
 
     def _bool(self):
-        return self._int((0, 1)) != 0
+        def _bool_closure():
+            return self._buffer.read_bits(1) != 0
+        return _bool_closure
 
     def _choice(self, bounds, fields):
-        tag = self._int(bounds)
-        if tag not in fields:
-            raise CorruptedError(self)
-        field = fields[tag]
-        return {field[0]: self.instance(field[1])}
+        tag_func = self._int(bounds)
+        field_lookup = {}
+
+        for index in fields:
+            name, typeid = fields[index]
+            field_lookup[index] = (name, self._lookup(typeid))
+
+        def _choice_closure():
+            tag = tag_func()
+            if tag not in fields:
+                raise CorruptedError(self)
+            field_name, field_func = field_lookup[tag]
+            return {field_name: field_func()}
+
+        return _choice_closure
 
     def _fourcc(self):
-        #  bug fix for hero mastery levels.  Bytes were decoding backwards.
-        return struct.pack('>I', self._buffer.read_bits(32)).decode('utf-8')
+        def _fourcc_closure():
+            #  bug fix for hero mastery levels.  Bytes were decoding backwards.
+            return struct.pack('>I', self._buffer.read_bits(32)).decode('utf-8')
+        return _fourcc_closure
 
     def _int(self, bounds):
-        return bounds[0] + self._buffer.read_bits(bounds[1])
+        _buffer = self._buffer
+        if bounds[0] == 0:
+            def _int0_closure():
+                return _buffer.read_bits(bounds[1])
+            return _int0_closure
+        else:
+            def _int_closure():
+                return bounds[0] + _buffer.read_bits(bounds[1])
+            return _int_closure
 
     def _null(self):
-        return None
+        def _null_closure():
+            return None
+        return _null_closure
 
     def _optional(self, typeid):
-        exists = self._bool()
-        return self.instance(typeid) if exists else None
+        bool_func = self._bool()
+        exec_func = self._lookup(typeid)
+
+        def _optional_closure():
+            exists = bool_func()
+            return exec_func() if exists else None
+        return _optional_closure
 
     def _real32(self):
-        return struct.unpack('>f', self._buffer.read_unaligned_bytes(4))
+        def _real32_closure():
+            return struct.unpack('>f', self._buffer.read_unaligned_bytes(4))
+        return _real32_closure
 
     def _real64(self):
-        return struct.unpack('>d', self._buffer.read_unaligned_bytes(8))
+        def _real64_closure():
+            return struct.unpack('>d', self._buffer.read_unaligned_bytes(8))
+        return _real64_closure
 
     def _struct(self, fields):
-        result = {}
-        for field in fields:
-            if field[0] == '__parent':
-                parent = self.instance(field[1])
-                if isinstance(parent, dict):
-                    result.update(parent)
-                elif len(fields) == 1:
-                    result = parent
-                else:
-                    result[field[0]] = parent
+        # Adding assumption that parent is the first field in the _struct, if it's there.
+        parent_func = None
+
+        fields_lookup = []
+
+        for name, typeid, index in fields:
+            field_func = self._lookup(typeid)
+            if name == '__parent':
+                parent_func = field_func
             else:
-                result[field[0]] = self.instance(field[1])
-        return result
+                fields_lookup.append( (name, field_func))
+
+        def _struct_closure():
+            result = {}
+            if parent_func is not None:
+                parent_result = parent_func()
+                if isinstance(parent_result, dict):
+                    result = parent_result
+                else:
+                    result['__parent'] = parent_result
+
+            for name, exec_func in fields_lookup:
+                result[name] = exec_func()
+            return result
 
-cdef class VersionedDecoder:
-    cdef BitPackedBuffer _buffer
-    cdef _typeinfos
-    cdef int _typeinfos_len
-    cdef _typeinfos_lookup
+        return _struct_closure
 
+    def _build_skip_functions(self):
+        # Skip closures advance the buffer past a typeid without building any objects.
+        # Types with a fixed width collapse into a single skip_bits call.
+        widths = fixed_bit_widths(self._typeinfos)
+        skip_functions = []
+        for typeid, (funcName, args_array) in enumerate(self._typeinfos):
+            skip_functions.append(self._skip_closure(funcName, args_array, widths[typeid], widths, skip_functions))
+        return skip_functions
+
+    def _skip_closure(self, funcName, args_array, width, widths, skip_functions):
+        _buffer = self._buffer
+
+        if width is not None:
+            def _skip_fixed_closure():
+                _buffer.skip_bits(width)
+            return _skip_fixed_closure
+
+        if funcName == '_blob':
+            length_func = self._int(args_array[0])
+
+            def _skip_blob_closure():
+                _buffer.skip_aligned_bytes(length_func())
+            return _skip_blob_closure
+
+        elif funcName == '_bitarray':
+            length_func = self._int(args_array[0])
+
+            def _skip_bitarray_closure():
+                _buffer.skip_bits(length_func())
+            return _skip_bitarray_closure
+
+        elif funcName == '_optional':
+            skip_func = skip_functions[args_array[0]]
+
+            def _skip_optional_closure():
+                if _buffer.read_bits(1):
+                    skip_func()
+            return _skip_optional_closure
+
+        elif funcName == '_array':
+            length_func = self._int(args_array[0])
+            element_width = widths[args_array[1]]
+            if element_width is not None:
+                def _skip_fixed_array_closure():
+                    _buffer.skip_bits(length_func() * element_width)
+                return _skip_fixed_array_closure
+
+            skip_func = skip_functions[args_array[1]]
+
+            def _skip_array_closure():
+                for i in range(length_func()):
+                    skip_func()
+            return _skip_array_closure
+
+        elif funcName == '_choice':
+            tag_func = self._int(args_array[0])
+            fields_lookup = dict((tag, skip_functions[typeid]) for tag, (name, typeid) in args_array[1].items())
+
+            def _skip_choice_closure():
+                skip_func = fields_lookup.get(tag_func())
+                if skip_func is None:
+                    raise CorruptedError(self)
+                skip_func()
+            return _skip_choice_closure
+
+        elif funcName == '_struct':
+            # The parent is decoded first, see _struct
+            fields = sorted(args_array[0], key=lambda f: f[0] != '__parent')
+            skip_funcs = [skip_functions[typeid] for name, typeid, index in fields]
+
+            def _skip_struct_closure():
+                for skip_func in skip_funcs:
+                    skip_func()
+            return _skip_struct_closure
+
+        raise CorruptedError('unknown typeinfo %r' % (funcName,))
+
+
+class VersionedDecoder:
     def __init__(self, contents, typeinfos):
-        self._buffer = BitPackedBuffer(contents)
+        self._buffer = _as_buffer(contents)
         self._typeinfos = typeinfos
-        self._typeinfos_len = len(typeinfos)
-        self._typeinfos_lookup = []
-        for x in typeinfos:
-            self._typeinfos_lookup.append(getattr(self, x[0]))
 
     def __str__(self):
         return self._buffer.__str__()
@@ -209,9 +612,8 @@ cdef class VersionedDecoder:
     def instance(self, typeid):
         if typeid >= len(self._typeinfos):
             raise CorruptedError(self)
-        return self._typeinfos_lookup[typeid](*self._typeinfos[typeid][1])
-        #typeinfo = self._typeinfos[typeid]
-        #return getattr(self, typeinfo[0])(*typeinfo[1])
+        typeinfo = self._typeinfos[typeid]
+        return getattr(self, typeinfo[0])(*typeinfo[1])
 
     def byte_align(self):
         self._buffer.byte_align()
@@ -222,11 +624,17 @@ cdef class VersionedDecoder:
     def used_bits(self):
         return self._buffer.used_bits()
 
+    def tell_bits(self):
+        return self._buffer.tell_bits()
+
+    def seek_bits(self, bits):
+        self._buffer.seek_bits(bits)
+
     def _expect_skip(self, expected):
         if self._buffer.read_bits(8) != expected:
             raise CorruptedError(self)
 
-    cpdef unsigned int _vint(self):
+    def _vint(self):
         b = self._buffer.read_bits(8)
         negative = b & 1
         result = (b >> 1) & 0x3f
@@ -245,17 +653,12 @@ cdef class VersionedDecoder:
     def _bitarray(self, bounds):
         self._expect_skip(1)
         length = self._vint()
-        return (length, self._buffer.read_aligned_bytes((length + 7) / 8))
+        return (length, self._buffer.read_aligned_bytes((length + 7) // 8))
 
     def _blob(self, bounds):
         self._expect_skip(2)
         length = self._vint()
-        result = self._buffer.read_aligned_bytes(length)
-        try:
-            result = result.decode('utf-8')
-        except UnicodeDecodeError:
-            pass
-        return result
+        return _decode_blob(self._buffer.read_aligned_view(length))
 
     def _bool(self):
         self._expect_skip(6)
@@ -270,7 +673,7 @@ cdef class VersionedDecoder:
         field = fields[tag]
         return {field[0]: self.instance(field[1])}
 
-    cpdef bytes _fourcc(self):
+    def _fourcc(self):
         self._expect_skip(7)
         return self._buffer.read_aligned_bytes(4)
 
@@ -316,6 +719,9 @@ cdef class VersionedDecoder:
                 self._skip_instance()
         return result
 
+    def skip(self, typeid):
+        self._skip_instance()
+
     def _skip_instance(self):
         skip = self._buffer.read_bits(8)
         if skip == 0:  # array
@@ -324,7 +730,7 @@ cdef class VersionedDecoder:
                 self._skip_instance()
         elif skip == 1:  # bitblob
             length = self._vint()
-            self._buffer.read_aligned_bytes((length + 7) / 8)
+            self._buffer.read_aligned_bytes((length + 7) // 8)
         elif skip == 2:  # blob
             length = self._vint()
             self._buffer.read_aligned_bytes(length)
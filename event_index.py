@@ -0,0 +1,120 @@
+# Copyright (c) 2018 Blizzard Entertainment
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import bisect
+import json
+import os
+import tempfile
+
+
+# Number of events between two seek points.
+INDEX_INTERVAL = 256
+
+# Bumped whenever the sidecar file format changes, older sidecars are rebuilt.
+SIDECAR_VERSION = 1
+
+
+class EventIndex:
+    """Seek points of an event stream, recorded every interval events of a full decode.
+
+    Each seek point is the bit offset of an event and the gameloop reached before it, so
+    decoding can start there with the same gameloops as from the start of the stream.
+    """
+    def __init__(self, interval=INDEX_INTERVAL, gameloops=None, offsets=None):
+        self.interval = interval
+        self.gameloops = gameloops if gameloops is not None else []
+        self.offsets = offsets if offsets is not None else []
+
+    def __repr__(self):
+        return 'EventIndex(interval=%d, %d seek points)' % (self.interval, len(self.offsets))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def add(self, gameloop, bits):
+        self.gameloops.append(gameloop)
+        self.offsets.append(bits)
+
+    def seek_point(self, gameloop):
+        """Returns the (gameloop, bit offset) to start decoding from to reach the first
+        event at or after gameloop, (0, 0) for the start of the stream."""
+        # Gameloops never decrease, so no event before a seek point reached below gameloop
+        # can be at or after it.
+        i = bisect.bisect_left(self.gameloops, gameloop)
+        if i == 0:
+            return 0, 0
+        return self.gameloops[i - 1], self.offsets[i - 1]
+
+    def to_dict(self):
+        return {'interval': self.interval, 'gameloops': self.gameloops, 'offsets': self.offsets}
+
+    @classmethod
+    def from_dict(cls, value):
+        return cls(value['interval'], value['gameloops'], value['offsets'])
+
+
+def sidecar_path(path):
+    """Returns the name of the index file kept next to the replay file path."""
+    return path + '.index.json'
+
+
+def _replay_stamp(path):
+    # Identifies the replay file a sidecar was written for
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def load_indexes(path):
+    """Returns the EventIndex of each stream stored next to the replay file path.
+
+    Returns {} when there is no sidecar, or when it is outdated or unreadable.
+    """
+    try:
+        with open(sidecar_path(path), 'r') as f:
+            sidecar = json.load(f)
+        if sidecar.get('version') != SIDECAR_VERSION or sidecar.get('replay') != _replay_stamp(path):
+            return {}
+        return dict((name, EventIndex.from_dict(value)) for name, value in sidecar['streams'].items())
+    except (OSError, ValueError, KeyError, TypeError):
+        return {}
+
+
+def save_indexes(path, indexes):
+    """Stores the EventIndex of each stream next to the replay file path.
+
+    The sidecar is written to a temporary file of its own first and renamed, so readers never
+    see a partial file and concurrent writers don't clash.
+    """
+    sidecar = {
+        'version': SIDECAR_VERSION,
+        'replay': _replay_stamp(path),
+        'streams': dict((name, index.to_dict()) for name, index in indexes.items()),
+    }
+    filename = sidecar_path(path)
+    directory, basename = os.path.split(filename)
+    fd, tmp = tempfile.mkstemp(dir=directory or '.', prefix=basename + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(sidecar, f, separators=(',', ':'))
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
@@ -24,9 +24,13 @@ import sys
 import argparse
 import pprint
 import json
+import os
+import glob
+import tempfile
+import concurrent.futures
 
-from mpyq import mpyq
-import protocol_functions
+import replay
+import replay_cache
 
 class EventLogger:
     def __init__(self):
@@ -46,20 +50,207 @@ class EventLogger:
             pprint.pprint(event, stream=output)
 
     def log_stats(self, output):
-        for name, stat in sorted(self._event_stats.items(), key=lambda x: x[1][1]):
-            print(output, '"%s", %d, ' % (name, stat[0]))
+        for name, stat in sorted(self._event_stats.items(), key=lambda x: x[1][0]):
+            print('"%s", %d, ' % (name, stat[0]), file=output)
+
+
+# The streams written in batch mode, in the order they are decoded
+STREAMS = ('header', 'details', 'initdata', 'gameevents', 'messageevents', 'trackerevents', 'attributeevents')
+
+
+def find_replays(patterns):
+    """Returns the sorted .StormReplay files matching files, directories and/or glob patterns."""
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, files in os.walk(pattern):
+                paths.update(os.path.join(root, name) for name in files
+                             if name.lower().endswith('.stormreplay'))
+        elif os.path.isfile(pattern):
+            paths.add(pattern)
+        else:
+            paths.update(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    return sorted(paths)
+
+
+def output_names(paths):
+    """Returns the output name of each replay and the replays whose output name is taken.
+
+    The name is the replay's path relative to the directory holding all of them, without
+    the extension, so replays with the same file name in different directories get their
+    own outputs.  Returns ({path: name}, [(path, path of the replay with the same name)]).
+    """
+    if not paths:
+        return {}, []
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+    names = {}
+    taken = {}
+    duplicates = []
+    for path in paths:
+        name = os.path.splitext(os.path.relpath(os.path.abspath(path), root))[0]
+        key = os.path.normcase(name)
+        if key in taken:
+            duplicates.append((path, taken[key]))
+        else:
+            taken[key] = path
+            names[path] = name
+    return names, duplicates
+
+
+def read_base_build(path):
+    """Returns (path, base build) of a replay, the build is None if the header can't be read."""
+    try:
+        return path, replay.scan_replay_header(path)['m_version']['m_baseBuild']
+    except Exception:
+        return path, None
+
+
+def _json_default(value):
+    # Blobs that aren't valid utf-8 are decoded as bytes
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).decode('utf-8', 'backslashreplace')
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+def _dump_json(value):
+    return json.dumps(value, default=_json_default, separators=(',', ':'))
+
+
+# The Replay stream of each command line stream
+_REPLAY_STREAMS = {
+    'details': 'details',
+    'initdata': 'initdata',
+    'gameevents': 'game_events',
+    'messageevents': 'message_events',
+    'trackerevents': 'tracker_events',
+    'attributeevents': 'attributes',
+}
+
+
+def decode_streams(replay_file, streams):
+    """Yields (stream, item) for each decoded item of the wanted streams of a Replay.
+
+    Streams missing from the archive, e.g. the tracker events of old replays, are left out.
+    Event streams are decoded as they are written, unless the Replay has a cache to keep them in.
+    """
+    for stream in STREAMS:
+        if stream not in streams:
+            continue
+        if stream == 'header':
+            yield stream, replay_file.header
+            continue
+        name = _REPLAY_STREAMS[stream]
+        if name in replay.EVENT_STREAMS:
+            events = replay_file.iter_events(name) if replay_file.cache is None else replay_file.stream(name)
+            for event in events:
+                yield stream, event
+        else:
+            value = replay_file.stream(name)
+            if value is not None:
+                yield stream, value
+
+
+def write_ndjson(path, output_dir, streams, per_stream=False, cache=None, name=None):
+    """Decodes the wanted streams of a replay into NDJSON files in output_dir.
+
+    Each replay gets one name.ndjson file with a '_stream' key in every line, or with
+    per_stream a name.<stream>.ndjson file for each stream.  name defaults to the replay's
+    file name without the extension, see output_names.  Files are written to temporary
+    files of their own and renamed once complete.  cache is an optional ReplayCache.
+    """
+    if name is None:
+        name = os.path.splitext(os.path.basename(path))[0]
+    outputs = {}
+    try:
+        with replay.Replay(path, max_size=0, use_mmap=True, cache=cache) as replay_file:
+            for stream, item in decode_streams(replay_file, streams):
+                key = stream if per_stream else None
+                output = outputs.get(key)
+                if output is None:
+                    filename = '%s.%s.ndjson' % (name, stream) if per_stream else '%s.ndjson' % name
+                    filename = os.path.join(output_dir, filename)
+                    directory, basename = os.path.split(filename)
+                    os.makedirs(directory, exist_ok=True)
+                    fd, tmp = tempfile.mkstemp(dir=directory, prefix=basename + '.', suffix='.tmp')
+                    output = outputs[key] = (filename, tmp, os.fdopen(fd, 'w', encoding='utf-8'))
+                if not per_stream:
+                    item = dict(item, _stream=stream)
+                output[2].write(_dump_json(item))
+                output[2].write('\n')
+    except:
+        for filename, tmp, output in outputs.values():
+            output.close()
+            os.remove(tmp)
+        raise
+    for filename, tmp, output in outputs.values():
+        output.close()
+        os.replace(tmp, filename)
+
+
+def decode_batch(paths, output_dir, streams, per_stream=False, cache=None, names=None):
+    """Decodes replays, returns (path, error) for each replay that failed.
+
+    names optionally maps the paths to their output names.
+    """
+    errors = []
+    for path in paths:
+        try:
+            write_ndjson(path, output_dir, streams, per_stream, cache, names[path] if names else None)
+        except Exception as e:
+            errors.append((path, '%s: %s' % (type(e).__name__, e)))
+    return errors
+
+
+def decode_replays(paths, output_dir, streams, per_stream=False, workers=None, batch_size=16,
+                   output=sys.stderr, cache=None):
+    """Decodes replays into NDJSON files in output_dir with a pool of worker processes.
+
+    Replays are grouped by base build and handed out in batches, so every batch runs with
+    the decoder programs of one build and a worker process keeps them warm for its next
+    batch of that build.  The workers share the optional ReplayCache cache.  The outputs are
+    named by output_names, replays that would overwrite another's output are errors.
+    Returns the number of replays that could not be decoded.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    names, duplicates = output_names(paths)
+    for path, other in duplicates:
+        print('%s: same output name as %s' % (path, other), file=output)
+    failed = len(duplicates)
+    paths = [path for path in paths if path in names]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        builds = {}
+        for path, build in executor.map(read_base_build, paths, chunksize=64):
+            if build is None:
+                print('%s: unreadable replay header' % path, file=output)
+                failed += 1
+            else:
+                builds.setdefault(build, []).append(path)
+
+        futures = []
+        for build, build_paths in sorted(builds.items()):
+            for i in range(0, len(build_paths), batch_size):
+                batch = build_paths[i:i + batch_size]
+                futures.append(executor.submit(decode_batch, batch, output_dir, streams, per_stream, cache,
+                                               dict((path, names[path]) for path in batch)))
+
+        for future in concurrent.futures.as_completed(futures):
+            for path, error in future.result():
+                print('%s: %s' % (path, error), file=output)
+                failed += 1
+    return failed
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('replay_file', help='.StormReplay file to load')
+    parser.add_argument('replay_files', nargs='+', metavar='replay_file',
+                        help='.StormReplay file to load, in batch mode also directories or glob patterns')
     parser.add_argument("--gameevents", help="print game events",
                         action="store_true")
     parser.add_argument("--messageevents", help="print message events",
                         action="store_true")
     parser.add_argument("--trackerevents", help="print tracker events",
                         action="store_true")
-    parser.add_argument("--git add", help="print attributes events",
+    parser.add_argument("--attributeevents", help="print attributes events",
                         action="store_true")
     parser.add_argument("--header", help="print protocol header",
                         action="store_true")
@@ -71,64 +262,74 @@ if __name__ == '__main__':
                         action="store_true")
     parser.add_argument("--json", help="protocol information is printed in json format.",
                         action="store_true")
+    parser.add_argument("--output-dir", help="batch mode, decode every replay into NDJSON files in this directory.")
+    parser.add_argument("--per-stream", help="batch mode, write a NDJSON file per stream instead of per replay.",
+                        action="store_true")
+    parser.add_argument("--workers", help="batch mode, number of worker processes, defaults to the CPU count.",
+                        type=int)
+    parser.add_argument("--batch-size", help="batch mode, number of replays of the same build per task.",
+                        type=int, default=16)
+    parser.add_argument("--cache-dir", help="batch mode, keep the decoded streams in this directory and reuse them. "
+                        "Entries are pickles, the directory must only be writable by the current user.")
     args = parser.parse_args()
 
-    archive = mpyq.MPQArchive(args.replay_file)
+    if args.output_dir:
+        streams = set(stream for stream in STREAMS if getattr(args, stream))
+        streams.add('header')
+        paths = find_replays(args.replay_files)
+        cache = replay_cache.ReplayCache(args.cache_dir) if args.cache_dir else None
+        failed = decode_replays(paths, args.output_dir, streams, args.per_stream, args.workers, args.batch_size,
+                                cache=cache)
+        print('Decoded %d of %d replays' % (len(paths) - failed, len(paths)), file=sys.stderr)
+        sys.exit(1 if failed else 0)
+
+    if len(args.replay_files) != 1:
+        parser.error('decoding several replays requires --output-dir')
+    replay_file = replay.Replay(args.replay_files[0])
 
     logger = EventLogger()
     logger.args = args
 
     # Read the protocol header, this can be read with any protocol
-    contents = archive.header['user_data_header']['content']
-    header = protocol_functions.decode_replay_header(contents)
+    header = replay_file.header
     if args.header:
         logger.log(sys.stdout, header)
 
     # The header's baseBuild determines which protocol to use
-    baseBuild = header['m_version']['m_baseBuild']
-
     try:
-        protocol_functions.load_protocol(baseBuild)
-    except:
-        print(sys.stderr, 'Unsupported base build: %d' % baseBuild)
+        replay_file.decoder
+    except ImportError:
+        print('Unsupported base build: %d' % replay_file.build, file=sys.stderr)
         sys.exit(1)
 
     # Print protocol details
-    if args.details:
-        contents = archive.read_file('replay.details')
-        details = protocol_functions.decode_replay_details(contents)
-        logger.log(sys.stdout, details)
+    if args.details and replay_file.details is not None:
+        logger.log(sys.stdout, replay_file.details)
 
     # Print protocol init data
-    if args.initdata:
-        contents = archive.read_file('replay.initData')
-        initdata = protocol_functions.decode_replay_initdata(contents)
+    if args.initdata and replay_file.initdata is not None:
+        initdata = replay_file.initdata
         logger.log(sys.stdout, initdata['m_syncLobbyState']['m_gameDescription']['m_cacheHandles'])
         logger.log(sys.stdout, initdata)
 
     # Print game events and/or game events stats
     if args.gameevents:
-        contents = archive.read_file('replay.game.events')
-        for event in protocol_functions.decode_replay_game_events(contents):
+        for event in replay_file.iter_game_events():
             logger.log(sys.stdout, event)
 
     # Print message events
     if args.messageevents:
-        contents = archive.read_file('replay.message.events')
-        for event in protocol_functions.decode_replay_message_events(contents):
+        for event in replay_file.iter_message_events():
             logger.log(sys.stdout, event)
 
     # Print tracker events
     if args.trackerevents:
-        contents = archive.read_file('replay.tracker.events')
-        for event in protocol_functions.decode_replay_tracker_events(contents):
+        for event in replay_file.iter_tracker_events():
             logger.log(sys.stdout, event)
 
     # Print attributes events
-    if args.attributeevents:
-        contents = archive.read_file('replay.attributes.events')
-        attributes = protocol_functions.decode_replay_attributes_events(contents)
-        logger.log(sys.stdout, attributes)
+    if args.attributeevents and replay_file.attributes is not None:
+        logger.log(sys.stdout, replay_file.attributes)
 
     # Print stats
     if args.stats:
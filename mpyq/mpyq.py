@@ -6,10 +6,16 @@ mpyq is a Python library for reading MPQ (MoPaQ) archives.
 """
 
 import bz2
+import concurrent.futures
 import io
+import mmap
 import os
+import queue
 import struct
+import sys
+import threading
 import zlib
+from array import array
 from collections import namedtuple
 
 
@@ -26,6 +32,15 @@ MPQ_FILE_DELETE_MARKER  = 0x02000000
 MPQ_FILE_SECTOR_CRC     = 0x04000000
 MPQ_FILE_EXISTS         = 0x80000000
 
+# Array typecode of unsigned 32-bit words.
+UINT32 = 'I' if array('I').itemsize == 4 else 'L'
+
+# Files of fewer sectors are always decompressed in the calling thread.
+PARALLEL_MIN_SECTORS = 8
+
+# The amount of output each task of a parallel decompression produces.
+PARALLEL_TASK_SIZE = 64 * 1024
+
 MPQFileHeader = namedtuple('MPQFileHeader',
     '''
     magic
@@ -82,54 +97,215 @@ MPQBlockTableEntry = namedtuple('MPQBlockTableEntry',
 MPQBlockTableEntry.struct_format = '4I'
 
 
+def _decompress(data):
+    """Read the compression type and decompress file data."""
+    compression_type = data[0]
+    if compression_type == 0:
+        return data
+    elif compression_type == 2:
+        return zlib.decompress(data[1:], 15)
+    elif compression_type == 16:
+        return bz2.decompress(data[1:])
+    else:
+        raise RuntimeError("Unsupported compression type.")
+
+
+_sector_pool = None
+_sector_pool_pid = None
+_sector_pool_lock = threading.Lock()
+
+
+def sector_pool():
+    """Return the thread pool shared by parallel sector decompression.
+
+    zlib and bz2 release the GIL while decompressing, so the sectors of
+    a file are decompressed in parallel. A forked process gets a pool
+    of its own, the threads of the parent's pool don't survive the fork.
+    """
+    global _sector_pool, _sector_pool_pid
+    with _sector_pool_lock:
+        if _sector_pool is None or _sector_pool_pid != os.getpid():
+            _sector_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                thread_name_prefix='mpyq-sectors')
+            _sector_pool_pid = os.getpid()
+        return _sector_pool
+
+
+_END = object()
+
+
+def iter_prefetched(iterable, depth):
+    """Iterate over iterable with a thread running up to depth items ahead.
+
+    The thread waits while depth items are queued, and stops when the
+    iteration is closed early, e.g. by a break in the consumer's loop.
+    Exceptions raised by iterable are raised in the consumer.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                items.put((item, None))
+            items.put((_END, None))
+        except BaseException as e:
+            items.put((_END, e))
+
+    thread = threading.Thread(target=produce, name='mpyq-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is _END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        # Unblock a producer waiting for room, it stops before its next put.
+        while thread.is_alive():
+            try:
+                items.get(timeout=0.01)
+            except queue.Empty:
+                pass
+        thread.join()
+
+
 class MPQArchive(object):
 
-    def __init__(self, filename, listfile=True):
+    def __init__(self, filename, listfile=True, use_mmap=False, lazy=False,
+                 parallel=False):
         """Create a MPQArchive object.
 
         You can skip reading the listfile if you pass listfile=False
         to the constructor. The 'files' attribute will be unavailable
         if you do this.
+
+        With lazy=True only the header is read up front; the hash and
+        block tables are read on first use, and the listfile when the
+        'files' attribute is first accessed. read_file works without
+        the listfile.
+
+        With use_mmap=True the archive is memory mapped when the file
+        supports it, and read_file returns memoryview slices of the map
+        for stored blocks instead of copies. Close the archive when done
+        with it; the map stays alive as long as these slices do.
+
+        With parallel=True read_file decompresses the sectors of large
+        files on a shared thread pool, see sector_pool.
         """
         if hasattr(filename, 'read'):
             self.file = filename
+            self._owns_file = False
         else:
             self.file = open(filename, 'rb')
+            self._owns_file = True
+        self._map = None
+        self._view = None
+        if use_mmap:
+            try:
+                self._map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (AttributeError, io.UnsupportedOperation, ValueError, OSError):
+                pass  # not a regular, non-empty file, fall back to reads
+            else:
+                self._view = memoryview(self._map)
+        self.parallel = parallel
+        self._read_lock = threading.Lock()
         self.header = self.read_header()
-        self.hash_table = self.read_table('hash')
-        self.block_table = self.read_table('block')
-        if listfile:
-            self.files = self.read_file('(listfile)').splitlines()
-        else:
-            self.files = None
+        self._hash_table = None
+        self._hash_index = None
+        self._block_table = None
+        self._files = None
+        self._files_loaded = not listfile
+        if not lazy:
+            self._load_hash_table()
+            self._block_table = self.read_table('block')
+            self._load_files()
+
+    def _load_hash_table(self):
+        self._hash_table = self.read_table('hash')
+        self._hash_index = self._index_hash_table(self._hash_table)
+
+    def _load_files(self):
+        if not self._files_loaded:
+            listfile = self.read_file('(listfile)')
+            self._files = bytes(listfile).splitlines() if listfile is not None else None
+            self._files_loaded = True
+
+    @property
+    def hash_table(self):
+        if self._hash_table is None:
+            self._load_hash_table()
+        return self._hash_table
+
+    @property
+    def block_table(self):
+        if self._block_table is None:
+            self._block_table = self.read_table('block')
+        return self._block_table
+
+    @property
+    def files(self):
+        self._load_files()
+        return self._files
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Release the memory map and close the file if the archive opened it."""
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+            try:
+                self._map.close()
+            except BufferError:
+                pass  # slices handed out by read_file are still in use
+            self._map = None
+        if self._owns_file:
+            self.file.close()
+
+    def _read(self, offset, size):
+        """Read size bytes at offset, as a memoryview slice when mapped."""
+        if self._view is not None:
+            return self._view[offset:offset + size]
+        # iter_file with prefetch reads from another thread.
+        with self._read_lock:
+            self.file.seek(offset)
+            return self.file.read(size)
 
     def read_header(self):
         """Read the header of a MPQ archive."""
 
-        def read_mpq_header(offset=None):
-            if offset:
-                self.file.seek(offset)
-            data = self.file.read(32)
+        def read_mpq_header(offset=0):
+            data = self._read(offset, 32)
             header = MPQFileHeader._make(
                 struct.unpack(MPQFileHeader.struct_format, data))
             header = header._asdict()
             if header['format_version'] == 1:
-                data = self.file.read(12)
+                data = self._read(offset + 32, 12)
                 extended_header = MPQFileHeaderExt._make(
                     struct.unpack(MPQFileHeaderExt.struct_format, data))
                 header.update(extended_header._asdict())
             return header
 
         def read_mpq_user_data_header():
-            data = self.file.read(16)
+            data = self._read(0, 16)
             header = MPQUserDataHeader._make(
                 struct.unpack(MPQUserDataHeader.struct_format, data))
             header = header._asdict()
-            header['content'] = self.file.read(header['user_data_header_size'])
+            header['content'] = bytes(self._read(16, header['user_data_header_size']))
             return header
 
-        magic = self.file.read(4)
-        self.file.seek(0)
+        magic = bytes(self._read(0, 4))
 
         if magic == b'MPQ\x1a':
             header = read_mpq_header()
@@ -154,10 +330,9 @@ class MPQArchive(object):
 
         table_offset = self.header['%s_table_offset' % table_type]
         table_entries = self.header['%s_table_entries' % table_type]
-        key = self._hash('(%s table)' % table_type, 'TABLE')
+        key = self._table_keys[table_type]
 
-        self.file.seek(table_offset + self.header['offset'])
-        data = self.file.read(table_entries * 16)
+        data = self._read(table_offset + self.header['offset'], table_entries * 16)
         data = self._decrypt(data, key)
 
         def unpack_entry(position):
@@ -167,74 +342,167 @@ class MPQArchive(object):
 
         return [unpack_entry(i) for i in range(table_entries)]
 
+    def _index_hash_table(self, hash_table):
+        """Index the hash table entries by their (hash_a, hash_b) pair."""
+        index = {}
+        for entry in hash_table:
+            index.setdefault((entry.hash_a, entry.hash_b), entry)
+        return index
+
     def get_hash_table_entry(self, filename):
         """Get the hash table entry corresponding to a given filename."""
-        hash_a = self._hash(filename, 'HASH_A')
-        hash_b = self._hash(filename, 'HASH_B')
-        for entry in self.hash_table:
-            if (entry.hash_a == hash_a and entry.hash_b == hash_b):
-                return entry
-
-    def read_file(self, filename, force_decompress=False):
-        """Read a file from the MPQ archive."""
-
-        def decompress(data):
-            """Read the compression type and decompress file data."""
-            compression_type = data[0]
-            if compression_type == 0:
-                return data
-            elif compression_type == 2:
-                return zlib.decompress(data[1:], 15)
-            elif compression_type == 16:
-                return bz2.decompress(data[1:])
-            else:
-                raise RuntimeError("Unsupported compression type.")
-
+        if self._hash_index is None:
+            self._load_hash_table()
+        return self._hash_index.get(self._hash_filename(filename))
+
+    # The same few filenames are looked up in every archive.
+    _filename_hashes = {}
+
+    def _hash_filename(self, filename):
+        """Hash a filename into its (hash_a, hash_b) pair, memoized."""
+        hashes = self._filename_hashes.get(filename)
+        if hashes is None:
+            hashes = (self._hash(filename, 'HASH_A'), self._hash(filename, 'HASH_B'))
+            if len(self._filename_hashes) < 1024:
+                self._filename_hashes[filename] = hashes
+        return hashes
+
+    def _file_block(self, filename):
+        """Get the block table entry of a file, None if it has no data."""
         hash_entry = self.get_hash_table_entry(filename)
         if hash_entry is None:
             return None
         block_entry = self.block_table[hash_entry.block_table_index]
+        if not block_entry.flags & MPQ_FILE_EXISTS or block_entry.archived_size == 0:
+            return None
+        if block_entry.flags & MPQ_FILE_ENCRYPTED:
+            raise NotImplementedError("Encryption is not supported yet.")
+        return block_entry
+
+    def _sector_layout(self, block_entry):
+        """Get the sector size, the number of entries of the sector offset
+        table and the number of data sectors of a multi-sector file."""
+        sector_size = 512 << self.header['sector_size_shift']
+        sectors = int(block_entry.size / sector_size + 1)
+        if block_entry.flags & MPQ_FILE_SECTOR_CRC:
+            # The last entry is the offset of the sector checksums.
+            return sector_size, sectors + 2, sectors
+        return sector_size, sectors + 1, sectors
+
+    def _is_compressed(self, block_entry, force_decompress):
+        # Compression only happens when at least one byte is gained.
+        return bool(block_entry.flags & MPQ_FILE_COMPRESS and
+            (force_decompress or block_entry.size > block_entry.archived_size))
+
+    def read_file(self, filename, force_decompress=False, parallel=None):
+        """Read a file from the MPQ archive.
+
+        Returns bytes, or with use_mmap a bytes-like object: a
+        memoryview of the map for a stored single unit block, otherwise
+        the bytearray the file was assembled in. parallel overrides the
+        archive's parallel option for this file.
+        """
+        block_entry = self._file_block(filename)
+        if block_entry is None:
+            return None
 
         # Read the block.
-        if block_entry.flags & MPQ_FILE_EXISTS:
-            if block_entry.archived_size == 0:
-                return None
-
-            offset = block_entry.offset + self.header['offset']
-            self.file.seek(offset)
-            file_data = self.file.read(block_entry.archived_size)
-
-            if block_entry.flags & MPQ_FILE_ENCRYPTED:
-                raise NotImplementedError("Encryption is not supported yet.")
+        offset = block_entry.offset + self.header['offset']
+        block = self._read(offset, block_entry.archived_size)
+        compressed = self._is_compressed(block_entry, force_decompress)
 
+        try:
             if not block_entry.flags & MPQ_FILE_SINGLE_UNIT:
                 # File consist of many sectors. They all need to be
                 # decompressed separately and united.
-                sector_size = 512 << self.header['sector_size_shift']
-                sectors = int(block_entry.size / sector_size + 1)
-                if block_entry.flags & MPQ_FILE_SECTOR_CRC:
-                    crc = True
-                    sectors += 1
-                else:
-                    crc = False
-                positions = struct.unpack('<%dI' % (sectors + 1),
-                                          file_data[:4*(sectors+1)])
-                result = io.BytesIO()
-                for i in range(len(positions) - (2 if crc else 1)):
-                    sector = file_data[positions[i]:positions[i+1]]
-                    if (block_entry.flags & MPQ_FILE_COMPRESS and
-                        (force_decompress or block_entry.size > block_entry.archived_size)):
-                        sector = decompress(sector)
-                    result.write(sector)
-                file_data = result.getvalue()
-            else:
-                # Single unit files only need to be decompressed, but
-                # compression only happens when at least one byte is gained.
-                if (block_entry.flags & MPQ_FILE_COMPRESS and
-                    (force_decompress or block_entry.size > block_entry.archived_size)):
-                    file_data = decompress(file_data)
-
-            return file_data
+                sector_size, entries, count = self._sector_layout(block_entry)
+                positions = struct.unpack('<%dI' % entries, block[:4*entries])
+                if parallel is None:
+                    parallel = self.parallel
+                # Sectors are written straight into the output buffer.
+                with memoryview(block) as file_data:
+                    if parallel and compressed and count >= PARALLEL_MIN_SECTORS:
+                        result = self._decompress_parallel(
+                            file_data, positions, count, sector_size, block_entry.size)
+                    else:
+                        result = bytearray(block_entry.size)
+                        position = 0
+                        for i in range(count):
+                            with file_data[positions[i]:positions[i+1]] as sector:
+                                if compressed:
+                                    sector = _decompress(sector)
+                                result[position:position + len(sector)] = sector
+                                position += len(sector)
+                        del result[position:]
+                return result if self._view is not None else bytes(result)
+            elif compressed:
+                # Single unit files only need to be decompressed.
+                return _decompress(block)
+            return block
+        except BaseException:
+            # Views of the map kept alive by the traceback would keep
+            # close() from unmapping it.
+            if isinstance(block, memoryview):
+                block.release()
+            raise
+
+    def iter_file(self, filename, force_decompress=False, prefetch=0):
+        """Iterate over the contents of a file, one sector at a time.
+
+        Returns None if the file doesn't exist, like read_file. Sectors
+        are read and decompressed as the iteration reaches them, so only
+        one sector is held at a time. With prefetch, a thread reads and
+        decompresses up to that many sectors ahead of the consumer.
+        """
+        block_entry = self._file_block(filename)
+        if block_entry is None:
+            return None
+        sectors = self._iter_sectors(block_entry, force_decompress)
+        if prefetch:
+            return iter_prefetched(sectors, prefetch)
+        return sectors
+
+    def _iter_sectors(self, block_entry, force_decompress):
+        offset = block_entry.offset + self.header['offset']
+        compressed = self._is_compressed(block_entry, force_decompress)
+        if block_entry.flags & MPQ_FILE_SINGLE_UNIT:
+            file_data = self._read(offset, block_entry.archived_size)
+            yield _decompress(file_data) if compressed else file_data
+            return
+
+        sector_size, entries, count = self._sector_layout(block_entry)
+        positions = struct.unpack('<%dI' % entries, self._read(offset, 4*entries))
+        for i in range(count):
+            sector = self._read(offset + positions[i], positions[i+1] - positions[i])
+            yield _decompress(sector) if compressed else sector
+
+    def _decompress_parallel(self, file_data, positions, count, sector_size, size):
+        """Decompress sectors on the sector pool into their offsets of the output."""
+        result = bytearray(size)
+        output = memoryview(result)
+
+        def decompress_sectors(first, last):
+            for i in range(first, last):
+                with file_data[positions[i]:positions[i+1]] as data:
+                    sector = _decompress(data)
+                    start = i * sector_size
+                    if len(sector) != min(sector_size, size - start):
+                        raise RuntimeError("Decompressed sector size mismatch.")
+                    output[start:start + len(sector)] = sector
+
+        step = max(1, PARALLEL_TASK_SIZE // sector_size)
+        pool = sector_pool()
+        futures = [pool.submit(decompress_sectors, first, min(first + step, count))
+                   for first in range(0, count, step)]
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+            concurrent.futures.wait(futures)
+            output.release()
+        return result
 
     def extract(self):
         """Extract all the files inside the MPQ archive in memory."""
@@ -316,14 +584,13 @@ class MPQArchive(object):
         seed1 = 0x7FED7FED
         seed2 = 0xEEEEEEEE
 
-        is_bytes = isinstance(string, bytes)
+        if isinstance(string, bytes):
+            string = string.decode('latin-1')
+        encryption_table = self.encryption_table
+        offset = hash_types[hash_type] << 8
 
-        for ch in string:
-            if is_bytes:
-                ch = ord(chr(ch).upper())
-            else:
-                ch = ord(ch.upper())
-            value = self.encryption_table[(hash_types[hash_type] << 8) + ch]
+        for ch in map(ord, string.upper()):
+            value = encryption_table[offset + ch]
             seed1 = (value ^ (seed1 + seed2)) & 0xFFFFFFFF
             seed2 = ch + seed1 + seed2 + (seed2 << 5) + 3 & 0xFFFFFFFF
 
@@ -333,26 +600,30 @@ class MPQArchive(object):
         """Decrypt hash or block table or a sector."""
         seed1 = key
         seed2 = 0xEEEEEEEE
-        result = io.BytesIO()
+        encryption_table = self.encryption_table
+
+        # Every word depends on the previous one, only the (un)packing is done in one go.
+        words = array(UINT32)
+        words.frombytes(data[:len(data) // 4 * 4])
+        if sys.byteorder == 'big':
+            words.byteswap()
 
-        for i in range(len(data) // 4):
-            seed2 += self.encryption_table[0x400 + (seed1 & 0xFF)]
-            seed2 &= 0xFFFFFFFF
-            value = struct.unpack("<I", data[i*4:i*4+4])[0]
-            value = (value ^ (seed1 + seed2)) & 0xFFFFFFFF
+        for i, value in enumerate(words):
+            seed2 = seed2 + encryption_table[0x400 + (seed1 & 0xFF)] & 0xFFFFFFFF
+            value ^= seed1 + seed2 & 0xFFFFFFFF
+            words[i] = value
 
-            seed1 = ((~seed1 << 0x15) + 0x11111111) | (seed1 >> 0x0B)
-            seed1 &= 0xFFFFFFFF
+            seed1 = ((~seed1 << 0x15) + 0x11111111 | seed1 >> 0x0B) & 0xFFFFFFFF
             seed2 = value + seed2 + (seed2 << 5) + 3 & 0xFFFFFFFF
 
-            result.write(struct.pack("<I", value))
-        retval = result.getvalue()
-        return result.getvalue()
+        if sys.byteorder == 'big':
+            words.byteswap()
+        return words.tobytes()
 
     def _prepare_encryption_table(self=None):
         """Prepare encryption table for MPQ hash function."""
         seed = 0x00100001
-        crypt_table = {}
+        crypt_table = array(UINT32, bytes(4 * 0x500))
 
         for i in range(256):
             index = i
@@ -372,6 +643,20 @@ class MPQArchive(object):
     encryption_table = _prepare_encryption_table()
 
 
+def _precompute_hashes():
+    """Hash the table keys and the filenames read from every replay."""
+    archive = MPQArchive.__new__(MPQArchive)
+    MPQArchive._table_keys = dict(
+        (table_type, archive._hash('(%s table)' % table_type, 'TABLE'))
+        for table_type in ('hash', 'block'))
+    for filename in ('(listfile)', 'replay.details', 'replay.initData',
+                     'replay.game.events', 'replay.message.events',
+                     'replay.tracker.events', 'replay.attributes.events'):
+        archive._hash_filename(filename)
+
+_precompute_hashes()
+
+
 def main():
     import argparse
     description = "mpyq reads and extracts MPQ archives."
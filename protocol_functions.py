@@ -1,13 +1,23 @@
 #
 
 from decoders import *
+from decoder_compiler import *
+from tracker_columns import COLUMN_EVENTS, POSITIONS_EVENT, tracker_columns, unit_positions
+import protocol_store
 
-protocol = __import__('protocol29406')
+protocol = protocol_store.load_protocol(29406)
 
 
 def load_protocol( build ):
+    """Selects the protocol of build for the module-level decode functions.
+
+    protocol can also be set to a protocol module directly, as with earlier versions.
+
+    This changes the protocol for every caller, use a ReplayDecoder of the build to decode
+    replays of different builds at the same time.
+    """
     global protocol
-    protocol = __import__('protocol%s' % build)
+    protocol = protocol_store.load_protocol(build)
 
 
 def _varuint32_value(value):
@@ -17,19 +27,87 @@ def _varuint32_value(value):
     return 0
 
 
-def _decode_event_stream(decoder, eventid_typeid, event_types, decode_user_id):
+def _eventid(event, event_types):
+    # Returns the eventid of an event name or eventid, None if this protocol doesn't know it.
+    if isinstance(event, int):
+        return event if event in event_types else None
+    for eventid, (typeid, typename) in event_types.items():
+        if typename == event:
+            return eventid
+    return None
+
+
+def _event_filter_ids(event_filter, event_types):
+    # Returns the set of eventids selected by event_filter, a collection of event names and/or eventids.
+    if event_filter is None:
+        return None
+    return set(_eventid(event, event_types) for event in event_filter) - set([None])
+
+
+def _event_projection(projection, event_types):
+    # Returns the projection of event names and/or eventids as the fields to decode for each struct
+    # typeid, and the fields to keep for each eventid whose decoded struct still needs trimming.
+    # Events can share a struct typeid, e.g. SUnitBornEvent and SUnitInitEvent, so the typeid is only
+    # projected to the union of the fields wanted by all of its events.
+    if not projection:
+        return None, None
+    fields = {}
+    for event, event_fields in projection.items():
+        eventid = _eventid(event, event_types)
+        if eventid is not None:
+            fields[eventid] = frozenset(event_fields)
+
+    typeids = {}
+    for eventid, (typeid, typename) in event_types.items():
+        typeids.setdefault(typeid, []).append(fields.get(eventid))
+
+    typeid_projection = {}
+    for typeid, event_fields in typeids.items():
+        if None not in event_fields:
+            typeid_projection[typeid] = frozenset().union(*event_fields)
+
+    trim = {}
+    for eventid, event_fields in fields.items():
+        if typeid_projection.get(event_types[eventid][0]) != event_fields:
+            trim[eventid] = event_fields
+    return typeid_projection, trim
+
+
+def _decode_event_stream(decoder, protocol, eventid_typeid, event_types, decode_user_id, event_filter=None, trim=None,
+                         start_gameloop=None, end_gameloop=None, index=None, build_index=None):
     # Decodes events prefixed with a gameloop and possibly userid
+    # Events not selected by event_filter are skipped without being decoded, and the events in trim
+    # only keep the given fields.
+    # Only the events with start_gameloop <= gameloop < end_gameloop are decoded, index is the
+    # EventIndex used to seek close to start_gameloop.  build_index is an EventIndex to record the
+    # seek points of the stream in.
+    wanted = _event_filter_ids(event_filter, event_types)
+    svaruint32_typeid = protocol.svaruint32_typeid
+    replay_userid_typeid = protocol.replay_userid_typeid
     gameloop = 0
+    if start_gameloop is None:
+        start_gameloop = 0
+    elif index is not None:
+        gameloop, bits = index.seek_point(start_gameloop)
+        decoder.seek_bits(bits)
+    count = 0
     while not decoder.done():
         start_bits = decoder.used_bits()
 
+        if build_index is not None:
+            if count % build_index.interval == 0:
+                build_index.add(gameloop, start_bits)
+            count += 1
+
         # decode the gameloop delta before each event
-        delta = _varuint32_value(decoder.instance(protocol.svaruint32_typeid))
+        delta = _varuint32_value(decoder.instance(svaruint32_typeid))
         gameloop += delta
+        if end_gameloop is not None and gameloop >= end_gameloop:
+            return
 
         # decode the userid before each event
         if decode_user_id:
-            userid = decoder.instance(protocol.replay_userid_typeid)
+            userid = decoder.instance(replay_userid_typeid)
 
         # decode the event id
         eventid = decoder.instance(eventid_typeid)
@@ -37,8 +115,16 @@ def _decode_event_stream(decoder, eventid_typeid, event_types, decode_user_id):
         if typeid is None:
             raise CorruptedError('eventid(%d) at %s' % (eventid, decoder))
 
+        if (wanted is not None and eventid not in wanted) or gameloop < start_gameloop:
+            decoder.skip(typeid)
+            decoder.byte_align()
+            continue
+
         # decode the event struct instance
         event = decoder.instance(typeid)
+        if trim and eventid in trim:
+            fields = trim[eventid]
+            event = dict((k, v) for k, v in event.items() if k in fields)
         event['_event'] = typename
         event['_eventid'] = eventid
 
@@ -53,52 +139,196 @@ def _decode_event_stream(decoder, eventid_typeid, event_types, decode_user_id):
         yield event
 
 
-def decode_replay_game_events(contents):
-    """Decodes and yields each game event from the contents byte string."""
-    decoder = BitPackedDecoder(contents, protocol.typeinfos)
-    for event in _decode_event_stream(decoder,
-                                      protocol.game_eventid_typeid,
-                                      protocol.game_event_types,
-                                      decode_user_id=True):
-        yield event
-
-
-def decode_replay_message_events(contents):
+class ReplayDecoder:
+    """Decodes the replay contents of one build.
+
+    A ReplayDecoder only holds its Protocol and keeps no decoding state between calls, so
+    decoders of different builds can be used at the same time from any number of threads.
+    The compiled decoder programs are shared by all decoders of the same schema.
+
+    protocol is a Protocol, a build number, or a protocol module such as protocol70133.
+    """
+    def __init__(self, protocol):
+        if isinstance(protocol, protocol_store.Protocol):
+            pass
+        elif hasattr(protocol, 'typeinfos'):
+            protocol = protocol_store.Protocol.from_module(protocol)
+        else:
+            protocol = protocol_store.load_protocol(protocol)
+        self.protocol = protocol
+
+    def __repr__(self):
+        return 'ReplayDecoder(%d)' % self.protocol.build
+
+    def _event_stream(self, contents, decoder_class, get_program, eventid_typeid, event_types,
+                      decode_user_id, event_filter, projection, **window):
+        projection, trim = _event_projection(projection, event_types)
+        decoder = decoder_class(contents, get_program(self.protocol.typeinfos, projection))
+        return _decode_event_stream(decoder,
+                                    self.protocol,
+                                    eventid_typeid,
+                                    event_types,
+                                    decode_user_id=decode_user_id,
+                                    event_filter=event_filter,
+                                    trim=trim,
+                                    **window)
+
+    def decode_replay_game_events(self, contents, event_filter=None, projection=None,
+                                  start_gameloop=None, end_gameloop=None, index=None, build_index=None):
+        """Decodes and yields each game event from the contents byte string.
+
+        event_filter optionally restricts the output to the given event names and/or eventids,
+        other events are skipped without being decoded.  projection optionally maps event names
+        and/or eventids to the fields to decode, e.g. {'NNet.Game.SCmdEvent': ['m_abil', 'm_data']},
+        the other fields of those events are skipped and left out.
+
+        start_gameloop and end_gameloop optionally restrict the output to the events with
+        start_gameloop <= _gameloop < end_gameloop.  Decoding starts from the seek point of the
+        EventIndex index closest to start_gameloop, or skips the events before it from the start
+        of the stream without one.  build_index is an empty EventIndex to record the seek points
+        of the stream in while decoding all of it.
+        """
+        return self._event_stream(contents,
+                                  CompiledBitPackedDecoder,
+                                  get_bitpacked_program,
+                                  self.protocol.game_eventid_typeid,
+                                  self.protocol.game_event_types,
+                                  True,
+                                  event_filter,
+                                  projection,
+                                  start_gameloop=start_gameloop,
+                                  end_gameloop=end_gameloop,
+                                  index=index,
+                                  build_index=build_index)
+
+    def decode_replay_message_events(self, contents, event_filter=None, projection=None,
+                                     start_gameloop=None, end_gameloop=None, index=None, build_index=None):
+        """Decodes and yields each message event from the contents byte string.
+
+        The options work as for decode_replay_game_events.
+        """
+        return self._event_stream(contents,
+                                  CompiledBitPackedDecoder,
+                                  get_bitpacked_program,
+                                  self.protocol.message_eventid_typeid,
+                                  self.protocol.message_event_types,
+                                  True,
+                                  event_filter,
+                                  projection,
+                                  start_gameloop=start_gameloop,
+                                  end_gameloop=end_gameloop,
+                                  index=index,
+                                  build_index=build_index)
+
+    def decode_replay_tracker_events(self, contents, event_filter=None, projection=None,
+                                     start_gameloop=None, end_gameloop=None, index=None, build_index=None):
+        """Decodes and yields each tracker event from the contents byte string.
+
+        The options work as for decode_replay_game_events.
+        """
+        return self._event_stream(contents,
+                                  CompiledVersionedDecoder,
+                                  get_versioned_program,
+                                  self.protocol.tracker_eventid_typeid,
+                                  self.protocol.tracker_event_types,
+                                  False,
+                                  event_filter,
+                                  projection,
+                                  start_gameloop=start_gameloop,
+                                  end_gameloop=end_gameloop,
+                                  index=index,
+                                  build_index=build_index)
+
+    def decode_replay_tracker_columns(self, contents, events=None, use_numpy=None):
+        """Decodes the tracker events from the contents byte string into TrackerColumns.
+
+        events maps the names of the events to decode to their fields, by default
+        COLUMN_EVENTS, the other events are skipped.  See tracker_columns for use_numpy.
+        """
+        events = COLUMN_EVENTS if events is None else events
+        return tracker_columns(self.decode_replay_tracker_events(contents,
+                                                                 event_filter=list(events),
+                                                                 projection=events),
+                               use_numpy)
+
+    def decode_replay_unit_positions(self, contents, use_numpy=None):
+        """Decodes the unit positions of the tracker events from the contents byte string.
+
+        Returns the _gameloop, unitIndex, x and y columns of every unit mentioned by the
+        SUnitPositionsEvent events, see unit_positions.
+        """
+        return unit_positions(self.decode_replay_tracker_events(contents, event_filter=[POSITIONS_EVENT]),
+                              use_numpy)
+
+    def decode_replay_header(self, contents):
+        """Decodes and return the replay header from the contents byte string."""
+        decoder = CompiledVersionedDecoder(contents, get_versioned_program(self.protocol.typeinfos))
+        return decoder.instance(self.protocol.replay_header_typeid)
+
+    def decode_replay_details(self, contents):
+        """Decodes and returns the game details from the contents byte string."""
+        decoder = CompiledVersionedDecoder(contents, get_versioned_program(self.protocol.typeinfos))
+        return decoder.instance(self.protocol.game_details_typeid)
+
+    def decode_replay_initdata(self, contents):
+        """Decodes and return the replay init data from the contents byte string."""
+        decoder = CompiledBitPackedDecoder(contents, get_bitpacked_program(self.protocol.typeinfos))
+        return decoder.instance(self.protocol.replay_initdata_typeid)
+
+    def decode_replay_attributes_events(self, contents):
+        """Decodes and yields each attribute from the contents byte string."""
+        return decode_replay_attributes_events(contents)
+
+
+# The module-level functions decode with the protocol selected by load_protocol.
+
+def decode_replay_game_events(contents, event_filter=None, projection=None,
+                              start_gameloop=None, end_gameloop=None, index=None, build_index=None):
+    """Decodes and yields each game event from the contents byte string.
+
+    See ReplayDecoder.decode_replay_game_events.
+    """
+    return ReplayDecoder(protocol).decode_replay_game_events(contents, event_filter, projection,
+                                                             start_gameloop, end_gameloop, index, build_index)
+
+
+def decode_replay_message_events(contents, event_filter=None, projection=None,
+                                 start_gameloop=None, end_gameloop=None, index=None, build_index=None):
     """Decodes and yields each message event from the contents byte string."""
-    decoder = BitPackedDecoder(contents, protocol.typeinfos)
-    for event in _decode_event_stream(decoder,
-                                      protocol.message_eventid_typeid,
-                                      protocol.message_event_types,
-                                      decode_user_id=True):
-        yield event
+    return ReplayDecoder(protocol).decode_replay_message_events(contents, event_filter, projection,
+                                                                start_gameloop, end_gameloop, index, build_index)
 
 
-def decode_replay_tracker_events(contents):
+def decode_replay_tracker_events(contents, event_filter=None, projection=None,
+                                 start_gameloop=None, end_gameloop=None, index=None, build_index=None):
     """Decodes and yields each tracker event from the contents byte string."""
-    decoder = VersionedDecoder(contents, protocol.typeinfos)
-    for event in _decode_event_stream(decoder,
-                                      protocol.tracker_eventid_typeid,
-                                      protocol.tracker_event_types,
-                                      decode_user_id=False):
-        yield event
+    return ReplayDecoder(protocol).decode_replay_tracker_events(contents, event_filter, projection,
+                                                                start_gameloop, end_gameloop, index, build_index)
+
+
+def decode_replay_tracker_columns(contents, events=None, use_numpy=None):
+    """Decodes the tracker events from the contents byte string into TrackerColumns."""
+    return ReplayDecoder(protocol).decode_replay_tracker_columns(contents, events, use_numpy)
+
+
+def decode_replay_unit_positions(contents, use_numpy=None):
+    """Decodes the unit positions of the tracker events from the contents byte string."""
+    return ReplayDecoder(protocol).decode_replay_unit_positions(contents, use_numpy)
 
 
 def decode_replay_header(contents):
     """Decodes and return the replay header from the contents byte string."""
-    decoder = VersionedDecoder(contents, protocol.typeinfos)
-    return decoder.instance(protocol.replay_header_typeid)
+    return ReplayDecoder(protocol).decode_replay_header(contents)
 
 
 def decode_replay_details(contents):
     """Decodes and returns the game details from the contents byte string."""
-    decoder = VersionedDecoder(contents, protocol.typeinfos)
-    return decoder.instance(protocol.game_details_typeid)
+    return ReplayDecoder(protocol).decode_replay_details(contents)
 
 
 def decode_replay_initdata(contents):
     """Decodes and return the replay init data from the contents byte string."""
-    decoder = BitPackedDecoder(contents, protocol.typeinfos)
-    return decoder.instance(protocol.replay_initdata_typeid)
+    return ReplayDecoder(protocol).decode_replay_initdata(contents)
 
 
 def decode_replay_attributes_events(contents):
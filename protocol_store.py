@@ -0,0 +1,188 @@
+# Copyright (c) 2018 Blizzard Entertainment
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import glob
+import os
+import threading
+
+
+# The attributes a protocol module defines for its build.
+PROTOCOL_ATTRIBUTES = (
+    'typeinfos',
+    'game_event_types',
+    'game_eventid_typeid',
+    'message_event_types',
+    'message_eventid_typeid',
+    'tracker_event_types',
+    'tracker_eventid_typeid',
+    'svaruint32_typeid',
+    'replay_userid_typeid',
+    'replay_header_typeid',
+    'game_details_typeid',
+    'replay_initdata_typeid',
+)
+
+
+# Most builds don't change the protocol, so each schema is stored once in the protocol module of
+# the first build using it, followed by the later builds sharing it.
+# Regenerate with `python protocol_store.py` after adding protocol modules.
+schemas = {
+    29406: (),
+    30414: (30509, 30829, 30948, 31090),
+    31360: (31566, 31726, 31948),
+    32120: (32253,),
+    32455: (32524,),
+    33182: (33353,),
+    33684: (),
+    34053: (34190, 34659, 34846),
+    35360: (35529, 35634, 35702, 36144, 36280, 36359, 36536, 36693),
+    37069: (37117, 37274, 37351, 37569, 37795),
+    38236: (38500, 38593, 38793, 39015, 39153, 39271, 39445, 39595, 39709, 39951, 40087, 40322),
+    40336: (40431, 40697, 40798),
+    41150: (41393, 41504),
+    41609: (41707, 41764, 41810, 42178, 42273, 42406, 42506, 42590),
+    42742: (42958, 43051, 43170, 43259, 43481, 43527, 43571),
+    43905: (44124,),
+    44256: (44468, 44737, 44797, 44941, 45024, 45228, 45635),
+    45815: (45889, 45949, 46158, 46416, 46446, 46690, 46787, 46869, 46889, 47024, 47133, 47219,
+            47479, 47801, 47903, 47944, 48027, 48297, 48548, 48583, 48760, 49008, 49076, 49278,
+            49495, 49838),
+    49582: (49747, 49907, 50286, 50424, 50441, 50673, 50950, 51150, 51375, 51609, 51779, 51923,
+            52008, 52124, 52351, 52647),
+    51978: (52214, 52381),
+    52561: (52860, 52986, 53174, 53270, 53275, 53548, 53965, 54098, 54339, 54968, 55010, 55058,
+            55288, 55844),
+    55929: (56175, 56361, 56705, 56784, 56859, 57062, 57286, 57589),
+    57547: (57797, 58209, 58344, 58482, 58623, 58795, 59239),
+    59279: (59657, 59799, 59988),
+    59837: (59944, 60228, 60265, 60399, 60522, 60567, 60632, 60821, 61129, 61361, 61552),
+    61718: (61872, 61952, 62119, 62212, 62424),
+    62548: (62833, 63070, 63203, 63402, 63507, 63635, 64100, 64129, 64255, 64331, 64455, 64657,
+            64863, 65006, 65054, 65285, 65617, 65654),
+    65579: (65655, 65751, 65846, 65943, 66182, 66292, 66488, 66810, 66946),
+    66977: (67143, 67462, 67621, 67679, 67985, 68509),
+    68406: (68669, 68740, 68778, 69099, 69185, 69228, 69264, 69350, 69790, 69823),
+    69947: (70133,),
+}
+
+_schema_builds = dict((build, schema) for schema, builds in schemas.items() for build in builds)
+
+
+class Protocol:
+    """The decoding tables of one build.
+
+    Builds sharing a schema share the same table objects, so anything cached per typeinfos,
+    e.g. the compiled decoder programs, is shared between them too.
+    """
+    def __init__(self, build, schema, tables):
+        self.build = build
+        self.schema = schema
+        for name in PROTOCOL_ATTRIBUTES:
+            setattr(self, name, tables[name])
+
+    def __repr__(self):
+        return 'Protocol(build=%d, schema=%d)' % (self.build, self.schema)
+
+    @classmethod
+    def from_module(cls, module):
+        """Returns a Protocol with the tables of a protocol module, e.g. protocol70133.
+
+        The build is taken from the module name, 0 if it has none.
+        """
+        digits = module.__name__.rpartition('.')[2][len('protocol'):]
+        build = int(digits) if digits.isdigit() else 0
+        return cls(build, build, dict((name, getattr(module, name)) for name in PROTOCOL_ATTRIBUTES))
+
+
+_tables = {}
+_protocols = {}
+_lock = threading.Lock()
+
+
+def schema_of(build):
+    """Returns the build whose protocol module holds the schema of build."""
+    return _schema_builds.get(build, build)
+
+
+def _load_tables(schema):
+    # Builds missing from the index, e.g. newly added protocol modules, fall back to their own module.
+    tables = _tables.get(schema)
+    if tables is None:
+        module = __import__('protocol%s' % schema)
+        tables = _tables[schema] = dict((name, getattr(module, name)) for name in PROTOCOL_ATTRIBUTES)
+    return tables
+
+
+def load_protocol(build):
+    """Returns the Protocol of build, raises ImportError if the build is unknown."""
+    build = int(build)
+    protocol = _protocols.get(build)
+    if protocol is None:
+        with _lock:
+            protocol = _protocols.get(build)
+            if protocol is None:
+                schema = schema_of(build)
+                protocol = _protocols[build] = Protocol(build, schema, _load_tables(schema))
+    return protocol
+
+
+def available_builds():
+    """Returns the sorted builds that can be loaded."""
+    return sorted(set(schemas) | set(_schema_builds) | set(_module_builds()))
+
+
+def _module_builds(directory=None):
+    directory = directory or os.path.dirname(os.path.abspath(__file__))
+    builds = []
+    for path in glob.glob(os.path.join(directory, 'protocol[0-9]*.py')):
+        name = os.path.basename(path)[len('protocol'):-len('.py')]
+        if name.isdigit():
+            builds.append(int(name))
+    return builds
+
+
+def build_index(directory=None):
+    """Returns the schema index of the protocol modules in directory, as for schemas."""
+    index = {}
+    for build in sorted(_module_builds(directory)):
+        module = __import__('protocol%d' % build)
+        key = repr([getattr(module, name) for name in PROTOCOL_ATTRIBUTES])
+        index.setdefault(key, []).append(build)
+    return dict((builds[0], tuple(builds[1:])) for builds in index.values())
+
+
+def format_index(index, width=100):
+    lines = ['schemas = {']
+    for schema, builds in sorted(index.items()):
+        line = '    %d: (' % schema
+        indent = ' ' * len(line)
+        for i, build in enumerate(builds):
+            item = '%d,' % build if i + 1 < len(builds) or len(builds) == 1 else '%d' % build
+            if len(line) + len(item) + 2 > width:
+                lines.append(line.rstrip())
+                line = indent
+            line += item + ' '
+        lines.append(line.rstrip() + '),')
+    lines.append('}')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    print(format_index(build_index()))
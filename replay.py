@@ -0,0 +1,277 @@
+# Copyright (c) 2018 Blizzard Entertainment
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections
+import struct
+
+from decoder_compiler import *
+from event_index import EventIndex, load_indexes, save_indexes
+from mpyq import mpyq
+import protocol_functions
+import protocol_store
+
+
+# The replay header is versioned, so it can be read with the protocol of any build.
+HEADER_BUILD = 29406
+
+# The header fields scan_replay_header decodes by default.
+HEADER_FIELDS = ('m_version', 'm_elapsedGameLoops')
+
+# The user data header is a few hundred bytes, read along with its 16 byte MPQ header.
+_SCAN_SIZE = 1024
+
+
+def read_user_data(path):
+    """Returns the user data header content of a replay, which holds the replay header.
+
+    path is a file name or a binary file object positioned at the start of the replay.
+    """
+    if hasattr(path, 'read'):
+        return _read_user_data(path, path)
+    with open(path, 'rb', buffering=0) as f:
+        return _read_user_data(f, path)
+
+
+def _read_user_data(f, path):
+    data = f.read(_SCAN_SIZE)
+    if len(data) < 16 or data[:4] != b'MPQ\x1b':
+        raise ValueError('%s is not a replay' % (path,))
+    size = struct.unpack_from('<I', data, 12)[0]
+    if len(data) < 16 + size:
+        data += f.read(16 + size - len(data))
+    return data[16:16 + size]
+
+
+def scan_replay_header(path, fields=HEADER_FIELDS):
+    """Decodes the replay header of a replay file without opening it as an archive.
+
+    Only the user data header at the start of the file is read, and only the given header
+    fields are decoded, by default the version (including m_baseBuild) and the game length.
+    Pass fields=None to decode the whole header.
+    """
+    protocol = protocol_store.load_protocol(HEADER_BUILD)
+    typeid = protocol.replay_header_typeid
+    projection = {typeid: fields} if fields is not None else None
+    decoder = CompiledVersionedDecoder(read_user_data(path), get_versioned_program(protocol.typeinfos, projection))
+    return decoder.instance(typeid)
+
+
+# The archive file and ReplayDecoder method of each stream of a replay.
+STREAMS = collections.OrderedDict([
+    ('details', ('replay.details', 'decode_replay_details')),
+    ('initdata', ('replay.initData', 'decode_replay_initdata')),
+    ('attributes', ('replay.attributes.events', 'decode_replay_attributes_events')),
+    ('game_events', ('replay.game.events', 'decode_replay_game_events')),
+    ('message_events', ('replay.message.events', 'decode_replay_message_events')),
+    ('tracker_events', ('replay.tracker.events', 'decode_replay_tracker_events')),
+    ('tracker_columns', ('replay.tracker.events', 'decode_replay_tracker_columns')),
+    ('unit_positions', ('replay.tracker.events', 'decode_replay_unit_positions')),
+])
+
+EVENT_STREAMS = ('game_events', 'message_events', 'tracker_events')
+
+
+class Replay:
+    """A replay file whose streams are read and decoded on first access.
+
+    The header, details, initdata, attributes, game_events, message_events, tracker_events,
+    tracker_columns and unit_positions properties each read and decompress their archive file when first accessed and keep the
+    decoded result.  max_size optionally bounds the cache by the total decompressed size of
+    the cached streams, the least recently used streams are dropped first and decoded again
+    when needed.  The iter_*_events methods decode events without caching them, with prefetch
+    a thread decompresses up to that many sectors ahead of their decoding.  Their start_gameloop
+    seeks with the event_index of the stream, kept in a sidecar file next to the replay.
+    use_mmap and parallel are passed on to the MPQArchive.
+
+    cache is an optional ReplayCache the header and streams are loaded from before being
+    decoded, and stored in after.  The archive is only opened when something isn't cached.
+    """
+    def __init__(self, path, max_size=None, use_mmap=False, parallel=False, prefetch=0, cache=None):
+        self.path = path
+        self.max_size = max_size
+        self.prefetch = prefetch
+        self.cache = cache
+        self._archive_options = dict(listfile=False, use_mmap=use_mmap, lazy=True, parallel=parallel)
+        self._archive = None
+        self._cache_key = None
+        self._cache = collections.OrderedDict()
+        self._cache_size = 0
+        self._header = None
+        self._decoder = None
+        self._indexes = None
+
+    def __repr__(self):
+        return 'Replay(%r)' % (self.path,)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Closes the archive, it is opened again if streams are read afterwards."""
+        self.clear_cache()
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+    @property
+    def archive(self):
+        if self._archive is None:
+            self._archive = mpyq.MPQArchive(self.path, **self._archive_options)
+        return self._archive
+
+    @property
+    def cache_key(self):
+        """The key of the replay in the ReplayCache."""
+        if self._cache_key is None:
+            self._cache_key = self.cache.key(self.path)
+        return self._cache_key
+
+    def _cached(self, name, load):
+        # Returns the value of load() through the ReplayCache
+        if self.cache is None:
+            return load()
+        try:
+            return self.cache.load(self.cache_key, name)
+        except KeyError:
+            value = load()
+            self.cache.store(self.cache_key, name, value)
+            return value
+
+    def clear_cache(self):
+        self._cache.clear()
+        self._cache_size = 0
+
+    @property
+    def header(self):
+        if self._header is None:
+            self._header = self._cached('header', self._decode_header)
+        return self._header
+
+    def _decode_header(self):
+        contents = self.archive.header['user_data_header']['content']
+        return protocol_functions.ReplayDecoder(HEADER_BUILD).decode_replay_header(contents)
+
+    @property
+    def build(self):
+        return self.header['m_version']['m_baseBuild']
+
+    @property
+    def decoder(self):
+        """The ReplayDecoder of the replay's build, raises ImportError for unknown builds."""
+        if self._decoder is None:
+            self._decoder = protocol_functions.ReplayDecoder(self.build)
+        return self._decoder
+
+    def read_file(self, filename):
+        return self.archive.read_file(filename)
+
+    def stream(self, name):
+        """Returns the decoded stream, see STREAMS, None or [] if the replay doesn't have it."""
+        if name in self._cache:
+            self._cache.move_to_end(name)
+            return self._cache[name][0]
+
+        value, size = self._cached(name, lambda: self._decode_stream(name))
+        if self.max_size is None or size <= self.max_size:
+            self._cache[name] = (value, size)
+            self._cache_size += size
+            while self.max_size is not None and self._cache_size > self.max_size:
+                evicted, (evicted_value, evicted_size) = self._cache.popitem(last=False)
+                self._cache_size -= evicted_size
+        return value
+
+    def _decode_stream(self, name):
+        # Returns the decoded stream and its decompressed size
+        filename, method = STREAMS[name]
+        contents = self.archive.read_file(filename)
+        if not contents:
+            return [] if name in EVENT_STREAMS else None, 0
+        value = getattr(self.decoder, method)(contents)
+        if name in EVENT_STREAMS:
+            value = list(value)
+        return value, len(contents)
+
+    def event_index(self, name):
+        """Returns the EventIndex of an event stream.
+
+        The index is read from the replay's sidecar file, or built by walking the stream once
+        and saved to it.  Replays opened from a file object, or whose sidecar can't be written,
+        keep the index in memory.
+        """
+        if self._indexes is None:
+            self._indexes = load_indexes(self.path) if isinstance(self.path, str) else {}
+        index = self._indexes.get(name)
+        if index is None:
+            index = EventIndex()
+            # Every event is skipped, the walk only records the seek points.
+            for event in self._iter_events(name, [], None, build_index=index):
+                pass
+            self._indexes[name] = index
+            if isinstance(self.path, str):
+                try:
+                    save_indexes(self.path, self._indexes)
+                except OSError:
+                    pass
+        return index
+
+    def iter_events(self, name, event_filter=None, projection=None, start_gameloop=None, end_gameloop=None):
+        """Decodes and yields the events of an event stream without caching them.
+
+        The stream is decompressed sector by sector as the events are decoded, so
+        only the sectors being read are held in memory, never the whole stream.
+        event_filter, projection, start_gameloop and end_gameloop work as for
+        ReplayDecoder.decode_replay_game_events, start_gameloop seeks with event_index.
+        """
+        index = self.event_index(name) if start_gameloop else None
+        return self._iter_events(name, event_filter, projection,
+                                 start_gameloop=start_gameloop, end_gameloop=end_gameloop, index=index)
+
+    def _iter_events(self, name, event_filter, projection, **options):
+        filename, method = STREAMS[name]
+        chunks = self.archive.iter_file(filename, prefetch=self.prefetch)
+        if chunks is not None:
+            contents = ChunkedBitPackedBuffer(chunks)
+            try:
+                for event in getattr(self.decoder, method)(contents, event_filter, projection, **options):
+                    yield event
+            finally:
+                # Stops the prefetching thread when the caller stops early
+                chunks.close()
+
+    details = property(lambda self: self.stream('details'))
+    initdata = property(lambda self: self.stream('initdata'))
+    attributes = property(lambda self: self.stream('attributes'))
+    game_events = property(lambda self: self.stream('game_events'))
+    message_events = property(lambda self: self.stream('message_events'))
+    tracker_events = property(lambda self: self.stream('tracker_events'))
+    tracker_columns = property(lambda self: self.stream('tracker_columns'))
+    unit_positions = property(lambda self: self.stream('unit_positions'))
+
+    def iter_game_events(self, event_filter=None, projection=None, start_gameloop=None, end_gameloop=None):
+        return self.iter_events('game_events', event_filter, projection, start_gameloop, end_gameloop)
+
+    def iter_message_events(self, event_filter=None, projection=None, start_gameloop=None, end_gameloop=None):
+        return self.iter_events('message_events', event_filter, projection, start_gameloop, end_gameloop)
+
+    def iter_tracker_events(self, event_filter=None, projection=None, start_gameloop=None, end_gameloop=None):
+        return self.iter_events('tracker_events', event_filter, projection, start_gameloop, end_gameloop)
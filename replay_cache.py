@@ -0,0 +1,179 @@
+# Copyright (c) 2018 Blizzard Entertainment
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import hashlib
+import os
+import pickle
+import tempfile
+import zlib
+
+import tracker_columns
+
+
+# Bumped whenever the decoded streams change, entries of older versions are never hit again
+# and age out of the cache.
+CACHE_VERSION = 1
+
+# The tracker columns hold NumPy arrays when NumPy is installed and lists otherwise.
+DECODER_VERSION = '%d%s' % (CACHE_VERSION, 'n' if tracker_columns.has_numpy() else 'l')
+
+# Default bound of the total size of the cache files.
+DEFAULT_MAX_SIZE = 1 << 30
+
+# Eviction goes down to this fraction of max_size, so a full cache isn't scanned on every store.
+EVICT_RATIO = 0.9
+
+# The directory is scanned again after this many stores, to account for other processes' entries.
+RESCAN_STORES = 1024
+
+_SUFFIX = '.zpkl'
+
+
+def _check_private(directory):
+    # Refuses directories other users could plant entries in
+    if not hasattr(os, 'getuid'):
+        return
+    stat = os.stat(directory)
+    if stat.st_uid != os.getuid():
+        raise PermissionError('cache directory %s is owned by another user' % directory)
+    if stat.st_mode & 0o022:
+        raise PermissionError('cache directory %s is writable by other users' % directory)
+
+
+def replay_hash(path):
+    """Returns the hash of the contents of the replay file path."""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ReplayCache:
+    """A directory of decoded replay streams, shared by any number of processes.
+
+    Entries are keyed by the hash of the replay contents and DECODER_VERSION, and stored as
+    zlib compressed pickles.  Entries are written to a temporary file and renamed, so readers
+    never see partial entries.  When the files add up to more than max_size bytes, the least
+    recently used ones are removed down to EVICT_RATIO of it; hits refresh the modification
+    time of their file.  The total size is tracked as entries are stored, the directory is only
+    scanned when it goes over max_size or every RESCAN_STORES stores.
+
+    Loading a pickle can run arbitrary code, so the cache directory must only be writable by
+    the user running the processes sharing it: it is created with 0700 permissions, and a
+    directory owned by another user or writable by other users is refused with PermissionError.
+    """
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        _check_private(directory)
+        self._size = None  # total size of the entries, None until the directory is scanned
+        self._stores = 0
+
+    def __repr__(self):
+        return 'ReplayCache(%r)' % (self.directory,)
+
+    def key(self, path):
+        """Returns the key of the replay file path."""
+        return '%s-%s' % (replay_hash(path), DECODER_VERSION)
+
+    def _filename(self, key, stream):
+        return os.path.join(self.directory, '%s.%s%s' % (key, stream, _SUFFIX))
+
+    def load(self, key, stream):
+        """Returns the cached value of a stream, raises KeyError when it isn't cached."""
+        filename = self._filename(key, stream)
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            value = pickle.loads(zlib.decompress(data))
+        except FileNotFoundError:
+            raise KeyError((key, stream))
+        except (OSError, zlib.error, pickle.UnpicklingError, EOFError, ValueError):
+            # Unreadable entries are dropped and decoded again
+            self._remove(filename)
+            raise KeyError((key, stream))
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        return value
+
+    def store(self, key, stream, value):
+        """Caches the value of a stream, then evicts entries above max_size."""
+        data = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        if len(data) > self.max_size:
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self._filename(key, stream))
+        except BaseException:
+            self._remove(tmp)
+            raise
+
+        # Replaced entries are counted twice until the next scan, which only evicts early
+        self._stores += 1
+        if self._size is None or self._stores >= RESCAN_STORES:
+            self._size = self.size()
+            self._stores = 0
+        else:
+            self._size += len(data)
+        if self._size > self.max_size:
+            self.evict(int(self.max_size * EVICT_RATIO))
+
+    def entries(self):
+        """Returns (mtime, size, filename) for each cache file, least recently used first."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(_SUFFIX):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue  # evicted by another process
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        return entries
+
+    def size(self):
+        return sum(size for mtime, size, filename in self.entries())
+
+    def evict(self, max_size=None):
+        """Removes the least recently used entries until the cache fits in max_size bytes."""
+        max_size = self.max_size if max_size is None else max_size
+        entries = self.entries()
+        total = sum(size for mtime, size, filename in entries)
+        for mtime, size, filename in entries:
+            if total <= max_size:
+                break
+            self._remove(filename)
+            total -= size
+        self._size = total
+
+    def clear(self):
+        self.evict(0)
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+#
+# Builds the optional compiled decoders backend in place:
+#
+#     python setup.py build_ext --inplace
+#
+# The resulting extension module is imported instead of decoders.py whenever it is present.
+
+from setuptools import Extension, setup
+from Cython.Build import cythonize
+
+setup(name='heroprotocol',
+      ext_modules=cythonize([Extension('decoders', ['decoders.pyx'])], language_level=3),
+     )
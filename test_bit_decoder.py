@@ -1,4 +1,5 @@
 
+import random
 import unittest
 import struct
 
@@ -75,6 +76,135 @@ class TestBitDecododer(unittest.TestCase):
         self.assertEqual(0x7F, decoder.read_bits(7))
         #self.assertEqual(1, decoder.read_bits(8))
 
+    def test_used_bits(self):
+        data = struct.pack('<I', 0x12345678)
+
+        decoder = BitPackedBuffer(data)
+
+        self.assertEqual(0, decoder.used_bits())
+        decoder.read_bits(3)
+        self.assertEqual(3, decoder.used_bits())
+        decoder.read_bits(13)
+        self.assertEqual(16, decoder.tell_bits())
+        decoder.byte_align()
+        self.assertEqual(16, decoder.tell_bits())
+        decoder.read_bits(1)
+        decoder.byte_align()
+        self.assertEqual(24, decoder.tell_bits())
+
+    def test_seek_bits(self):
+        testdata = int('00111001 11110000 01111111 11111100'.replace(' ', ''), 2)
+        data = struct.pack('<I', testdata)
+
+        decoder = BitPackedBuffer(data)
+
+        decoder.seek_bits(15)
+        self.assertEqual(0x00, decoder.read_bits(5))
+        self.assertEqual(0x1F, decoder.read_bits(5))
+
+        decoder.seek_bits(2)
+        self.assertEqual(0x1FFF, decoder.read_bits(13))
+        self.assertEqual(15, decoder.tell_bits())
+
+        decoder.seek_bits(32)
+        self.assertTrue(decoder.done())
+        self.assertRaises(TruncatedError, decoder.seek_bits, 33)
+
+    def test_truncated(self):
+        decoder = BitPackedBuffer(b'\xff')
+
+        decoder.read_bits(6)
+        self.assertRaises(TruncatedError, decoder.read_bits, 3)
+        self.assertRaises(TruncatedError, decoder.read_aligned_bytes, 1)
+
+    def test_aligned_view(self):
+        data = b'\x01abcdef'
+
+        decoder = BitPackedBuffer(data)
+
+        self.assertEqual(1, decoder.read_bits(2))
+        view = decoder.read_aligned_view(3)
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(b'abc', view)
+        self.assertEqual(32, decoder.tell_bits())
+        self.assertEqual(b'def', decoder.read_aligned_bytes(3))
+        self.assertTrue(decoder.done())
+
+    def test_read_bits_widths(self):
+        # Compare against reading the same stream one byte-sized chunk at a time
+        rnd = random.Random(0)
+        data = bytes(rnd.getrandbits(8) for i in range(512))
+
+        for endian in ('big', 'little'):
+            decoder = BitPackedBuffer(data, endian)
+            reference = BitPackedBuffer(data, endian)
+            while reference.tell_bits() + 64 < len(data) * 8:
+                width = rnd.choice((0, 1, 3, 7, 8, 9, 15, 16, 17, 31, 32, 33, 63, 64))
+                expected = 0
+                remaining = width
+                while remaining:
+                    chunk = min(remaining, 8 - reference.tell_bits() % 8)
+                    value = reference.read_bits(chunk)
+                    if endian == 'big':
+                        expected = (expected << chunk) | value
+                    else:
+                        expected |= value << (width - remaining)
+                    remaining -= chunk
+                self.assertEqual(expected, decoder.read_bits(width))
+                self.assertEqual(reference.tell_bits(), decoder.tell_bits())
+
+
+class TestChunkedBuffer(unittest.TestCase):
+
+    def chunks(self, data, rnd):
+        # Splits data into chunks of random sizes, some empty
+        chunks = []
+        i = 0
+        while i < len(data):
+            size = rnd.choice((0, 1, 2, 5, 13, 64))
+            chunks.append(data[i:i + size])
+            i += size
+        return chunks
+
+    def test_same_reads(self):
+        rnd = random.Random(1)
+        data = bytes(rnd.getrandbits(8) for i in range(2048))
+        for endian in ('big', 'little'):
+            reference = BitPackedBuffer(data, endian)
+            chunked = ChunkedBitPackedBuffer(self.chunks(data, rnd), endian)
+            while reference.tell_bits() + 128 < len(data) * 8:
+                op = rnd.choice(('bits', 'bits', 'view', 'skip', 'skip_bytes', 'align', 'unaligned'))
+                if op == 'bits':
+                    width = rnd.choice((0, 1, 7, 8, 9, 31, 32, 33, 64))
+                    self.assertEqual(reference.read_bits(width), chunked.read_bits(width))
+                elif op == 'view':
+                    self.assertEqual(reference.read_aligned_view(5), chunked.read_aligned_view(5))
+                elif op == 'skip':
+                    width = rnd.randint(0, 40)
+                    reference.skip_bits(width)
+                    chunked.skip_bits(width)
+                elif op == 'skip_bytes':
+                    reference.skip_aligned_bytes(3)
+                    chunked.skip_aligned_bytes(3)
+                elif op == 'align':
+                    reference.byte_align()
+                    chunked.byte_align()
+                else:
+                    self.assertEqual(reference.read_unaligned_bytes(3), chunked.read_unaligned_bytes(3))
+                self.assertEqual(reference.tell_bits(), chunked.tell_bits())
+            chunked.seek_bits(len(data) * 8 - 8)
+            self.assertEqual(data[-1], chunked.read_bits(8))
+            self.assertTrue(chunked.done())
+
+    def test_done_and_truncated(self):
+        chunked = ChunkedBitPackedBuffer([b'', b'\x01', b'', b'\x02\x03', b''])
+        self.assertFalse(chunked.done())
+        self.assertEqual(0x010203, chunked.read_bits(24))
+        self.assertTrue(chunked.done())
+        self.assertRaises(TruncatedError, chunked.read_bits, 1)
+        self.assertTrue(ChunkedBitPackedBuffer([]).done())
+        self.assertRaises(TruncatedError, ChunkedBitPackedBuffer([b'ab']).read_aligned_view, 3)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
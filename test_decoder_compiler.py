@@ -0,0 +1,374 @@
+import random
+import unittest
+
+from decoders import *
+from decoder_compiler import *
+
+import decoder_compiler
+import protocol29406
+import protocol70133
+
+
+class BitPackedWriter:
+    # Writes bits in the order BitPackedBuffer reads them back in big-endian mode
+
+    def __init__(self):
+        self._data = bytearray()
+        self._nextbits = 0  # bits already used in the last byte
+
+    def write_bits(self, value, bits):
+        while bits:
+            if self._nextbits == 0:
+                self._data.append(0)
+            chunk = min(8 - self._nextbits, bits)
+            bits -= chunk
+            self._data[-1] |= ((value >> bits) & ((1 << chunk) - 1)) << self._nextbits
+            self._nextbits = (self._nextbits + chunk) & 7
+
+    def byte_align(self):
+        self._nextbits = 0
+
+    def write_aligned_bytes(self, data):
+        self.byte_align()
+        self._data.extend(data)
+
+    def getvalue(self):
+        return bytes(self._data)
+
+
+def write_random_instance(writer, typeinfos, typeid, rnd, depth=0):
+    # Writes a random, valid instance of typeid, keeping arrays and blobs short
+    name, args = typeinfos[typeid]
+
+    def write_int(bounds, value):
+        writer.write_bits(value - bounds[0], bounds[1])
+        return value
+
+    def write_length(bounds):
+        return write_int(bounds, bounds[0] + min(rnd.randint(0, 3), (1 << bounds[1]) - 1))
+
+    if name == '_int':
+        write_int(args[0], args[0][0] + rnd.getrandbits(args[0][1]) if args[0][1] else args[0][0])
+    elif name == '_bool':
+        writer.write_bits(rnd.getrandbits(1), 1)
+    elif name == '_array':
+        for i in range(write_length(args[0])):
+            write_random_instance(writer, typeinfos, args[1], rnd, depth + 1)
+    elif name == '_bitarray':
+        length = write_length(args[0])
+        writer.write_bits(rnd.getrandbits(length) if length else 0, length)
+    elif name == '_blob':
+        length = write_length(args[0])
+        writer.write_aligned_bytes(bytes(rnd.choice(b'abc\xff') for i in range(length)))
+    elif name == '_choice':
+        tag = write_int(args[0], rnd.choice(sorted(args[1])))
+        write_random_instance(writer, typeinfos, args[1][tag][1], rnd, depth + 1)
+    elif name == '_fourcc':
+        writer.write_bits(int.from_bytes(b'Hero', 'big'), 32)
+    elif name == '_optional':
+        exists = depth < 6 and rnd.getrandbits(1)
+        writer.write_bits(exists, 1)
+        if exists:
+            write_random_instance(writer, typeinfos, args[0], rnd, depth + 1)
+    elif name == '_struct':
+        fields = sorted(args[0], key=lambda f: f[0] != '__parent')
+        for field in fields:
+            write_random_instance(writer, typeinfos, field[1], rnd, depth + 1)
+
+
+def write_random_events(protocol, count, rnd):
+    # Writes a game event stream of count random events
+    eventid_typeid = protocol.game_eventid_typeid
+    event_types = sorted(protocol.game_event_types.items())
+    eventid_bounds = protocol.typeinfos[eventid_typeid][1][0]
+
+    writer = BitPackedWriter()
+    for i in range(count):
+        write_random_instance(writer, protocol.typeinfos, protocol.svaruint32_typeid, rnd)
+        write_random_instance(writer, protocol.typeinfos, protocol.replay_userid_typeid, rnd)
+        eventid, (typeid, typename) = rnd.choice(event_types)
+        writer.write_bits(eventid - eventid_bounds[0], eventid_bounds[1])
+        write_random_instance(writer, protocol.typeinfos, typeid, rnd)
+        writer.byte_align()
+    return writer.getvalue()
+
+
+class VersionedWriter:
+    # Writes values in the self-describing format VersionedDecoder reads
+
+    def __init__(self):
+        self._data = bytearray()
+
+    def write_byte(self, value):
+        self._data.append(value)
+
+    def write_vint(self, value):
+        negative = value < 0
+        value = -value if negative else value
+        b = ((value & 0x3f) << 1) | negative
+        value >>= 6
+        while value:
+            self._data.append(b | 0x80)
+            b = value & 0x7f
+            value >>= 7
+        self._data.append(b)
+
+    def write_bytes(self, data):
+        self._data.extend(data)
+
+    def getvalue(self):
+        return bytes(self._data)
+
+
+def write_random_versioned(writer, typeinfos, typeid, rnd, depth=0):
+    # Writes a random instance of typeid, with an unknown extra field in some structs
+    name, args = typeinfos[typeid]
+    if name == '_int':
+        writer.write_byte(9)
+        writer.write_vint(rnd.randint(-1000, 1 << 40))
+    elif name == '_bool':
+        writer.write_byte(6)
+        writer.write_byte(rnd.getrandbits(1))
+    elif name == '_array':
+        length = rnd.randint(0, 3)
+        writer.write_byte(0)
+        writer.write_vint(length)
+        for i in range(length):
+            write_random_versioned(writer, typeinfos, args[1], rnd, depth + 1)
+    elif name == '_bitarray':
+        length = rnd.randint(0, 20)
+        writer.write_byte(1)
+        writer.write_vint(length)
+        writer.write_bytes(bytes(rnd.getrandbits(8) for i in range((length + 7) // 8)))
+    elif name == '_blob':
+        length = rnd.randint(0, 5)
+        writer.write_byte(2)
+        writer.write_vint(length)
+        writer.write_bytes(bytes(rnd.choice(b'abc\xff') for i in range(length)))
+    elif name == '_choice':
+        tag = rnd.choice(sorted(args[1]))
+        writer.write_byte(3)
+        writer.write_vint(tag)
+        write_random_versioned(writer, typeinfos, args[1][tag][1], rnd, depth + 1)
+    elif name == '_fourcc':
+        writer.write_byte(7)
+        writer.write_bytes(b'Hero')
+    elif name == '_optional':
+        exists = depth < 6 and rnd.getrandbits(1)
+        writer.write_byte(4)
+        writer.write_byte(exists)
+        if exists:
+            write_random_versioned(writer, typeinfos, args[0], rnd, depth + 1)
+    elif name == '_struct':
+        fields = args[0]
+        extra = rnd.getrandbits(2) == 0
+        writer.write_byte(5)
+        writer.write_vint(len(fields) + extra)
+        for field in fields:
+            writer.write_vint(field[2])
+            write_random_versioned(writer, typeinfos, field[1], rnd, depth + 1)
+        if extra:
+            writer.write_vint(1000)
+            writer.write_byte(0)
+            writer.write_vint(2)
+            writer.write_byte(9)
+            writer.write_vint(5)
+            writer.write_byte(2)
+            writer.write_vint(1)
+            writer.write_bytes(b'x')
+
+
+def write_versioned_value(writer, typeinfos, typeid, value):
+    # Writes a decoded value of typeid back in the format VersionedDecoder reads
+    name, args = typeinfos[typeid]
+    if name == '_int':
+        writer.write_byte(9)
+        writer.write_vint(value)
+    elif name == '_bool':
+        writer.write_byte(6)
+        writer.write_byte(int(value))
+    elif name == '_array':
+        writer.write_byte(0)
+        writer.write_vint(len(value))
+        for item in value:
+            write_versioned_value(writer, typeinfos, args[1], item)
+    elif name == '_bitarray':
+        writer.write_byte(1)
+        writer.write_vint(value[0])
+        writer.write_bytes(value[1])
+    elif name == '_blob':
+        value = value.encode('utf-8') if isinstance(value, str) else value
+        writer.write_byte(2)
+        writer.write_vint(len(value))
+        writer.write_bytes(value)
+    elif name == '_choice':
+        (field, item), = value.items()
+        tag = next(tag for tag, f in args[1].items() if f[0] == field)
+        writer.write_byte(3)
+        writer.write_vint(tag)
+        write_versioned_value(writer, typeinfos, args[1][tag][1], item)
+    elif name == '_fourcc':
+        writer.write_byte(7)
+        writer.write_bytes(value)
+    elif name == '_optional':
+        writer.write_byte(4)
+        writer.write_byte(value is not None)
+        if value is not None:
+            write_versioned_value(writer, typeinfos, args[0], value)
+    elif name == '_struct':
+        fields = [f for f in args[0] if f[0] in value]
+        writer.write_byte(5)
+        writer.write_vint(len(fields))
+        for field in fields:
+            writer.write_vint(field[2])
+            write_versioned_value(writer, typeinfos, field[1], value[field[0]])
+
+
+class TestBitPackedCompiler(unittest.TestCase):
+
+    def assertSameDecode(self, typeinfos, program, data, typeid):
+        reference = BitPackedDecoder(data, typeinfos)
+        compiled = CompiledBitPackedDecoder(data, program)
+        try:
+            expected = reference.instance(typeid)
+        except (TruncatedError, CorruptedError, UnicodeDecodeError) as e:
+            self.assertRaises(type(e), compiled.instance, typeid)
+        else:
+            self.assertEqual(expected, compiled.instance(typeid))
+            self.assertEqual(reference.used_bits(), compiled.used_bits())
+
+    def test_every_typeid(self):
+        for protocol in (protocol29406, protocol70133):
+            program = BitPackedProgram(protocol.typeinfos)
+            rnd = random.Random(0)
+            for typeid in range(len(protocol.typeinfos)):
+                writer = BitPackedWriter()
+                write_random_instance(writer, protocol.typeinfos, typeid, rnd)
+                self.assertSameDecode(protocol.typeinfos, program, writer.getvalue(), typeid)
+
+    def test_random_data(self):
+        # Garbage input has to fail (or not) the same way as the closure decoder
+        program = BitPackedProgram(protocol70133.typeinfos)
+        rnd = random.Random(1)
+        for typeid in range(len(protocol70133.typeinfos)):
+            data = bytes(rnd.getrandbits(8) for i in range(rnd.choice((2, 16, 64))))
+            self.assertSameDecode(protocol70133.typeinfos, program, data, typeid)
+
+    def test_inlined_struct(self):
+        typeinfos = [
+            ('_int', [(0, 7)]),  #0
+            ('_int', [(5, 3)]),  #1
+            ('_optional', [1]),  #2
+            ('_struct', [[('m_a', 0, 0), ('m_b', 2, 1)]]),  #3
+        ]
+        source = BitPackedCompiler(typeinfos).source()
+        self.assertIn("return {'m_a': read_bits(7), 'm_b': ((5 + read_bits(3)) if read_bits(1) else None)}",
+                      source)
+
+        writer = BitPackedWriter()
+        writer.write_bits(100, 7)
+        writer.write_bits(1, 1)
+        writer.write_bits(2, 3)
+        decoder = CompiledBitPackedDecoder(writer.getvalue(), BitPackedProgram(typeinfos))
+        self.assertEqual({'m_a': 100, 'm_b': 7}, decoder.instance(3))
+
+    def test_program_cache(self):
+        program = get_bitpacked_program(protocol70133.typeinfos)
+        self.assertIs(program, get_bitpacked_program(protocol70133.typeinfos))
+        self.assertIsNot(program, get_bitpacked_program(protocol29406.typeinfos))
+
+        # Decoders sharing a program each read their own buffer
+        first = CompiledBitPackedDecoder(b'\x01\x02', program)
+        second = CompiledBitPackedDecoder(b'\x03\x04', program)
+        self.assertEqual(1, first.instance(10))
+        self.assertEqual(3, second.instance(10))
+        self.assertEqual(2, first.instance(10))
+        self.assertEqual(4, second.instance(10))
+
+    def test_projected_program_cache(self):
+        typeinfos = [
+            ('_int', [(0, 7)]),  #0
+            ('_struct', [[('m_a', 0, 0), ('m_b', 0, 1), ('m_c', 0, 2)]]),  #1
+        ]
+        self.addCleanup(setattr, decoder_compiler, 'MAX_PROJECTED_PROGRAMS', decoder_compiler.MAX_PROJECTED_PROGRAMS)
+        decoder_compiler.MAX_PROJECTED_PROGRAMS = 2
+        program = get_bitpacked_program(typeinfos)
+        first = get_bitpacked_program(typeinfos, {1: ['m_a']})
+        self.assertIs(first, get_bitpacked_program(typeinfos, {1: ['m_a']}))
+        second = get_bitpacked_program(typeinfos, {1: ['m_b']})
+        self.assertIs(first, get_bitpacked_program(typeinfos, {1: ['m_a']}))
+        # the least recently used projection is dropped, the unprojected program stays
+        get_bitpacked_program(typeinfos, {1: ['m_c']})
+        self.assertIsNot(second, get_bitpacked_program(typeinfos, {1: ['m_b']}))
+        self.assertEqual(2, sum(1 for key in decoder_compiler._projected_programs if key[1] == id(typeinfos)))
+        self.assertIs(program, get_bitpacked_program(typeinfos))
+
+    def test_skip(self):
+        program = BitPackedProgram(protocol70133.typeinfos)
+        rnd = random.Random(2)
+        for typeid in range(len(protocol70133.typeinfos)):
+            writer = BitPackedWriter()
+            write_random_instance(writer, protocol70133.typeinfos, typeid, rnd)
+            writer.write_bits(5, 3)
+            data = writer.getvalue()
+
+            decoder = CompiledBitPackedDecoder(data, program)
+            decoder.instance(typeid)
+            for skipper in (CompiledBitPackedDecoder(data, program),
+                            BitPackedDecoder(data, protocol70133.typeinfos)):
+                skipper.skip(typeid)
+                self.assertEqual(decoder.used_bits(), skipper.used_bits())
+                self.assertEqual(5, skipper._buffer.read_bits(3))
+
+    def test_skip_collapses_fixed_width(self):
+        typeinfos = [
+            ('_int', [(0, 7)]),  #0
+            ('_bool', []),  #1
+            ('_struct', [[('m_a', 0, 0), ('m_b', 1, 1)]]),  #2
+            ('_array', [(0, 4), 2]),  #3
+            ('_optional', [0]),  #4
+            ('_struct', [[('m_a', 2, 0), ('m_b', 0, 1), ('m_c', 4, 2), ('m_d', 3, 3), ('m_e', 1, 4)]]),  #5
+        ]
+        self.assertEqual([7, 1, 8, None, None, None], fixed_bit_widths(typeinfos))
+        self.assertEqual(['skip_bits(15)', 'if read_bits(1):', '    skip_bits(7)',
+                          'skip_bits(read_bits(4) * 8)', 'skip_bits(1)'],
+                         BitPackedCompiler(typeinfos).skip(5, inline=False))
+
+        writer = BitPackedWriter()
+        writer.write_bits(0, 15)
+        writer.write_bits(1, 1)
+        writer.write_bits(0, 7)
+        writer.write_bits(2, 4)
+        writer.write_bits(0, 17)
+        writer.write_bits(0x3f, 6)
+        data = writer.getvalue()
+        for decoder in (BitPackedDecoder(data, typeinfos), CompiledBitPackedDecoder(data, BitPackedProgram(typeinfos))):
+            decoder.skip(5)
+            self.assertEqual(44, decoder.used_bits())
+            self.assertEqual(0x3f, decoder._buffer.read_bits(6))
+
+
+class TestVersionedProgram(unittest.TestCase):
+
+    def test_every_typeid(self):
+        for protocol in (protocol29406, protocol70133):
+            program = get_versioned_program(protocol.typeinfos)
+            rnd = random.Random(0)
+            for typeid in range(len(protocol.typeinfos)):
+                writer = VersionedWriter()
+                write_random_versioned(writer, protocol.typeinfos, typeid, rnd)
+                data = writer.getvalue()
+
+                reference = VersionedDecoder(data, protocol.typeinfos)
+                compiled = CompiledVersionedDecoder(data, program)
+                self.assertEqual(reference.instance(typeid), compiled.instance(typeid))
+                self.assertTrue(compiled.done())
+
+    def test_corrupted(self):
+        program = get_versioned_program(protocol70133.typeinfos)
+        decoder = CompiledVersionedDecoder(b'\x09\x00', program)
+        self.assertRaises(CorruptedError, decoder.instance, protocol70133.replay_header_typeid)
+
+
+if __name__ == '__main__':
+    unittest.main()
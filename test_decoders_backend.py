@@ -0,0 +1,102 @@
+import glob
+import importlib
+import importlib.util
+import os
+import random
+import unittest
+
+import decoders
+from decoder_compiler import BitPackedProgram
+
+from test_decoder_compiler import BitPackedWriter, VersionedWriter, write_random_instance, write_random_versioned
+
+
+def _load_python_decoders():
+    # Loads decoders.py under another name, the compiled backend shadows it when built
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'decoders.py')
+    spec = importlib.util.spec_from_file_location('_python_decoders', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _unique_typeinfos():
+    # Returns one protocol module for each distinct set of typeinfos
+    protocols = {}
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for path in sorted(glob.glob(os.path.join(directory, 'protocol[0-9]*.py'))):
+        protocol = importlib.import_module(os.path.basename(path)[:-3])
+        protocols.setdefault(repr(protocol.typeinfos), protocol)
+    return list(protocols.values())
+
+
+python_decoders = _load_python_decoders()
+compiled = not decoders.__file__.endswith('.py')
+
+
+@unittest.skipUnless(compiled, 'compiled decoders backend is not built')
+class TestBackendParity(unittest.TestCase):
+
+    def test_api(self):
+        def public(obj):
+            return set(name for name in dir(obj) if not name.startswith('__'))
+
+        self.assertEqual(public(python_decoders), public(decoders))
+        for name in ('BitPackedBuffer', 'BitPackedDecoder', 'VersionedDecoder'):
+            self.assertEqual(public(getattr(python_decoders, name)), public(getattr(decoders, name)), name)
+
+    def assertSameResult(self, python_func, compiled_func):
+        # Returns False when both raised the same exception
+        try:
+            expected = python_func()
+        except Exception as e:
+            with self.assertRaises(Exception) as context:
+                compiled_func()
+            self.assertEqual(type(e).__name__, type(context.exception).__name__)
+            return False
+        else:
+            self.assertEqual(expected, compiled_func())
+            return True
+
+    def test_buffer(self):
+        rnd = random.Random(0)
+        data = bytes(rnd.getrandbits(8) for i in range(4096))
+        for endian in ('big', 'little'):
+            python_buffer = python_decoders.BitPackedBuffer(data, endian)
+            compiled_buffer = decoders.BitPackedBuffer(data, endian)
+            while not python_buffer.done():
+                width = rnd.choice((0, 1, 5, 8, 13, 32, 56, 57, 64, 100))
+                if not self.assertSameResult(lambda: python_buffer.read_bits(width),
+                                             lambda: compiled_buffer.read_bits(width)):
+                    break
+                self.assertEqual(python_buffer.tell_bits(), compiled_buffer.tell_bits())
+                self.assertEqual(str(python_buffer), str(compiled_buffer))
+                if rnd.getrandbits(3) == 0:
+                    python_buffer.byte_align()
+                    compiled_buffer.byte_align()
+                    self.assertSameResult(lambda: python_buffer.read_aligned_bytes(3),
+                                          lambda: compiled_buffer.read_aligned_bytes(3))
+
+    def test_protocols(self):
+        for protocol in _unique_typeinfos():
+            typeinfos = protocol.typeinfos
+            program = BitPackedProgram(typeinfos)
+            rnd = random.Random(protocol.__name__)
+            for typeid in range(len(typeinfos)):
+                writer = BitPackedWriter()
+                write_random_instance(writer, typeinfos, typeid, rnd)
+                data = writer.getvalue()
+                self.assertSameResult(lambda: python_decoders.BitPackedDecoder(data, typeinfos).instance(typeid),
+                                      lambda: decoders.BitPackedDecoder(data, typeinfos).instance(typeid))
+                self.assertSameResult(lambda: program.bind(python_decoders.BitPackedBuffer(data))[0][typeid](),
+                                      lambda: program.bind(decoders.BitPackedBuffer(data))[0][typeid]())
+
+                writer = VersionedWriter()
+                write_random_versioned(writer, typeinfos, typeid, rnd)
+                data = writer.getvalue()
+                self.assertSameResult(lambda: python_decoders.VersionedDecoder(data, typeinfos).instance(typeid),
+                                      lambda: decoders.VersionedDecoder(data, typeinfos).instance(typeid))
+
+
+if __name__ == '__main__':
+    unittest.main()
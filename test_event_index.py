@@ -0,0 +1,106 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import event_index
+import protocol_functions
+
+from test_decoder_compiler import write_random_events
+from test_protocol_functions import write_random_tracker_events
+
+
+class TestEventIndex(unittest.TestCase):
+
+    def test_seek_point(self):
+        index = event_index.EventIndex(2)
+        for gameloop, bits in [(0, 0), (10, 80), (10, 160), (25, 240)]:
+            index.add(gameloop, bits)
+        self.assertEqual((0, 0), index.seek_point(0))
+        self.assertEqual((0, 0), index.seek_point(10))
+        self.assertEqual((10, 160), index.seek_point(11))
+        self.assertEqual((10, 160), index.seek_point(25))
+        self.assertEqual((25, 240), index.seek_point(1000))
+        self.assertEqual((0, 0), event_index.EventIndex().seek_point(100))
+
+    def test_sidecar(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'a.StormReplay')
+            with open(path, 'wb') as f:
+                f.write(b'replay')
+            self.assertEqual({}, event_index.load_indexes(path))
+
+            index = event_index.EventIndex(16, [0, 5], [0, 128])
+            event_index.save_indexes(path, {'game_events': index})
+            self.assertEqual(['a.StormReplay', 'a.StormReplay.index.json'], sorted(os.listdir(directory)))
+            loaded = event_index.load_indexes(path)['game_events']
+            self.assertEqual(index.to_dict(), loaded.to_dict())
+
+            # a changed replay invalidates the sidecar
+            time.sleep(0.01)
+            with open(path, 'wb') as f:
+                f.write(b'another replay')
+            self.assertEqual({}, event_index.load_indexes(path))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_concurrent_saves(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'a.StormReplay')
+            with open(path, 'wb') as f:
+                f.write(b'replay')
+            errors = []
+            def save(i):
+                try:
+                    for n in range(50):
+                        event_index.save_indexes(path, {'game_events': event_index.EventIndex(i, [0], [0])})
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=save, args=(i,)) for i in range(1, 5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual([], errors)
+            self.assertIn(event_index.load_indexes(path)['game_events'].interval, [1, 2, 3, 4])
+            self.assertEqual(['a.StormReplay', 'a.StormReplay.index.json'], sorted(os.listdir(directory)))
+        finally:
+            shutil.rmtree(directory)
+
+class TestGameloopWindow(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = protocol_functions.ReplayDecoder(70133)
+
+    def assertWindows(self, decode, contents):
+        events = list(decode(contents))
+        index = event_index.EventIndex(7)
+        self.assertEqual(events, list(decode(contents, build_index=index)))
+        self.assertEqual((len(events) + 6) // 7, len(index))
+
+        gameloops = sorted(set(e['_gameloop'] for e in events))
+        rnd = random.Random(0)
+        windows = [(0, None), (gameloops[-1] + 1, None), (None, gameloops[len(gameloops) // 2])]
+        windows += [tuple(sorted(rnd.sample(gameloops, 2))) for i in range(10)]
+        for start, end in windows:
+            expected = [e for e in events
+                        if (start is None or e['_gameloop'] >= start) and (end is None or e['_gameloop'] < end)]
+            self.assertEqual(expected, list(decode(contents, start_gameloop=start, end_gameloop=end)))
+            self.assertEqual(expected, list(decode(contents, start_gameloop=start, end_gameloop=end, index=index)))
+
+    def test_game_events(self):
+        contents = write_random_events(self.decoder.protocol, 500, random.Random(1))
+        self.assertWindows(self.decoder.decode_replay_game_events, contents)
+
+    def test_tracker_events(self):
+        contents = write_random_tracker_events(self.decoder.protocol, 300, random.Random(2))
+        self.assertWindows(self.decoder.decode_replay_tracker_events, contents)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import heroprotocol
+import protocol_functions
+import replay_cache
+
+from test_decoder_compiler import VersionedWriter, write_random_events, write_random_versioned, write_versioned_value
+from test_mpyq import write_mpq
+from test_protocol_functions import write_random_tracker_events
+
+
+def write_random_replay(build, rnd, events=100):
+    # Returns a replay of build with a random header, details, game and tracker events
+    protocol = protocol_functions.ReplayDecoder(build).protocol
+
+    def versioned(typeid):
+        writer = VersionedWriter()
+        write_random_versioned(writer, protocol.typeinfos, typeid, rnd)
+        return writer.getvalue()
+
+    header = protocol_functions.ReplayDecoder(build).decode_replay_header(versioned(protocol.replay_header_typeid))
+    header['m_version'] = {'m_baseBuild': build}
+    writer = VersionedWriter()
+    write_versioned_value(writer, protocol.typeinfos, protocol.replay_header_typeid, header)
+
+    files = [
+        ('replay.details', versioned(protocol.game_details_typeid)),
+        ('replay.game.events', write_random_events(protocol, events, rnd)),
+        ('replay.tracker.events', write_random_tracker_events(protocol, events, rnd)),
+    ]
+    return write_mpq([(name, data + b'\x00' * (len(data) % 4096 == 0)) for name, data in files],
+                     user_data=writer.getvalue())
+
+
+class TestBatchDecoding(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.replays = os.path.join(self.directory, 'replays')
+        self.output = os.path.join(self.directory, 'output')
+        os.makedirs(os.path.join(self.replays, 'nested'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_replay(self, name, data):
+        path = os.path.join(self.replays, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def read_ndjson(self, name):
+        with open(os.path.join(self.output, name), encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def test_find_replays(self):
+        paths = [self.write_replay(name, b'') for name in ('a.StormReplay', 'nested/b.StormReplay', 'c.txt')]
+        self.assertEqual(paths[:2], heroprotocol.find_replays([self.replays]))
+        self.assertEqual(paths[:1], heroprotocol.find_replays([os.path.join(self.replays, '*.StormReplay')]))
+        self.assertEqual(paths[2:], heroprotocol.find_replays([paths[2]]))
+
+    def test_decode_replays(self):
+        rnd = random.Random(0)
+        builds = {'a': 70133, 'b': 29406, 'nested/c': 70133}
+        for name, build in builds.items():
+            self.write_replay(name + '.StormReplay', write_random_replay(build, rnd))
+        self.write_replay('broken.StormReplay', b'MPQ\x1bnot a replay')
+
+        paths = heroprotocol.find_replays([self.replays])
+        errors = open(os.devnull, 'w')
+        streams = set(['header', 'details', 'gameevents', 'trackerevents'])
+        self.assertEqual(1, heroprotocol.decode_replays(paths, self.output, streams, workers=2, output=errors))
+        self.assertEqual(0, heroprotocol.decode_replays(paths[:1], self.output, streams, per_stream=True,
+                                                        workers=1, output=errors))
+        errors.close()
+
+        for name, build in builds.items():
+            lines = self.read_ndjson(name + '.ndjson')
+            self.assertEqual(['header', 'details'], [line['_stream'] for line in lines[:2]])
+            self.assertEqual(build, lines[0]['m_version']['m_baseBuild'])
+            self.assertEqual(200, sum(1 for line in lines if line['_stream'].endswith('events')))
+
+        game_events = self.read_ndjson('a.gameevents.ndjson')
+        self.assertEqual([dict(line, _stream='gameevents') for line in game_events],
+                         [line for line in self.read_ndjson('a.ndjson') if line['_stream'] == 'gameevents'])
+        self.assertEqual(sorted(['a.ndjson', 'b.ndjson', 'nested', 'a.header.ndjson', 'a.details.ndjson',
+                                 'a.gameevents.ndjson', 'a.trackerevents.ndjson']),
+                         sorted(os.listdir(self.output)))
+        self.assertEqual(['c.ndjson'], os.listdir(os.path.join(self.output, 'nested')))
+
+    def test_same_file_names(self):
+        rnd = random.Random(2)
+        os.makedirs(os.path.join(self.replays, 'a'))
+        os.makedirs(os.path.join(self.replays, 'b'))
+        data = dict((name, write_random_replay(70133, rnd)) for name in ('a', 'b'))
+        for name in data:
+            self.write_replay(os.path.join(name, 'Game.StormReplay'), data[name])
+
+        paths = heroprotocol.find_replays([self.replays])
+        errors = open(os.devnull, 'w')
+        self.assertEqual(0, heroprotocol.decode_replays(paths, self.output, set(['header', 'gameevents']),
+                                                        workers=2, output=errors))
+        errors.close()
+        self.assertEqual(['a', 'b'], sorted(os.listdir(self.output)))
+        for name in data:
+            self.assertEqual(['Game.ndjson'], os.listdir(os.path.join(self.output, name)))
+        self.assertNotEqual(self.read_ndjson(os.path.join('a', 'Game.ndjson')),
+                            self.read_ndjson(os.path.join('b', 'Game.ndjson')))
+
+        # the same replay spelled differently would still share an output
+        path = os.path.join(self.replays, 'a', 'Game.StormReplay')
+        other = os.path.join(self.replays, 'a', '.', 'Game.StormReplay')
+        names, duplicates = heroprotocol.output_names([path, other])
+        self.assertEqual({path: 'Game'}, names)
+        self.assertEqual([(other, path)], duplicates)
+        errors = io.StringIO()
+        self.assertEqual(1, heroprotocol.decode_replays([path, other], self.output, set(['header']),
+                                                        workers=1, output=errors))
+        self.assertIn('same output name', errors.getvalue())
+
+    def test_cache(self):
+        path = self.write_replay('a.StormReplay', write_random_replay(70133, random.Random(1)))
+        cache = replay_cache.ReplayCache(os.path.join(self.directory, 'cache'))
+        streams = set(['header', 'details', 'gameevents', 'trackerevents'])
+        os.makedirs(self.output)
+        heroprotocol.write_ndjson(path, self.output, streams)
+        expected = self.read_ndjson('a.ndjson')
+
+        for i in range(2):
+            heroprotocol.write_ndjson(path, self.output, streams, cache=cache)
+            self.assertEqual(expected, self.read_ndjson('a.ndjson'))
+            self.assertEqual(4, len(cache.entries()))
+
+
+if __name__ == '__main__':
+    unittest.main()
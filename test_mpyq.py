@@ -0,0 +1,289 @@
+import io
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+
+from mpyq import mpyq
+
+
+_hasher = mpyq.MPQArchive.__new__(mpyq.MPQArchive)
+
+
+def _encrypt(data, key):
+    # Inverse of MPQArchive._decrypt
+    table = mpyq.MPQArchive.encryption_table
+    seed1 = key
+    seed2 = 0xEEEEEEEE
+    result = []
+    for value, in struct.iter_unpack('<I', data):
+        seed2 = (seed2 + table[0x400 + (seed1 & 0xFF)]) & 0xFFFFFFFF
+        result.append((value ^ (seed1 + seed2)) & 0xFFFFFFFF)
+        seed1 = (((~seed1 << 0x15) + 0x11111111) | (seed1 >> 0x0B)) & 0xFFFFFFFF
+        seed2 = (value + seed2 + (seed2 << 5) + 3) & 0xFFFFFFFF
+    return struct.pack('<%dI' % len(result), *result)
+
+
+def _compress(data):
+    return b'\x02' + zlib.compress(data)
+
+
+def _write_block(data, sector_size, single_unit):
+    # Returns the archived data and flags of a file, compressed when that saves space
+    flags = mpyq.MPQ_FILE_EXISTS
+    if single_unit:
+        flags |= mpyq.MPQ_FILE_SINGLE_UNIT
+        archived = _compress(data)
+        if len(archived) < len(data):
+            return archived, flags | mpyq.MPQ_FILE_COMPRESS
+        return data, flags
+
+    # the sector count is derived as mpyq does, so the size can't be a multiple of sector_size
+    assert len(data) % sector_size
+    chunks = [data[i:i + sector_size] for i in range(0, len(data), sector_size)]
+    for sectors, sector_flags in (([_compress(chunk) for chunk in chunks], mpyq.MPQ_FILE_COMPRESS), (chunks, 0)):
+        positions = [4 * (len(sectors) + 1)]
+        for sector in sectors:
+            positions.append(positions[-1] + len(sector))
+        archived = struct.pack('<%dI' % len(positions), *positions) + b''.join(sectors)
+        if sector_flags == 0 or len(archived) < len(data):
+            return archived, flags | sector_flags
+
+
+def write_mpq(files, user_data=b'', sector_size_shift=3, single_unit=(), listfile=True):
+    """Returns an MPQ archive of the (name, data) files behind a user data header.
+
+    Files are stored in sectors unless their name is in single_unit.
+    """
+    files = list(files)
+    if listfile:
+        files.append(('(listfile)', '\r\n'.join(name for name, data in files).encode('ascii')))
+    sector_size = 512 << sector_size_shift
+
+    body = bytearray()
+    blocks = []
+    header_size = 44
+    for name, data in files:
+        archived, flags = _write_block(data, sector_size, name in single_unit)
+        blocks.append((header_size + len(body), len(archived), len(data), flags))
+        body.extend(archived)
+
+    hash_entries = 16
+    while hash_entries < 2 * len(files):
+        hash_entries *= 2
+    hash_table = [(0xFFFFFFFF, 0xFFFFFFFF, 0xFFFF, 0xFFFF, 0xFFFFFFFF)] * hash_entries
+    for index, (name, data) in enumerate(files):
+        position = _hasher._hash(name, 'TABLE_OFFSET') & (hash_entries - 1)
+        while hash_table[position][4] != 0xFFFFFFFF:
+            position = (position + 1) & (hash_entries - 1)
+        hash_table[position] = (_hasher._hash(name, 'HASH_A'), _hasher._hash(name, 'HASH_B'), 0, 0, index)
+
+    hash_data = b''.join(struct.pack('<2I2HI', *entry) for entry in hash_table)
+    block_data = b''.join(struct.pack('<4I', *entry) for entry in blocks)
+    hash_table_offset = header_size + len(body)
+    block_table_offset = hash_table_offset + len(hash_data)
+    archive_size = block_table_offset + len(block_data)
+
+    mpq_header_offset = (16 + len(user_data) + 511) // 512 * 512
+    output = io.BytesIO()
+    output.write(struct.pack('<4s3I', b'MPQ\x1b', 512, mpq_header_offset, len(user_data)))
+    output.write(user_data)
+    output.write(b'\x00' * (mpq_header_offset - output.tell()))
+    output.write(struct.pack('<4s2I2H4I', b'MPQ\x1a', header_size, archive_size, 1, sector_size_shift,
+                             hash_table_offset, block_table_offset, hash_entries, len(blocks)))
+    output.write(struct.pack('q2h', 0, 0, 0))
+    output.write(body)
+    output.write(_encrypt(hash_data, _hasher._hash('(hash table)', 'TABLE')))
+    output.write(_encrypt(block_data, _hasher._hash('(block table)', 'TABLE')))
+    return output.getvalue()
+
+
+def random_files(rnd, count=5):
+    # Returns compressible files of up to a few sectors, and one incompressible file
+    files = []
+    for i in range(count):
+        size = rnd.randint(1, 20000)
+        size += size % 4096 == 0
+        files.append(('replay.file%d' % i, bytes(rnd.choice(b'abcd') for j in range(size))))
+    files.append(('replay.random', bytes(rnd.getrandbits(8) for j in range(5000))))
+    return files
+
+
+class TestMPQArchive(unittest.TestCase):
+
+    def test_read_file(self):
+        rnd = random.Random(0)
+        files = random_files(rnd)
+        data = write_mpq(files, user_data=b'header', single_unit=['replay.file0'])
+        archive = mpyq.MPQArchive(io.BytesIO(data))
+        self.assertEqual(b'header', archive.header['user_data_header']['content'])
+        self.assertEqual([name.encode('ascii') for name, contents in files], archive.files)
+        for name, contents in files:
+            self.assertEqual(contents, archive.read_file(name))
+        self.assertIsNone(archive.read_file('replay.missing'))
+
+    def test_hash_table_entry(self):
+        files = random_files(random.Random(3), 20)
+        archive = mpyq.MPQArchive(io.BytesIO(write_mpq(files)))
+        for name, contents in files + [('(listfile)', b''), ('replay.missing', b'')]:
+            hash_a = archive._hash(name, 'HASH_A')
+            hash_b = archive._hash(name, 'HASH_B')
+            expected = next((entry for entry in archive.hash_table
+                             if entry.hash_a == hash_a and entry.hash_b == hash_b), None)
+            self.assertEqual(expected, archive.get_hash_table_entry(name))
+            self.assertEqual(expected, archive.get_hash_table_entry(name.encode('ascii')))
+        self.assertIsNone(archive.get_hash_table_entry('replay.missing'))
+
+    def test_decrypt(self):
+        archive = mpyq.MPQArchive.__new__(mpyq.MPQArchive)
+        data = bytes(random.Random(4).getrandbits(8) for i in range(1024))
+        self.assertEqual(data, archive._decrypt(_encrypt(data, 0x12345678), 0x12345678))
+        self.assertEqual(data[:8], archive._decrypt(memoryview(_encrypt(data[:8], 7) + b'xyz'), 7))
+        self.assertEqual(mpyq.MPQArchive._table_keys['hash'], archive._hash('(hash table)', 'TABLE'))
+        self.assertEqual(0xC3AF3770, archive._hash('(hash table)', 'TABLE'))
+
+    def test_lazy(self):
+        files = random_files(random.Random(5))
+        archive = mpyq.MPQArchive(io.BytesIO(write_mpq(files)), lazy=True)
+        self.assertIsNone(archive._hash_table)
+        self.assertIsNone(archive._block_table)
+        for name, contents in files:
+            self.assertEqual(contents, archive.read_file(name))
+        self.assertFalse(archive._files_loaded)
+        self.assertEqual([name.encode('ascii') for name, contents in files], archive.files)
+        self.assertEqual(mpyq.MPQArchive(io.BytesIO(write_mpq(files))).hash_table, archive.hash_table)
+
+        archive = mpyq.MPQArchive(io.BytesIO(write_mpq(files, listfile=False)), lazy=True)
+        self.assertIsNone(archive.files)
+
+    def test_parallel(self):
+        rnd = random.Random(6)
+        files = [('replay.game.events', bytes(rnd.choice(b'abcdefgh') for i in range(100001))),
+                 ('replay.small', b'small' * 100)]
+        data = write_mpq(files, sector_size_shift=0)
+        archive = mpyq.MPQArchive(io.BytesIO(data), parallel=True)
+        for name, contents in files:
+            self.assertEqual(contents, archive.read_file(name))
+            self.assertEqual(contents, archive.read_file(name, parallel=False))
+        archive = mpyq.MPQArchive(io.BytesIO(data))
+        self.assertEqual(files[0][1], archive.read_file('replay.game.events', parallel=True))
+
+    def test_iter_file(self):
+        files = random_files(random.Random(7))
+        data = write_mpq(files, single_unit=['replay.file2'])
+        archive = mpyq.MPQArchive(io.BytesIO(data))
+        for name, contents in files:
+            chunks = list(archive.iter_file(name))
+            self.assertEqual(contents, b''.join(chunks))
+            if name != 'replay.file2':
+                self.assertEqual(len(contents) // 4096 + 1, len(chunks))
+        self.assertEqual(1, len(list(archive.iter_file('replay.file2'))))
+        self.assertIsNone(archive.iter_file('replay.missing'))
+
+    def test_prefetch(self):
+        rnd = random.Random(8)
+        contents = bytes(rnd.choice(b'abcdefgh') for i in range(50001))
+        data = write_mpq([('replay.game.events', contents)], sector_size_shift=0)
+        archive = mpyq.MPQArchive(io.BytesIO(data))
+        self.assertEqual(contents, b''.join(archive.iter_file('replay.game.events', prefetch=4)))
+
+        # stopping early stops the thread
+        chunks = archive.iter_file('replay.game.events', prefetch=2)
+        self.assertEqual(contents[:512], next(chunks))
+        chunks.close()
+        self.assertNotIn('mpyq-prefetch', [thread.name for thread in threading.enumerate()])
+        self.assertEqual(contents, archive.read_file('replay.game.events'))
+
+    def test_prefetch_backpressure(self):
+        produced = []
+        def items():
+            for i in range(100):
+                produced.append(i)
+                yield i
+        iterator = mpyq.iter_prefetched(items(), 3)
+        self.assertEqual(0, next(iterator))
+        time.sleep(0.1)
+        # up to 3 queued and one waiting for room
+        self.assertLessEqual(len(produced), 5)
+        iterator.close()
+
+        def failing():
+            yield 1
+            raise RuntimeError('corrupted sector')
+        iterator = mpyq.iter_prefetched(failing(), 3)
+        self.assertEqual(1, next(iterator))
+        self.assertRaises(RuntimeError, next, iterator)
+
+    def test_without_listfile(self):
+        files = random_files(random.Random(1), 2)
+        archive = mpyq.MPQArchive(io.BytesIO(write_mpq(files, listfile=False)), listfile=False)
+        self.assertIsNone(archive.files)
+        for name, contents in files:
+            self.assertEqual(contents, archive.read_file(name))
+
+
+class TestMappedArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.files = random_files(random.Random(2))
+        fd, self.path = tempfile.mkstemp(suffix='.StormReplay')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(write_mpq(self.files, user_data=b'header', single_unit=['replay.file1', 'replay.random']))
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_read_file(self):
+        with mpyq.MPQArchive(self.path, use_mmap=True) as archive:
+            self.assertIsNotNone(archive._view)
+            self.assertEqual(b'header', archive.header['user_data_header']['content'])
+            self.assertEqual([name.encode('ascii') for name, contents in self.files], archive.files)
+            for name, contents in self.files:
+                self.assertEqual(contents, archive.read_file(name))
+            # stored blocks are not copied
+            self.assertIsInstance(archive.read_file('replay.random'), memoryview)
+
+    def test_close_after_error(self):
+        rnd = random.Random(9)
+        files = [('replay.game.events', bytes(rnd.choice(b'abcdefgh') for i in range(100001)))]
+        with open(self.path, 'wb') as f:
+            f.write(write_mpq(files + self.files, sector_size_shift=0, single_unit=['replay.file1']))
+
+        def corrupted(data):
+            raise RuntimeError('corrupted sector')
+        self.addCleanup(setattr, mpyq, '_decompress', mpyq._decompress)
+        mpyq._decompress = corrupted
+
+        for name, parallel in [('replay.game.events', False), ('replay.game.events', True), ('replay.file1', False)]:
+            archive = mpyq.MPQArchive(self.path, listfile=False, use_mmap=True)
+            mapped = archive._map
+            # the exception and its traceback are kept alive
+            try:
+                archive.read_file(name, parallel=parallel)
+            except RuntimeError as e:
+                error = e
+            self.assertIsNotNone(error.__traceback__)
+            archive.close()
+            self.assertTrue(mapped.closed)
+
+    def test_close_with_slices(self):
+        archive = mpyq.MPQArchive(self.path, use_mmap=True)
+        contents = archive.read_file('replay.random')
+        archive.close()
+        self.assertTrue(archive.file.closed)
+        self.assertEqual(dict(self.files)['replay.random'], contents)
+
+    def test_fallback(self):
+        with open(self.path, 'rb') as f:
+            archive = mpyq.MPQArchive(io.BytesIO(f.read()), use_mmap=True)
+        self.assertIsNone(archive._view)
+        for name, contents in self.files:
+            self.assertEqual(contents, archive.read_file(name))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+import random
+import threading
+import unittest
+
+import protocol_functions
+
+from test_decoder_compiler import VersionedWriter, write_random_events, write_random_versioned
+
+
+def write_random_tracker_events(protocol, count, rnd):
+    # Writes a tracker event stream of count random events
+    writer = VersionedWriter()
+    event_types = sorted(protocol.tracker_event_types.items())
+    for i in range(count):
+        writer.write_byte(3)  # SVarUint32 choice
+        writer.write_vint(1)
+        writer.write_byte(9)
+        writer.write_vint(rnd.randint(0, 100))
+        eventid, (typeid, typename) = rnd.choice(event_types)
+        writer.write_byte(9)
+        writer.write_vint(eventid)
+        write_random_versioned(writer, protocol.typeinfos, typeid, rnd)
+    return writer.getvalue()
+
+
+class TestEventFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.default_protocol = protocol_functions.protocol
+        protocol_functions.load_protocol(70133)
+        self.protocol = protocol_functions.protocol
+
+    def tearDown(self):
+        protocol_functions.protocol = self.default_protocol
+
+    def test_game_events(self):
+        contents = write_random_events(self.protocol, 500, random.Random(0))
+        events = list(protocol_functions.decode_replay_game_events(contents))
+
+        wanted = ['NNet.Game.SCmdEvent', 'NNet.Game.SCameraUpdateEvent']
+        filtered = list(protocol_functions.decode_replay_game_events(contents, event_filter=wanted))
+        self.assertTrue(filtered)
+        self.assertEqual([e for e in events if e['_event'] in wanted], filtered)
+
+        eventid = events[0]['_eventid']
+        filtered = list(protocol_functions.decode_replay_game_events(contents, event_filter=[eventid]))
+        self.assertEqual([e for e in events if e['_eventid'] == eventid], filtered)
+
+        self.assertEqual([], list(protocol_functions.decode_replay_game_events(contents, event_filter=[])))
+
+    def test_tracker_events(self):
+        contents = write_random_tracker_events(self.protocol, 300, random.Random(1))
+        events = list(protocol_functions.decode_replay_tracker_events(contents))
+        self.assertEqual(300, len(events))
+
+        wanted = ['NNet.Replay.Tracker.SUnitDiedEvent', 'NNet.Replay.Tracker.SStatGameEvent']
+        filtered = list(protocol_functions.decode_replay_tracker_events(contents, event_filter=wanted))
+        self.assertTrue(filtered)
+        self.assertEqual([e for e in events if e['_event'] in wanted], filtered)
+
+
+class TestProjection(unittest.TestCase):
+
+    def setUp(self):
+        self.default_protocol = protocol_functions.protocol
+        protocol_functions.load_protocol(70133)
+        self.protocol = protocol_functions.protocol
+
+    def tearDown(self):
+        protocol_functions.protocol = self.default_protocol
+
+    def assertProjected(self, events, projected, projection):
+        self.assertEqual(len(events), len(projected))
+        for event, result in zip(events, projected):
+            fields = projection.get(event['_event'])
+            if fields is not None:
+                event = dict((k, v) for k, v in event.items() if k in fields or k.startswith('_'))
+            self.assertEqual(event, result)
+
+    def test_game_events(self):
+        contents = write_random_events(self.protocol, 500, random.Random(2))
+        events = list(protocol_functions.decode_replay_game_events(contents))
+
+        projection = {
+            'NNet.Game.SCmdEvent': ['m_abil', 'm_data'],
+            'NNet.Game.SCameraUpdateEvent': ['m_target'],
+            'NNet.Game.STriggerChatMessageEvent': [],
+        }
+        projected = list(protocol_functions.decode_replay_game_events(contents, projection=projection))
+        self.assertProjected(events, projected, projection)
+
+    def test_tracker_events(self):
+        contents = write_random_tracker_events(self.protocol, 300, random.Random(3))
+        events = list(protocol_functions.decode_replay_tracker_events(contents))
+
+        # SUnitBornEvent and SUnitInitEvent share a struct
+        projection = {'NNet.Replay.Tracker.SUnitBornEvent': ['m_unitTypeName', 'm_x', 'm_y']}
+        projected = list(protocol_functions.decode_replay_tracker_events(contents, projection=projection))
+        self.assertProjected(events, projected, projection)
+
+        projection = {
+            'NNet.Replay.Tracker.SUnitBornEvent': ['m_unitTypeName', 'm_x', 'm_y'],
+            'NNet.Replay.Tracker.SUnitInitEvent': ['m_unitTypeName'],
+            'NNet.Replay.Tracker.SStatGameEvent': ['m_eventName'],
+        }
+        projected = list(protocol_functions.decode_replay_tracker_events(contents, projection=projection))
+        self.assertProjected(events, projected, projection)
+
+
+class TestReplayDecoder(unittest.TestCase):
+
+    def test_module_functions(self):
+        self.addCleanup(setattr, protocol_functions, 'protocol', protocol_functions.protocol)
+        protocol_functions.load_protocol(70133)
+        decoder = protocol_functions.ReplayDecoder(70133)
+        self.assertIs(protocol_functions.protocol, decoder.protocol)
+        contents = write_random_events(decoder.protocol, 200, random.Random(4))
+        self.assertEqual(list(protocol_functions.decode_replay_game_events(contents)),
+                         list(decoder.decode_replay_game_events(contents)))
+
+    def test_protocol_module(self):
+        # protocol used to be a protocol module, assigning one still works
+        import protocol70133
+        self.addCleanup(setattr, protocol_functions, 'protocol', protocol_functions.protocol)
+        protocol_functions.protocol = protocol70133
+        decoder = protocol_functions.ReplayDecoder(70133)
+        self.assertEqual(70133, protocol_functions.ReplayDecoder(protocol70133).protocol.build)
+        self.assertIs(protocol70133.typeinfos, protocol_functions.ReplayDecoder(protocol70133).protocol.typeinfos)
+        contents = write_random_events(decoder.protocol, 200, random.Random(6))
+        self.assertEqual(list(decoder.decode_replay_game_events(contents)),
+                         list(protocol_functions.decode_replay_game_events(contents)))
+        writer = VersionedWriter()
+        write_random_versioned(writer, decoder.protocol.typeinfos, decoder.protocol.replay_header_typeid,
+                               random.Random(7))
+        self.assertEqual(decoder.decode_replay_header(writer.getvalue()),
+                         protocol_functions.decode_replay_header(writer.getvalue()))
+
+    def test_concurrent_builds(self):
+        # Decodes replays of builds with different schemas at the same time
+        streams = []
+        for i, build in enumerate([29406, 45815, 70133]):
+            decoder = protocol_functions.ReplayDecoder(build)
+            contents = write_random_events(decoder.protocol, 300, random.Random(5 + i))
+            streams.append((decoder, contents, list(decoder.decode_replay_game_events(contents))))
+
+        results = {}
+        def decode(i, decoder, contents):
+            for n in range(5):
+                results[i, n] = list(decoder.decode_replay_game_events(contents))
+
+        threads = [threading.Thread(target=decode, args=(i, decoder, contents))
+                   for i, (decoder, contents, events) in enumerate(streams)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for (i, n), events in results.items():
+            self.assertEqual(streams[i][2], events)
+        self.assertEqual(15, len(results))
+
+
+if __name__ == '__main__':
+    unittest.main()
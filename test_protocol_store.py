@@ -0,0 +1,33 @@
+import unittest
+
+import protocol_store
+
+
+class TestProtocolStore(unittest.TestCase):
+
+    def test_index_up_to_date(self):
+        self.assertEqual(protocol_store.schemas, protocol_store.build_index())
+
+    def test_shared_schema(self):
+        first = protocol_store.load_protocol(62548)
+        later = protocol_store.load_protocol(65654)
+        self.assertEqual(65654, later.build)
+        self.assertEqual(62548, later.schema)
+        self.assertIs(first.typeinfos, later.typeinfos)
+        self.assertIs(first.tracker_event_types, later.tracker_event_types)
+        self.assertIs(later, protocol_store.load_protocol('65654'))
+
+    def test_tables(self):
+        module = __import__('protocol70133')
+        protocol = protocol_store.load_protocol(70133)
+        for name in protocol_store.PROTOCOL_ATTRIBUTES:
+            self.assertEqual(getattr(module, name), getattr(protocol, name))
+
+    def test_unknown_build(self):
+        self.assertRaises(ImportError, protocol_store.load_protocol, 12345)
+        self.assertNotIn(12345, protocol_store.available_builds())
+        self.assertIn(70133, protocol_store.available_builds())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import protocol_functions
+import replay
+
+from test_heroprotocol import write_random_replay
+
+
+class TestScanReplayHeader(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'a.StormReplay')
+        with open(self.path, 'wb') as f:
+            f.write(write_random_replay(70133, random.Random(0), events=10))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_scan(self):
+        header = protocol_functions.ReplayDecoder(replay.HEADER_BUILD).decode_replay_header(
+            replay.read_user_data(self.path))
+        self.assertEqual(70133, header['m_version']['m_baseBuild'])
+
+        scanned = replay.scan_replay_header(self.path)
+        self.assertEqual(dict((k, header[k]) for k in replay.HEADER_FIELDS), scanned)
+        self.assertEqual(header, replay.scan_replay_header(self.path, fields=None))
+        self.assertEqual({'m_type': header['m_type']}, replay.scan_replay_header(self.path, fields=['m_type']))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(scanned, replay.scan_replay_header(f))
+
+    def test_not_a_replay(self):
+        self.assertRaises(ValueError, replay.scan_replay_header, io.BytesIO(b'MPQ\x1a' + bytes(100)))
+        self.assertRaises(ValueError, replay.scan_replay_header, io.BytesIO(b''))
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'a.StormReplay')
+        with open(self.path, 'wb') as f:
+            f.write(write_random_replay(70133, random.Random(1), events=50))
+        self.decoder = protocol_functions.ReplayDecoder(70133)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_streams(self):
+        with replay.Replay(self.path) as replay_file:
+            self.assertEqual(70133, replay_file.build)
+            self.assertIs(self.decoder.protocol, replay_file.decoder.protocol)
+            game_events = list(self.decoder.decode_replay_game_events(replay_file.read_file('replay.game.events')))
+            self.assertEqual(game_events, replay_file.game_events)
+            self.assertIs(replay_file.game_events, replay_file.game_events)
+            self.assertEqual(game_events, list(replay_file.iter_game_events()))
+            self.assertEqual([e for e in game_events if e['_event'] == 'NNet.Game.SCmdEvent'],
+                             list(replay_file.iter_game_events(event_filter=['NNet.Game.SCmdEvent'])))
+            self.assertEqual(self.decoder.decode_replay_details(replay_file.read_file('replay.details')),
+                             replay_file.details)
+            self.assertEqual(50, len(replay_file.tracker_events))
+
+            # streams the replay doesn't have
+            self.assertIsNone(replay_file.initdata)
+            self.assertEqual([], replay_file.message_events)
+            self.assertEqual([], list(replay_file.iter_message_events()))
+
+    def test_streaming(self):
+        with open(self.path, 'wb') as f:
+            f.write(write_random_replay(70133, random.Random(2), events=1000))
+        with replay.Replay(self.path, max_size=0) as replay_file:
+            self.assertGreater(len(list(replay_file.archive.iter_file('replay.game.events'))), 1)
+            for name in replay.EVENT_STREAMS:
+                self.assertEqual(replay_file.stream(name), list(replay_file.iter_events(name)))
+            projection = {'NNet.Replay.Tracker.SUnitBornEvent': ['m_unitTypeName']}
+            contents = replay_file.read_file('replay.tracker.events')
+            self.assertEqual(list(self.decoder.decode_replay_tracker_events(contents, projection=projection)),
+                             list(replay_file.iter_tracker_events(projection=projection)))
+
+        with replay.Replay(self.path, max_size=0, prefetch=4) as replay_file:
+            for name in replay.EVENT_STREAMS:
+                self.assertEqual(replay_file.stream(name), list(replay_file.iter_events(name)))
+            events = replay_file.iter_game_events()
+            next(events)
+            events.close()
+
+    def test_gameloop_window(self):
+        with replay.Replay(self.path) as replay_file:
+            events = replay_file.tracker_events
+            start, end = events[10]['_gameloop'], events[40]['_gameloop']
+            expected = [e for e in events if start <= e['_gameloop'] < end]
+            self.assertEqual(expected, list(replay_file.iter_tracker_events(start_gameloop=start, end_gameloop=end)))
+            index = replay_file.event_index('tracker_events')
+            self.assertTrue(os.path.exists(self.path + '.index.json'))
+
+        with replay.Replay(self.path) as replay_file:
+            self.assertEqual(index.to_dict(), replay_file.event_index('tracker_events').to_dict())
+            self.assertEqual(expected, list(replay_file.iter_tracker_events(start_gameloop=start, end_gameloop=end)))
+            self.assertEqual(['tracker_events'], list(replay_file._indexes))
+
+    def test_reopen(self):
+        replay_file = replay.Replay(self.path)
+        details = replay_file.details
+        replay_file.close()
+        self.assertEqual(50, len(replay_file.game_events))
+        self.assertEqual(details, replay_file.details)
+        self.assertEqual(50, len(list(replay_file.iter_tracker_events())))
+        replay_file.close()
+        replay_file.close()
+
+    def test_max_size(self):
+        with replay.Replay(self.path) as replay_file:
+            game_size = len(replay_file.read_file('replay.game.events'))
+            tracker_size = len(replay_file.read_file('replay.tracker.events'))
+
+        with replay.Replay(self.path, max_size=max(game_size, tracker_size)) as replay_file:
+            game_events = replay_file.game_events
+            self.assertIs(game_events, replay_file.game_events)
+            replay_file.tracker_events
+            self.assertEqual(['tracker_events'], list(replay_file._cache))
+            self.assertIsNot(game_events, replay_file.game_events)
+            self.assertEqual(game_events, replay_file.game_events)
+
+        with replay.Replay(self.path, max_size=0) as replay_file:
+            self.assertIsNot(replay_file.game_events, replay_file.game_events)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import replay
+import replay_cache
+
+from test_heroprotocol import write_random_replay
+
+
+class TestReplayCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = replay_cache.ReplayCache(os.path.join(self.directory, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_store_load(self):
+        self.assertRaises(KeyError, self.cache.load, 'key', 'details')
+        value = {'m_title': b'Cursed Hollow', 'm_playerList': [{'m_hero': 'Raynor'}] * 10}
+        self.cache.store('key', 'details', value)
+        self.assertEqual(value, self.cache.load('key', 'details'))
+        self.assertRaises(KeyError, self.cache.load, 'key', 'initdata')
+        self.assertRaises(KeyError, self.cache.load, 'other', 'details')
+        self.assertEqual(['key.details.zpkl'], os.listdir(self.cache.directory))
+
+        # unreadable entries are misses
+        filename = self.cache.entries()[0][2]
+        with open(filename, 'wb') as f:
+            f.write(b'corrupted')
+        self.assertRaises(KeyError, self.cache.load, 'key', 'details')
+        self.assertEqual([], self.cache.entries())
+
+    def test_evict(self):
+        rnd = random.Random(0)
+        for i in range(4):
+            self.cache.store('key%d' % i, 'details', bytes(rnd.getrandbits(8) for j in range(1000)))
+            os.utime(self.cache._filename('key%d' % i, 'details'), (i, i))
+        self.cache.load('key0', 'details')  # now the most recently used
+
+        size = self.cache.size()
+        self.cache.evict(size - 1)
+        self.assertRaises(KeyError, self.cache.load, 'key1', 'details')
+        self.cache.max_size = size // 2
+        self.cache.store('key4', 'details', b'')
+        self.assertEqual(['key0', 'key4'], sorted(os.path.basename(f).split('.')[0]
+                                                  for mtime, size, f in self.cache.entries()))
+        self.cache.clear()
+        self.assertEqual(0, self.cache.size())
+
+    def test_store_scans(self):
+        scans = []
+        entries = self.cache.entries
+        self.cache.entries = lambda: scans.append(1) or entries()
+        rnd = random.Random(1)
+        for i in range(20):
+            self.cache.store('key%d' % i, 'details', bytes(rnd.getrandbits(8) for j in range(1000)))
+        # one scan to start counting the size
+        self.assertEqual(1, len(scans))
+
+        self.cache.max_size = 10000
+        self.cache.store('key20', 'details', b'')
+        self.assertEqual(2, len(scans))
+        self.assertLessEqual(self.cache.size(), 9000)
+
+    def test_private_directory(self):
+        self.assertEqual(0o700, os.stat(self.cache.directory).st_mode & 0o777)
+        shared = os.path.join(self.directory, 'shared')
+        os.mkdir(shared)
+        os.chmod(shared, 0o777)
+        self.assertRaises(PermissionError, replay_cache.ReplayCache, shared)
+
+    def test_key(self):
+        path = os.path.join(self.directory, 'a.StormReplay')
+        with open(path, 'wb') as f:
+            f.write(b'replay')
+        key = self.cache.key(path)
+        self.assertTrue(key.endswith(replay_cache.DECODER_VERSION))
+        with open(path, 'wb') as f:
+            f.write(b'other replay')
+        self.assertNotEqual(key, self.cache.key(path))
+
+
+class TestCachedReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'a.StormReplay')
+        with open(self.path, 'wb') as f:
+            f.write(write_random_replay(70133, random.Random(0), events=50))
+        self.cache = replay_cache.ReplayCache(os.path.join(self.directory, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_hit_skips_archive(self):
+        names = ['details', 'initdata', 'game_events', 'tracker_columns']
+        with replay.Replay(self.path) as replay_file:
+            expected = [replay_file.header] + [replay_file.stream(name) for name in names]
+
+        with replay.Replay(self.path, cache=self.cache) as replay_file:
+            self.assertEqual(expected[:4], [replay_file.header] + [replay_file.stream(name) for name in names[:3]])
+            replay_file.tracker_columns
+        self.assertEqual(5, len(self.cache.entries()))
+
+        with replay.Replay(self.path, cache=self.cache) as replay_file:
+            self.assertEqual(70133, replay_file.build)
+            cached = [replay_file.header] + [replay_file.stream(name) for name in names]
+            self.assertIsNone(replay_file._archive)
+        self.assertEqual(expected[:4], cached[:4])
+        self.assertEqual(list(expected[4].tables), list(cached[4].tables))
+        for name, table in expected[4].tables.items():
+            self.assertEqual(sorted(table.columns), sorted(cached[4][name].columns))
+            for column, values in table.columns.items():
+                self.assertEqual(list(values), list(cached[4][name].columns[column]))
+
+
+if __name__ == '__main__':
+    unittest.main()
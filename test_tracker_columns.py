@@ -0,0 +1,116 @@
+import os
+import random
+import subprocess
+import sys
+import unittest
+
+import protocol_functions
+import tracker_columns
+
+from test_protocol_functions import write_random_tracker_events
+
+
+class TestTrackerColumns(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = protocol_functions.ReplayDecoder(70133)
+        self.contents = write_random_tracker_events(self.decoder.protocol, 400, random.Random(0))
+        self.events = list(self.decoder.decode_replay_tracker_events(self.contents))
+
+    def assertColumns(self, columns):
+        for name, fields in tracker_columns.COLUMN_EVENTS.items():
+            events = [e for e in self.events if e['_event'] == name]
+            table = columns[name]
+            self.assertEqual(len(events), len(table))
+            self.assertEqual([e['_gameloop'] for e in events], list(table['_gameloop']))
+            for field in fields:
+                values = [e.get(field) for e in events]
+                if field in table.children:
+                    child = table.children[field]
+                    items = [(row, item) for row, value in enumerate(values) for item in value or []]
+                    self.assertEqual([row for row, item in items], list(child['_row']))
+                    if field == 'm_items':
+                        self.assertEqual([item for row, item in items], list(child['value']))
+                    else:
+                        self.assertEqual([item['m_key'] for row, item in items], child.strings_of('m_key'))
+                elif values and isinstance(values[0], (str, bytes)):
+                    self.assertEqual(values, table.strings_of(field))
+                elif field in table.columns:
+                    expected = [tracker_columns.MISSING if v is None else v for v in values]
+                    self.assertEqual(expected, list(table[field]))
+
+    def test_columns(self):
+        columns = self.decoder.decode_replay_tracker_columns(self.contents, use_numpy=False)
+        self.assertEqual(set(tracker_columns.COLUMN_EVENTS), set(columns.tables))
+        self.assertEqual(sorted(['_gameloop', 'm_unitTagIndex', 'm_unitTagRecycle', 'm_unitTypeName',
+                                 'm_controlPlayerId', 'm_upkeepPlayerId', 'm_x', 'm_y']),
+                         sorted(columns['NNet.Replay.Tracker.SUnitBornEvent'].columns))
+        self.assertColumns(columns)
+
+    def test_events(self):
+        events = {'NNet.Replay.Tracker.SUnitDiedEvent': ['m_x', 'm_y']}
+        columns = self.decoder.decode_replay_tracker_columns(self.contents, events=events, use_numpy=False)
+        self.assertEqual(['NNet.Replay.Tracker.SUnitDiedEvent'], list(columns.tables))
+        self.assertEqual(['_gameloop', 'm_x', 'm_y'], sorted(columns['NNet.Replay.Tracker.SUnitDiedEvent'].columns))
+
+    def test_missing_fields(self):
+        table = tracker_columns.ColumnTable('t', tracker_columns.StringTable())
+        table.append({'a': 1})
+        table.append({'b': 'x', 'a': None})
+        table.append({'b': 'x'})
+        self.assertEqual([1, tracker_columns.MISSING, tracker_columns.MISSING], list(table['a']))
+        self.assertEqual([None, 'x', 'x'], table.strings_of('b'))
+        self.assertEqual(['x'], table.strings.strings)
+
+    @unittest.skipIf(tracker_columns.numpy_module() is None, 'NumPy is not installed')
+    def test_numpy(self):
+        columns = self.decoder.decode_replay_tracker_columns(self.contents, use_numpy=True)
+        self.assertIsInstance(columns['NNet.Replay.Tracker.SUnitBornEvent']['m_x'], tracker_columns.numpy_module().ndarray)
+        self.assertColumns(columns)
+
+
+class TestUnitPositions(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = protocol_functions.ReplayDecoder(70133)
+        self.contents = write_random_tracker_events(self.decoder.protocol, 400, random.Random(1))
+
+        # the expansion described in the README
+        self.expected = []
+        for event in self.decoder.decode_replay_tracker_events(self.contents):
+            if event['_event'] == tracker_columns.POSITIONS_EVENT:
+                unitIndex = event['m_firstUnitIndex']
+                for i in range(0, len(event['m_items']) // 3 * 3, 3):
+                    unitIndex += event['m_items'][i + 0]
+                    x = event['m_items'][i + 1] * 4
+                    y = event['m_items'][i + 2] * 4
+                    self.expected.append((event['_gameloop'], unitIndex, x, y))
+        self.assertTrue(self.expected)
+
+    def assertPositions(self, table):
+        self.assertEqual(len(self.expected), len(table))
+        self.assertEqual(self.expected, list(zip(*(map(int, table[c]) for c in ('_gameloop', 'unitIndex', 'x', 'y')))))
+
+    def test_positions(self):
+        self.assertPositions(self.decoder.decode_replay_unit_positions(self.contents, use_numpy=False))
+
+    @unittest.skipIf(tracker_columns.numpy_module() is None, 'NumPy is not installed')
+    def test_numpy(self):
+        self.assertPositions(self.decoder.decode_replay_unit_positions(self.contents, use_numpy=True))
+
+    def test_empty(self):
+        self.assertEqual(0, len(tracker_columns.unit_positions([], use_numpy=False)))
+
+
+class TestNumpyImport(unittest.TestCase):
+
+    def test_lazy_import(self):
+        # NumPy is only imported once columns are built
+        code = 'import sys, heroprotocol, replay_cache; print("numpy" in sys.modules)'
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(b'False', output.strip())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,275 @@
+# Copyright (c) 2018 Blizzard Entertainment
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections
+import importlib.util
+import itertools
+from array import array
+
+
+# The numpy module once imported, False if NumPy isn't installed.  NumPy takes longer to
+# import than the rest of the decoders, so it is only imported when columns are built.
+_numpy = None
+
+
+def numpy_module():
+    """Returns the numpy module, imported on first use, or None if NumPy isn't installed."""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+
+def has_numpy():
+    """Returns whether NumPy is installed, without importing it."""
+    if _numpy is not None:
+        return bool(_numpy)
+    return importlib.util.find_spec('numpy') is not None
+
+
+# The tracker events decoded into columns by default, with the fields to decode.
+COLUMN_EVENTS = {
+    'NNet.Replay.Tracker.SUnitBornEvent': ('m_unitTagIndex', 'm_unitTagRecycle', 'm_unitTypeName',
+                                           'm_controlPlayerId', 'm_upkeepPlayerId', 'm_x', 'm_y'),
+    'NNet.Replay.Tracker.SUnitDiedEvent': ('m_unitTagIndex', 'm_unitTagRecycle', 'm_killerPlayerId',
+                                           'm_x', 'm_y', 'm_killerUnitTagIndex', 'm_killerUnitTagRecycle'),
+    'NNet.Replay.Tracker.SUnitPositionsEvent': ('m_firstUnitIndex', 'm_items'),
+    'NNet.Replay.Tracker.SStatGameEvent': ('m_eventName', 'm_stringData', 'm_intData', 'm_fixedData'),
+}
+
+POSITIONS_EVENT = 'NNet.Replay.Tracker.SUnitPositionsEvent'
+
+# The value of a missing optional field, or of a field the event doesn't have.
+MISSING = -1
+
+
+class StringTable:
+    """Interns strings into codes, the index of each string in strings."""
+    def __init__(self):
+        self.strings = []
+        self._codes = {}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def intern(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.strings)
+            self.strings.append(value)
+        return code
+
+
+class ColumnTable:
+    """A struct of arrays, one 64-bit integer column per field.
+
+    Strings are stored as codes into the shared StringTable, missing values as MISSING.
+    Array fields go to a child table per field, in which the _row column is the row of the
+    parent, struct items are stored by field and other items in a 'value' column.
+    """
+    def __init__(self, name, strings):
+        self.name = name
+        self.strings = strings
+        self.columns = collections.OrderedDict()
+        self.children = collections.OrderedDict()
+        self._rows = 0
+
+    def __len__(self):
+        return self._rows
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def __repr__(self):
+        return 'ColumnTable(%r, %d rows, columns=%r)' % (self.name, self._rows, list(self.columns))
+
+    @classmethod
+    def from_columns(cls, name, columns, strings=None):
+        """Returns a table of the given columns of equal length."""
+        table = cls(name, strings if strings is not None else StringTable())
+        table.columns.update(columns)
+        table._rows = len(next(iter(table.columns.values()))) if table.columns else 0
+        return table
+
+    def _column(self, name):
+        column = self.columns.get(name)
+        if column is None:
+            column = self.columns[name] = array('q', [MISSING]) * self._rows
+        return column
+
+    def _child(self, name):
+        child = self.children.get(name)
+        if child is None:
+            child = self.children[name] = ColumnTable('%s.%s' % (self.name, name), self.strings)
+        return child
+
+    def append(self, row):
+        """Appends a decoded struct as a row."""
+        index = self._rows
+        for name, value in row.items():
+            if isinstance(value, list):
+                child = self._child(name)
+                for item in value:
+                    child.append(dict(item, _row=index) if isinstance(item, dict) else {'_row': index, 'value': item})
+            else:
+                self._column(name).append(self._value(value))
+        self._rows += 1
+        for column in self.columns.values():
+            if len(column) < self._rows:
+                column.append(MISSING)
+
+    def _value(self, value):
+        if value is None:
+            return MISSING
+        if isinstance(value, (str, bytes)):
+            return self.strings.intern(value)
+        if isinstance(value, dict):
+            # an optional struct or choice, e.g. a SVarUint32, keeps its single value
+            for v in value.values():
+                return self._value(v)
+            return MISSING
+        return int(value)
+
+    def strings_of(self, column):
+        """Returns the strings of a column of string codes."""
+        strings = self.strings.strings
+        return [strings[code] if code != MISSING else None for code in self.columns[column]]
+
+    def to_numpy(self):
+        """Turns the columns into int64 NumPy arrays sharing the array memory."""
+        numpy = numpy_module()
+        for name, column in self.columns.items():
+            if isinstance(column, array):
+                self.columns[name] = numpy.frombuffer(column, dtype=numpy.int64) if len(column) else \
+                    numpy.zeros(0, dtype=numpy.int64)
+        for child in self.children.values():
+            child.to_numpy()
+
+
+class TrackerColumns:
+    """The tracker events of a replay as a ColumnTable per event name."""
+    def __init__(self):
+        self.strings = StringTable()
+        self.tables = collections.OrderedDict()
+
+    def __getitem__(self, event):
+        return self.tables[event]
+
+    def __contains__(self, event):
+        return event in self.tables
+
+    def table(self, event):
+        table = self.tables.get(event)
+        if table is None:
+            table = self.tables[event] = ColumnTable(event, self.strings)
+        return table
+
+    def append(self, event):
+        row = dict((k, v) for k, v in event.items() if k not in ('_event', '_eventid', '_bits'))
+        self.table(event['_event']).append(row)
+
+    def to_numpy(self):
+        for table in self.tables.values():
+            table.to_numpy()
+
+
+def tracker_columns(events, use_numpy=None):
+    """Collects decoded tracker events into TrackerColumns.
+
+    The columns are int64 NumPy arrays if NumPy is installed and use_numpy isn't False,
+    otherwise array('q') arrays.
+    """
+    use_numpy = _use_numpy(use_numpy)
+    columns = TrackerColumns()
+    for event in events:
+        columns.append(event)
+    if use_numpy:
+        columns.to_numpy()
+    return columns
+
+
+def _use_numpy(use_numpy):
+    if use_numpy is not None and not use_numpy:
+        return False
+    if numpy_module() is None:
+        if use_numpy:
+            raise ImportError('use_numpy requires NumPy')
+        return False
+    return True
+
+
+def unit_positions(events, use_numpy=None):
+    """Expands SUnitPositionsEvent events into a table of unit positions.
+
+    The m_items of each event are (index delta, x / 4, y / 4) triples, the unit index is
+    m_firstUnitIndex plus the running sum of the deltas.  Events are consumed as they are
+    decoded, other events are ignored, and the columns _gameloop, unitIndex, x and y are
+    built for the whole stream at once: with a cumulative sum over the deltas of all events
+    if NumPy is used, see tracker_columns, otherwise per event.
+    """
+    use_numpy = _use_numpy(use_numpy)
+    gameloops = array('q')
+    firsts = array('q')
+    counts = array('q')
+    items = array('q')
+    unit_index = array('q')
+    for event in events:
+        if event['_event'] != POSITIONS_EVENT:
+            continue
+        event_items = event['m_items']
+        count = len(event_items) // 3
+        gameloops.append(event['_gameloop'])
+        firsts.append(event['m_firstUnitIndex'])
+        counts.append(count)
+        items.extend(event_items[:3 * count])
+        if not use_numpy:
+            running = itertools.accumulate(event_items[0:3 * count:3], initial=event['m_firstUnitIndex'])
+            unit_index.extend(itertools.islice(running, 1, None))
+
+    if use_numpy:
+        numpy = numpy_module()
+        counts = numpy.frombuffer(counts, dtype=numpy.int64) if len(counts) else numpy.zeros(0, dtype=numpy.int64)
+        triples = (numpy.frombuffer(items, dtype=numpy.int64) if len(items) else
+                   numpy.zeros(0, dtype=numpy.int64)).reshape(-1, 3)
+        deltas = numpy.cumsum(triples[:, 0])
+        # the running sum of the deltas before each event's first item
+        starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+        before = numpy.concatenate(([0], deltas))[starts]
+        columns = [
+            ('_gameloop', numpy.repeat(numpy.asarray(gameloops, dtype=numpy.int64), counts)),
+            ('unitIndex', numpy.repeat(numpy.asarray(firsts, dtype=numpy.int64) - before, counts) + deltas),
+            ('x', triples[:, 1] * 4),
+            ('y', triples[:, 2] * 4),
+        ]
+    else:
+        gameloop = array('q')
+        for loop, count in zip(gameloops, counts):
+            gameloop.extend(array('q', [loop]) * count)
+        columns = [
+            ('_gameloop', gameloop),
+            ('unitIndex', unit_index),
+            ('x', array('q', (v * 4 for v in items[1::3]))),
+            ('y', array('q', (v * 4 for v in items[2::3]))),
+        ]
+    return ColumnTable.from_columns('unit_positions', columns)